@@ -1,32 +1,140 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify
+from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, g
 from flask_bootstrap import Bootstrap
 import os
 import datetime
-import plotly.express as px
-import plotly.graph_objects as go
-import pandas as pd
-import json
-import numpy as np
-
-from classes import MainProgramData, Ticker, Investment, UserProfile
-
-# Custom JSON encoder to handle numpy types
-class NumpyEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, np.integer):
-            return int(obj)
-        elif isinstance(obj, np.floating):
-            return float(obj)
-        elif isinstance(obj, np.ndarray):
-            return obj.tolist()
-        return super(NumpyEncoder, self).default(obj)
+import hashlib
+import hmac
+import io
+import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from classes import MainProgramData, Ticker, Investment, UserProfile, write_lock
+from refresher import BackgroundRefresher
+import charts
+import importer
+import metrics
+from market_data import CircuitBreaker, get_market_data
+from profiling import RequestProfiler
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'investment-tracker-secret-key'
+app.config['BACKGROUND_REFRESH'] = True  # Refresh tickers in a background thread instead of inside requests
+app.config['CHART_POINT_BUDGET'] = 500  # Longer series are downsampled before they are sent to the browser
+# Restore the latest session and load its tickers in the background at startup, see /ready
+app.config['WARM_UP'] = os.environ.get('INVESTMENT_TRACKER_WARM_UP') == '1'
+# Allow capturing sampling profiles of requests
+app.config['PROFILING_ENABLED'] = os.environ.get('INVESTMENT_TRACKER_PROFILING') == '1'
+# Profile a request sending it in X-Profile-Token or ?profile=
+app.config['PROFILING_TOKEN'] = os.environ.get('INVESTMENT_TRACKER_PROFILING_TOKEN') or None
+# Seconds after which a request is profiled automatically
+app.config['PROFILING_SLOW_THRESHOLD'] = (float(os.environ['INVESTMENT_TRACKER_PROFILING_SLOW_THRESHOLD'])
+                                          if os.environ.get('INVESTMENT_TRACKER_PROFILING_SLOW_THRESHOLD') else None)
+app.config['PROFILING_DIR'] = os.environ.get('INVESTMENT_TRACKER_PROFILING_DIR', 'profiles')
+# Seconds between stack samples
+app.config['PROFILING_INTERVAL'] = float(os.environ.get('INVESTMENT_TRACKER_PROFILING_INTERVAL', 0.005))
+# Seconds between written profiles
+app.config['PROFILING_MIN_INTERVAL'] = float(os.environ.get('INVESTMENT_TRACKER_PROFILING_MIN_INTERVAL', 60))
 bootstrap = Bootstrap(app)
 
-# Initialize the main program data
+# Currencies a portfolio's totals can be shown in, the same ones investments can be added in
+CURRENCIES = ('EUR', 'USD', 'GBP', 'JPY', 'CHF')
+
+# Initialize the main program data, journaling every change so nothing is lost between saves
 program_data = MainProgramData()
+program_data.open_journal()
+
+# Background refresher follows the global program data, which is replaced when a session is loaded
+refresher = BackgroundRefresher(lambda: program_data)
+
+# Serialized chart payloads, keyed by everything they depend on so they never go stale
+chart_cache = charts.ChartCache()
+
+# Created from the PROFILING_* settings with the first request, when profiling is enabled
+profiler = None
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def record_request_duration(response):
+    """Observe the request latency per route pattern, so IDs in URLs do not create separate series"""
+    start = g.pop('request_start', None)
+    if start is not None:
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        metrics.http_request_duration.observe(time.perf_counter() - start, route=route, method=request.method,
+                                              status=response.status_code)
+    return response
+
+@app.before_request
+def start_profiling():
+    global profiler
+    if not app.config['PROFILING_ENABLED']:
+        return
+    if profiler is None:
+        profiler = RequestProfiler(app.config['PROFILING_DIR'], app.config['PROFILING_INTERVAL'],
+                                   app.config['PROFILING_SLOW_THRESHOLD'], app.config['PROFILING_MIN_INTERVAL'])
+    token = app.config['PROFILING_TOKEN']
+    sent = request.headers.get('X-Profile-Token') or request.args.get('profile')
+    forced = bool(token and sent and hmac.compare_digest(token, sent))
+    g.profile = profiler.begin(forced)
+
+def end_profile():
+    """Stop sampling the current request and write its profile if it was forced or slow, return its path or None"""
+    capture = g.pop('profile', None)
+    if capture is None:
+        return None
+    route = request.url_rule.rule if request.url_rule is not None else request.path
+    path = profiler.end(capture, f"{request.method}_{route}")
+    return path if capture.forced else None
+
+@app.after_request
+def write_profile(response):
+    """Write the profile of a profiled or slow request, naming the file in the X-Profile header"""
+    path = end_profile()
+    if path is not None:
+        response.headers['X-Profile'] = os.path.basename(path)
+    return response
+
+@app.teardown_request
+def end_unfinished_profile(exception):
+    """End the capture of a request that failed before after_request, so its thread is no longer sampled"""
+    end_profile()
+
+@app.before_request
+def start_background_refresh():
+    """Start the background refresher with the first request served by this process"""
+    if app.config['BACKGROUND_REFRESH']:
+        refresher.start()
+
+def refresh_ticker_data(ticker, force=False):
+    """Make sure fresh ticker data is on its way and report whether a refresh is pending
+
+    After a failed refresh only force requests another one, the background refresher keeps retrying on
+    its own schedule, so pages waiting for the data stop reloading.
+    """
+    if not app.config['BACKGROUND_REFRESH']:
+        ticker.update_data(force=force)
+        return False
+    if not force and refresher.refresh_failed(ticker.tickerId):
+        return False
+    if force or ticker.needs_refresh():
+        refresher.request_refresh(ticker)
+    return refresher.is_refreshing(ticker.tickerId)
+
+def user_fx_rates(user):
+    """Get the exchange rates into the user's base currency, requesting the tracked FX tickers that have no data yet"""
+    fx_rates = program_data.get_fx_rates(user)
+    for ticker in fx_rates.tickers.values():
+        if ticker.last_updated is None:
+            refresh_ticker_data(ticker)
+    return fx_rates
+
+def chart_window():
+    """Get the number of trading days to chart from the request, 90 by default"""
+    return max(1, min(request.args.get('days', 90, type=int), Ticker.history_days))
 
 # Routes
 @app.route('/')
@@ -44,7 +152,10 @@ def load_session(session_id):
     global program_data
     loaded_data = program_data.load_saved_data(session_id)
     if loaded_data:
-        program_data = loaded_data
+        # Let writers on the old session finish before its journal is closed, readers keep their snapshot
+        with write_lock:
+            program_data.close_journal()
+            program_data = loaded_data
         flash(f'Session {session_id} loaded successfully', 'success')
     else:
         flash(f'Failed to load session {session_id}', 'danger')
@@ -53,7 +164,7 @@ def load_session(session_id):
 @app.route('/save_session', methods=['POST'])
 def save_session():
     """Save the current session"""
-    session_id = request.form.get('session_id')
+    session_id = request.form.get('session_id') or None
     saved_id = program_data.save_program_data(session_id)
     flash(f'Session saved with ID: {saved_id}', 'success')
     return redirect(url_for('index'))
@@ -86,70 +197,47 @@ def add_user():
 @app.route('/user/<user_id>')
 def user_profile(user_id):
     """Show user profile and investments"""
-    user = None
-    for u in program_data.users:
-        if u.id == user_id:
-            user = u
-            break
+    user = program_data.get_user_by_id(user_id)
 
     if not user:
         flash('User not found', 'danger')
         return redirect(url_for('users'))
 
-    # Get investment summaries without forcing updates
-    investments = user.get_investments_summary()
-
-    # Get sold investment summaries
-    sold_investments = user.get_sold_investments_summary() if hasattr(user, 'sold_investments') else []
-
-    # Calculate portfolio metrics for active investments
-    total_value = user.get_total_value()
-    total_initial = user.get_total_initial_investment()
-    overall_performance = user.get_overall_performance()
-
-    # Calculate metrics for sold investments
-    total_sold_value = 0
-    total_sold_initial = 0
-    total_sold_profit = 0
-
-    if sold_investments:
-        for inv in sold_investments:
-            if inv['selling_price'] is not None and inv['number_of_shares'] is not None:
-                total_sold_value += inv['selling_price'] * inv['number_of_shares']
-            if inv['initial_investment'] is not None:
-                total_sold_initial += inv['initial_investment']
-            if inv['profit'] is not None:
-                total_sold_profit += inv['profit']
-
-    # Calculate overall performance for sold investments
-    sold_performance = 0
-    if total_sold_initial > 0:
-        sold_performance = (total_sold_profit / total_sold_initial) * 100
+    # Get investment summaries and portfolio totals in the base currency, cached until the portfolio,
+    # its prices or the exchange rates change
+    fx_rates = user_fx_rates(user)
+    summary = user.get_profile_summary(fx_rates)
 
-    # Get total dividends with backward compatibility
-    total_dividends = user.total_dividends if hasattr(user, 'total_dividends') else 0
+    # Portfolio value over time across held and sold positions
+    def build_portfolio_chart():
+        portfolio_history = user.get_portfolio_history(fx_rates=fx_rates)
+        if portfolio_history.empty:
+            return None
+        return charts.to_json(charts.portfolio_chart(portfolio_history, app.config['CHART_POINT_BUDGET']))
+    portfolio_chart_json = chart_cache.get_or_build(('portfolio', user.id, user.get_summary_version(fx_rates)),
+                                                    build_portfolio_chart)
 
     return render_template('user_profile.html', 
                           user=user, 
-                          investments=investments,
-                          sold_investments=sold_investments,
-                          total_value=total_value,
-                          total_initial=total_initial,
-                          overall_performance=overall_performance,
-                          total_sold_value=total_sold_value,
-                          total_sold_initial=total_sold_initial,
-                          total_sold_profit=total_sold_profit,
-                          sold_performance=sold_performance,
-                          total_dividends=total_dividends)
+                          investments=summary['investments'],
+                          sold_investments=summary['sold_investments'],
+                          total_value=summary['total_value'],
+                          total_initial=summary['total_initial'],
+                          overall_performance=summary['overall_performance'],
+                          total_sold_value=summary['total_sold_value'],
+                          total_sold_initial=summary['total_sold_initial'],
+                          total_sold_profit=summary['total_sold_profit'],
+                          sold_performance=summary['sold_performance'],
+                          total_dividends=summary['total_dividends'],
+                          base_currency=summary['base_currency'],
+                          unconverted_currencies=summary['unconverted_currencies'],
+                          currencies=CURRENCIES,
+                          portfolio_chart_json=portfolio_chart_json)
 
 @app.route('/add_investment/<user_id>', methods=['GET', 'POST'])
 def add_investment(user_id):
     """Add a new investment for a user"""
-    user = None
-    for u in program_data.users:
-        if u.id == user_id:
-            user = u
-            break
+    user = program_data.get_user_by_id(user_id)
 
     if not user:
         flash('User not found', 'danger')
@@ -171,14 +259,7 @@ def add_investment(user_id):
                 flash('Invalid date format. Using current date.', 'warning')
 
         # Check if ticker exists or create a new one
-        ticker = None
-        for t in program_data.trackedTickers:
-            if t.tickerId == ticker_id:
-                ticker = t
-                break
-
-        if not ticker:
-            ticker = program_data.add_ticker(ticker_id)
+        ticker = program_data.add_ticker(ticker_id)
 
         # Get current price for the ticker
         current_price = ticker.get_current_price()
@@ -234,6 +315,7 @@ def add_investment(user_id):
                 tags
             )
 
+        program_data.track_fx_tickers(user)
         flash(f'Investment in {ticker_id} added successfully', 'success')
         return redirect(url_for('user_profile', user_id=user.id))
 
@@ -242,11 +324,7 @@ def add_investment(user_id):
 @app.route('/investment/<user_id>/<investment_id>')
 def investment_details(user_id, investment_id):
     """Show investment details"""
-    user = None
-    for u in program_data.users:
-        if u.id == user_id:
-            user = u
-            break
+    user = program_data.get_user_by_id(user_id)
 
     if not user:
         flash('User not found', 'danger')
@@ -257,34 +335,35 @@ def investment_details(user_id, investment_id):
         flash('Investment not found', 'danger')
         return redirect(url_for('user_profile', user_id=user.id))
 
-    # Update investment data
-    investment.update_data()
-
-    # Get performance history
-    performance_history = investment.get_performance_history(days=90)
-
-    # Create chart data
-    if not performance_history.empty:
-        fig = px.line(performance_history, 
-                     title=f'Investment Value History - {investment.ticker.name}',
-                     labels={'value': 'Value', 'index': 'Date'})
-        chart_json = json.dumps(fig.to_dict(), cls=NumpyEncoder)
-    else:
-        chart_json = None
+    # Serve the cached data immediately and let the background refresher fetch new prices
+    refreshing = refresh_ticker_data(investment.ticker) if investment.ticker else False
+
+    # Chart the performance history, rebuilt only when the window, the investment or its prices change
+    days = chart_window()
+    def build_chart():
+        performance_history = investment.get_performance_history(days=days)
+        if performance_history.empty:
+            return None
+        return charts.to_json(charts.line_chart(performance_history.to_frame('Value'),
+                                                f'Investment Value History - {investment.ticker.name}',
+                                                'Value', app.config['CHART_POINT_BUDGET']))
+    chart_key = ('investment', user.id, investment.id, days, user.version,
+                 investment.ticker.data_version if investment.ticker else None)
+    chart_json = chart_cache.get_or_build(chart_key, build_chart)
 
     return render_template('investment_details.html', 
                           user=user, 
                           investment=investment.to_dict(),
-                          chart_json=chart_json)
+                          chart_json=chart_json,
+                          days=days,
+                          as_of=investment.ticker.last_updated if investment.ticker else None,
+                          stale=investment.ticker.is_stale if investment.ticker else False,
+                          refreshing=refreshing)
 
 @app.route('/remove_investment/<user_id>/<investment_id>')
 def remove_investment(user_id, investment_id):
     """Remove an investment"""
-    user = None
-    for u in program_data.users:
-        if u.id == user_id:
-            user = u
-            break
+    user = program_data.get_user_by_id(user_id)
 
     if not user:
         flash('User not found', 'danger')
@@ -300,11 +379,7 @@ def remove_investment(user_id, investment_id):
 @app.route('/remove_sold_investment/<user_id>/<investment_id>')
 def remove_sold_investment(user_id, investment_id):
     """Remove a sold investment"""
-    user = None
-    for u in program_data.users:
-        if u.id == user_id:
-            user = u
-            break
+    user = program_data.get_user_by_id(user_id)
 
     if not user:
         flash('User not found', 'danger')
@@ -320,30 +395,26 @@ def remove_sold_investment(user_id, investment_id):
 @app.route('/refresh_investments/<user_id>')
 def refresh_investments(user_id):
     """Force refresh of all investment data"""
-    user = None
-    for u in program_data.users:
-        if u.id == user_id:
-            user = u
-            break
+    user = program_data.get_user_by_id(user_id)
 
     if not user:
         flash('User not found', 'danger')
         return redirect(url_for('users'))
 
-    # Force update all investments
-    user.update_all_investments(force=True)
-    flash('Investment data refreshed successfully', 'success')
+    # Force update all investments, fetching each distinct ticker once
+    results = program_data.refresh_tickers(users=[user], force=True)
+    failed = [ticker_id for ticker_id, success in results.items() if not success]
+    if failed:
+        flash(f'Refreshed {len(results) - len(failed)} of {len(results)} tickers. Failed: {", ".join(sorted(failed))}', 'warning')
+    else:
+        flash('Investment data refreshed successfully', 'success')
 
     return redirect(url_for('user_profile', user_id=user.id))
 
 @app.route('/update_tags/<user_id>/<investment_id>', methods=['POST'])
 def update_tags(user_id, investment_id):
     """Update tags for an investment"""
-    user = None
-    for u in program_data.users:
-        if u.id == user_id:
-            user = u
-            break
+    user = program_data.get_user_by_id(user_id)
 
     if not user:
         flash('User not found', 'danger')
@@ -359,8 +430,7 @@ def update_tags(user_id, investment_id):
     tags = [tag.strip() for tag in tags_str.split(',')] if tags_str.strip() else []
 
     # Update investment tags
-    investment.tags = tags
-    user.last_updated = datetime.datetime.now()
+    user.update_investment_tags(investment.id, tags)
 
     flash('Tags updated successfully', 'success')
     return redirect(url_for('investment_details', user_id=user.id, investment_id=investment.id))
@@ -368,11 +438,7 @@ def update_tags(user_id, investment_id):
 @app.route('/add_total_dividend/<user_id>', methods=['POST'])
 def add_total_dividend(user_id):
     """Add a dividend to the total, not tied to any specific investment"""
-    user = None
-    for u in program_data.users:
-        if u.id == user_id:
-            user = u
-            break
+    user = program_data.get_user_by_id(user_id)
 
     if not user:
         flash('User not found', 'danger')
@@ -407,14 +473,60 @@ def add_total_dividend(user_id):
 
     return redirect(url_for('user_profile', user_id=user.id))
 
+@app.route('/set_base_currency/<user_id>', methods=['POST'])
+def set_base_currency(user_id):
+    """Set the currency the portfolio totals are shown in"""
+    user = program_data.get_user_by_id(user_id)
+
+    if not user:
+        flash('User not found', 'danger')
+        return redirect(url_for('users'))
+
+    currency = request.form.get('base_currency')
+    if currency not in CURRENCIES:
+        flash('Invalid currency', 'danger')
+    elif currency != user.base_currency:
+        user.set_base_currency(currency)
+        program_data.track_fx_tickers(user)
+        flash(f'Portfolio totals are now shown in {currency}', 'success')
+    return redirect(url_for('user_profile', user_id=user.id))
+
+@app.route('/import_transactions/<user_id>', methods=['GET', 'POST'])
+def import_transactions(user_id):
+    """Import buys, sells and dividends from a broker's CSV export"""
+    user = program_data.get_user_by_id(user_id)
+
+    if not user:
+        flash('User not found', 'danger')
+        return redirect(url_for('users'))
+
+    if request.method == 'POST':
+        upload = request.files.get('transactions_file')
+        if not upload or not upload.filename:
+            flash('Please choose a CSV file to import', 'danger')
+            return render_template('import_transactions.html', user=user, result=None)
+
+        try:
+            with io.TextIOWrapper(upload.stream, encoding='utf-8-sig', newline='') as file:
+                result = importer.import_transactions(program_data, user, file)
+        except (ValueError, UnicodeDecodeError) as e:
+            flash(f'Could not import {upload.filename}: {e}', 'danger')
+            return render_template('import_transactions.html', user=user, result=None)
+        program_data.track_fx_tickers(user)
+
+        if not result.errors:
+            flash(result.summary(), 'success')
+            return redirect(url_for('user_profile', user_id=user.id))
+        # Show the rows that were skipped, the others are already imported
+        flash(result.summary(), 'warning')
+        return render_template('import_transactions.html', user=user, result=result)
+
+    return render_template('import_transactions.html', user=user, result=None)
+
 @app.route('/sell_investment/<user_id>/<investment_id>', methods=['POST'])
 def sell_investment(user_id, investment_id):
     """Sell an investment"""
-    user = None
-    for u in program_data.users:
-        if u.id == user_id:
-            user = u
-            break
+    user = program_data.get_user_by_id(user_id)
 
     if not user:
         flash('User not found', 'danger')
@@ -462,34 +574,277 @@ def tickers():
 @app.route('/ticker/<ticker_id>')
 def ticker_details(ticker_id):
     """Show ticker details"""
-    ticker = None
-    for t in program_data.trackedTickers:
-        if t.tickerId == ticker_id:
-            ticker = t
-            break
+    ticker = program_data.get_ticker(ticker_id)
 
     if not ticker:
         flash('Ticker not found', 'danger')
         return redirect(url_for('tickers'))
 
-    # Update ticker data
-    ticker.update_data()
+    # Serve the cached data immediately and let the background refresher fetch new prices
+    refreshing = refresh_ticker_data(ticker, force=request.args.get('refresh') == '1')
 
-    # Get price history
-    price_history = ticker.get_price_history(days=90)
-
-    # Create chart data
-    if not price_history.empty:
-        fig = px.line(price_history, 
-                     title=f'Price History - {ticker.name}',
-                     labels={'value': 'Price', 'index': 'Date'})
-        chart_json = json.dumps(fig.to_dict(), cls=NumpyEncoder)
-    else:
-        chart_json = None
+    # Chart the price history, rebuilt only when the window or the price data change
+    days = chart_window()
+    def build_chart():
+        price_history = ticker.get_price_history(days=days)
+        if price_history.empty:
+            return None
+        return charts.to_json(charts.line_chart(price_history.to_frame('Close'), f'Price History - {ticker.name}',
+                                                'Price', app.config['CHART_POINT_BUDGET']))
+    chart_json = chart_cache.get_or_build(('ticker', ticker.tickerId, days, ticker.data_version), build_chart)
 
     return render_template('ticker_details.html', 
                           ticker=ticker,
-                          chart_json=chart_json)
+                          chart_json=chart_json,
+                          days=days,
+                          as_of=ticker.last_updated,
+                          stale=ticker.is_stale,
+                          refreshing=refreshing)
+
+# JSON API
+API_PAGE_SIZE = 50
+API_MAX_PAGE_SIZE = 500
+# Investment fields the investments endpoint can sort by, mapped to their holdings table column
+API_SORT_COLUMNS = {'current_value': 'value', 'initial_investment': 'cost', 'number_of_shares': 'shares',
+                    'purchase_price': 'purchase_price', 'start_date': 'start', 'end_date': 'end', 'profit': 'profit'}
+
+def api_timestamp(value):
+    """Format a datetime for the JSON API"""
+    return value.isoformat() if value is not None else None
+
+def api_error(message, status):
+    return jsonify({'error': message}), status
+
+def api_response(get_version, build):
+    """Return build() as JSON with an ETag derived from get_version()
+
+    A request whose If-None-Match matches the current ETag gets a 304 without calling build().
+    The version is taken once before building and get_version loads the price data it depends on, so
+    the ETag never claims data newer than the body. The ETag includes the session, user and ticker
+    versions alone do not tell loaded sessions apart.
+    """
+    key = repr((program_data.session_id, request.path, sorted(request.args.items(multi=True)), get_version()))
+    tag = hashlib.sha1(key.encode()).hexdigest()
+    not_modified = request.if_none_match.contains(tag)
+    metrics.record_cache('api_etag', not_modified)
+    if not_modified:
+        response = app.response_class(status=304)
+    else:
+        response = jsonify(build())
+    response.set_etag(tag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def paginate(items):
+    """Slice a list according to the page and per_page query arguments"""
+    per_page = max(1, min(request.args.get('per_page', API_PAGE_SIZE, type=int), API_MAX_PAGE_SIZE))
+    total = len(items)
+    pages = max(1, -(-total // per_page))
+    page = max(1, min(request.args.get('page', 1, type=int), pages))
+    start = (page - 1) * per_page
+    return {'items': items[start:start + per_page], 'page': page, 'per_page': per_page, 'total': total,
+            'pages': pages}
+
+def api_number(value):
+    """Convert a number to a float for JSON, None for missing values and NaN, which JSON cannot represent"""
+    if value is None:
+        return None
+    value = float(value)
+    return None if math.isnan(value) else value
+
+def ticker_version(ticker):
+    """Version of a ticker's data for ETags, loading its price frames first so a lazy load does not change it"""
+    frames = ticker.get_frames()
+    return ticker.tickerId, ticker.data_version, frames.last_updated, ticker.is_stale
+
+def ticker_to_dict(ticker):
+    quote = ticker.get_last_quote()
+    return {'id': ticker.tickerId,
+            'name': ticker.name,
+            'sector': ticker.sector,
+            'currency': ticker.currency,
+            'current_price': api_number(quote['price']),
+            'as_of': api_timestamp(quote['as_of']),
+            'last_updated': api_timestamp(ticker.last_updated),
+            'stale': ticker.is_stale}
+
+def history_to_list(history):
+    """Convert a price or value series to [date, value] pairs"""
+    return [[date.isoformat(), api_number(value)] for date, value in history.items()]
+
+@app.route('/api/users/<user_id>')
+def api_user_profile(user_id):
+    """Portfolio totals of a user"""
+    user = program_data.get_user_by_id(user_id)
+    if not user:
+        return api_error('User not found', 404)
+
+    fx_rates = user_fx_rates(user)
+
+    def build():
+        summary = user.get_profile_summary(fx_rates)
+        return {'id': user.id,
+                'name': user.name,
+                'last_updated': api_timestamp(user.last_updated),
+                'base_currency': summary['base_currency'],
+                'unconverted_currencies': summary['unconverted_currencies'],
+                'investment_count': len(summary['investments']),
+                'sold_investment_count': len(summary['sold_investments']),
+                'total_value': api_number(summary['total_value']),
+                'total_initial': api_number(summary['total_initial']),
+                'overall_performance': api_number(summary['overall_performance']),
+                'total_sold_value': api_number(summary['total_sold_value']),
+                'total_sold_initial': api_number(summary['total_sold_initial']),
+                'total_sold_profit': api_number(summary['total_sold_profit']),
+                'sold_performance': api_number(summary['sold_performance']),
+                'total_dividends': api_number(summary['total_dividends'])}
+    return api_response(lambda: (user.get_summary_version(fx_rates), user.last_updated), build)
+
+@app.route('/api/users/<user_id>/investments')
+def api_investments(user_id):
+    """Paginated investment summaries of a user, or the sold ones with ?sold=1
+
+    ?ticker= limits them to one ticker, ?sort= orders them by one of API_SORT_COLUMNS (?order=desc to reverse).
+    """
+    user = program_data.get_user_by_id(user_id)
+    if not user:
+        return api_error('User not found', 404)
+    sold = request.args.get('sold') == '1'
+    ticker_id = request.args.get('ticker')
+    sort = request.args.get('sort')
+    if sort is not None and sort not in API_SORT_COLUMNS:
+        return api_error(f"Cannot sort by {sort}, use one of {', '.join(API_SORT_COLUMNS)}", 400)
+
+    fx_rates = user_fx_rates(user)
+
+    def build():
+        summary = user.get_profile_summary(fx_rates)
+        items = summary['sold_investments'] if sold else summary['investments']
+        if ticker_id is not None or sort is not None:
+            # Sort and filter on the holdings table, then pick the matching summaries
+            by_id = {item['id']: item for item in items}
+            investments = user.get_holdings().query(sold, ticker_id, API_SORT_COLUMNS.get(sort),
+                                                    request.args.get('order') == 'desc')
+            items = [by_id[investment.id] for investment in investments if investment.id in by_id]
+        return paginate(items)
+    return api_response(lambda: user.get_summary_version(fx_rates), build)
+
+@app.route('/api/users/<user_id>/investments/<investment_id>')
+def api_investment_details(user_id, investment_id):
+    """Details and value history of an active or sold investment"""
+    user = program_data.get_user_by_id(user_id)
+    if not user:
+        return api_error('User not found', 404)
+    investment = user.get_investment(investment_id, include_sold=True)
+    if not investment:
+        return api_error('Investment not found', 404)
+
+    if investment.ticker:
+        refresh_ticker_data(investment.ticker)
+
+    def build():
+        result = investment.to_dict()
+        result['history'] = history_to_list(investment.get_performance_history(days=chart_window()))
+        return result
+    return api_response(lambda: (user.version, ticker_version(investment.ticker) if investment.ticker else None),
+                        build)
+
+@app.route('/api/tickers')
+def api_tickers():
+    """All tracked tickers with their latest price"""
+    def build():
+        return {'items': [ticker_to_dict(ticker) for ticker in program_data.trackedTickers]}
+    return api_response(lambda: [ticker_version(ticker) for ticker in program_data.trackedTickers], build)
+
+@app.route('/api/tickers/<ticker_id>')
+def api_ticker_details(ticker_id):
+    """Details and closing price history of a ticker"""
+    ticker = program_data.get_ticker(ticker_id)
+    if not ticker:
+        return api_error('Ticker not found', 404)
+
+    refresh_ticker_data(ticker)
+
+    def build():
+        result = ticker_to_dict(ticker)
+        result['history'] = history_to_list(ticker.get_price_history(days=chart_window()))
+        return result
+    return api_response(lambda: ticker_version(ticker), build)
+
+# Warm-up
+
+warm_up_status = {'ready': True, 'phase': 'disabled', 'session_id': None, 'tickers': 0, 'seconds': None}
+
+def warm_up():
+    """Restore the most recently changed session and load the price data of its tickers
+
+    The session is only installed if no session was loaded and nothing was added in the meantime.
+    """
+    global program_data
+    start = time.perf_counter()
+    try:
+        initial = program_data
+        session_id = initial.get_latest_session()
+        if session_id is not None:
+            warm_up_status.update(phase='session', session_id=session_id)
+            loaded_data = initial.load_saved_data(session_id)
+            if loaded_data is not None:
+                with write_lock:
+                    if program_data is initial and not initial.users and not initial.trackedTickers:
+                        initial.close_journal()
+                        program_data = loaded_data
+                    else:
+                        loaded_data.close_journal()
+
+        # Load the price frames from the ticker store and build the summaries the first pages need
+        warm_up_status['phase'] = 'tickers'
+        fx_rates = [(user, program_data.get_fx_rates(user)) for user in program_data.users]
+        tickers = program_data.collect_tickers()
+        with ThreadPoolExecutor(max_workers=program_data.refresh_workers) as executor:
+            list(executor.map(lambda ticker: ticker.get_last_quote(), tickers))
+        for user, rates in fx_rates:
+            user.get_profile_summary(rates)
+        warm_up_status['tickers'] = len(tickers)
+    except Exception as e:
+        print(f"Error during warm-up: {e}")
+    finally:
+        warm_up_status.update(ready=True, phase='done', seconds=round(time.perf_counter() - start, 3))
+
+def start_warm_up():
+    warm_up_status.update(ready=False, phase='starting')
+    threading.Thread(target=warm_up, name='warm-up', daemon=True).start()
+
+@app.route('/ready')
+def ready():
+    """Readiness check, 503 until the warm-up has finished"""
+    return jsonify(warm_up_status), 200 if warm_up_status['ready'] else 503
+
+# Metrics
+
+def ticker_data_ages():
+    """Age of the price data of every tracked ticker whose data is loaded, without loading the others"""
+    now = datetime.datetime.now()
+    ages = {}
+    for ticker in program_data.collect_tickers():
+        frames = ticker.__dict__.get('_frames')
+        if frames is not None and frames.last_updated is not None:
+            ages[(ticker.tickerId,)] = (now - frames.last_updated).total_seconds()
+    return ages
+
+def circuit_states():
+    market_data = get_market_data()
+    return {(market_data.provider.name,): int(market_data.breaker.state == CircuitBreaker.OPEN)}
+
+metrics.ticker_data_age.set_function(ticker_data_ages)
+metrics.market_data_circuit_open.set_function(circuit_states)
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Metrics in the Prometheus text format"""
+    return app.response_class(metrics.REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+if app.config['WARM_UP']:
+    start_warm_up()
 
 if __name__ == '__main__':
     # Create templates directory if it doesn't exist
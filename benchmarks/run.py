@@ -0,0 +1,198 @@
+"""Time the hot operations on synthetic program data and compare them against a stored baseline
+
+Usage (from the repository root):
+    python benchmarks/run.py                    # compare against benchmarks/baseline.json
+    python benchmarks/run.py --save-baseline    # record a new baseline
+    python benchmarks/run.py --users 50 --investments 40 --tickers 200 --years 5
+
+Everything runs in a temporary directory with market data replayed from the synthetic price history,
+so no session or ticker data of the application is touched and no network access is needed.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import charts  # noqa: E402
+from classes import MainProgramData, refresh_tickers_concurrently  # noqa: E402
+from market_data import MarketDataGateway, ReplayProvider, set_market_data  # noqa: E402
+from benchmarks.synthetic import make_program_data, write_recordings  # noqa: E402
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+POINT_BUDGET = 500  # Same as CHART_POINT_BUDGET in app.py
+SESSION_ID = 'benchmark'
+RECORDINGS_DIR = 'recordings'
+
+
+def measure(func, repeat, setup=None):
+    """Run func repeat times after one warm-up run and return its timings in milliseconds"""
+    timings = []
+    for run in range(repeat + 1):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        elapsed = (time.perf_counter() - start) * 1000
+        if run > 0:
+            timings.append(elapsed)
+    return {'median_ms': round(statistics.median(timings), 4), 'min_ms': round(min(timings), 4)}
+
+
+def build_benchmarks(data, seed=0):
+    """Map benchmark names to (func, setup) pairs over the given program data"""
+    rng = np.random.default_rng(seed)
+    tickers = data.trackedTickers
+    users = data.users
+    investments = [investment for user in users for investment in user.investments + user.sold_investments]
+
+    # Random lookups spread over the whole history, including dates covered by intraday bars
+    lookups = []
+    for _ in range(200):
+        ticker = tickers[rng.integers(len(tickers))]
+        index = ticker.closingPrices.index
+        date = index[rng.integers(len(index))].to_pydatetime().replace(tzinfo=None)
+        lookups.append((ticker, date + datetime.timedelta(hours=int(rng.integers(10, 16)))))
+    dates = [date for _, date in lookups] * 5
+    histories = {user.id: user.get_portfolio_history() for user in users}
+
+    def clear_quotes():
+        for ticker in tickers:
+            ticker._last_quote = None
+
+    def clear_summaries():
+        for user in users:
+            user._summary_cache = None
+
+    def save():
+        data.save_program_data(SESSION_ID)
+
+    def load():
+        loaded = MainProgramData().load_saved_data(SESSION_ID)
+        loaded.close_journal()
+
+    def load_and_summarize():
+        loaded = MainProgramData().load_saved_data(SESSION_ID)
+        for user in loaded.users:
+            user.get_profile_summary()
+        loaded.close_journal()
+
+    return {
+        'ticker.get_current_price': (lambda: [ticker.get_current_price() for ticker in tickers], None),
+        'ticker.get_current_price (cold)': (lambda: [ticker.get_current_price() for ticker in tickers], clear_quotes),
+        'ticker.get_price_at_date x200': (lambda: [ticker.get_price_at_date(date) for ticker, date in lookups], None),
+        'ticker.get_prices_at_dates x1000': (lambda: [ticker.get_prices_at_dates(dates) for ticker in tickers], None),
+        'investment.to_dict': (lambda: [investment.to_dict() for investment in investments], None),
+        'user.get_profile_summary': (lambda: [user.get_profile_summary() for user in users], None),
+        'user.get_profile_summary (cold)': (lambda: [user.get_profile_summary() for user in users], clear_summaries),
+        'user.get_portfolio_history': (lambda: [user.get_portfolio_history() for user in users], None),
+        'charts.portfolio_chart': (lambda: [charts.to_json(charts.portfolio_chart(histories[user.id], POINT_BUDGET))
+                                            for user in users], None),
+        'charts.ticker_chart': (lambda: [charts.to_json(charts.line_chart(ticker.closingPrices[['Close']], ticker.name,
+                                                                          'Price', POINT_BUDGET))
+                                         for ticker in tickers], None),
+        'refresh_tickers_concurrently (replay)': (lambda: refresh_tickers_concurrently(tickers, force=True), None),
+        'session.save_program_data': (save, None),
+        'session.load_saved_data': (load, save),
+        'session.load_saved_data + summaries': (load_and_summarize, save),
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Print the results next to the baseline and return the names of the regressed benchmarks
+
+    The fastest run is compared, it is far less sensitive to noise from other processes than the median.
+    """
+    regressions = []
+    print(f"{'benchmark':<40} {'median ms':>12} {'min ms':>12} {'baseline ms':>12} {'change':>9}")
+    for name, result in results.items():
+        reference = baseline.get(name) if baseline else None
+        if reference is None:
+            print(f"{name:<40} {result['median_ms']:>12.3f} {result['min_ms']:>12.3f} {'-':>12} {'-':>9}")
+            continue
+        ratio = result['min_ms'] / reference['min_ms'] if reference['min_ms'] else 1.0
+        flag = ''
+        if ratio > 1 + tolerance:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        elif ratio < 1 - tolerance:
+            flag = '  faster'
+        print(f"{name:<40} {result['median_ms']:>12.3f} {result['min_ms']:>12.3f} {reference['min_ms']:>12.3f} "
+              f"{ratio - 1:>+8.0%}{flag}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--investments', type=int, default=20, help='investments per user')
+    parser.add_argument('--tickers', type=int, default=50)
+    parser.add_argument('--years', type=int, default=2, help='years of daily bars per ticker')
+    parser.add_argument('--intraday-days', type=int, default=7, help='days of hourly bars per ticker')
+    parser.add_argument('--replay-latency', type=float, default=0.02,
+                        help='seconds each replayed market data call takes')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=10, help='timed runs per benchmark')
+    parser.add_argument('--filter', default=None, help='only run benchmarks whose name contains this text')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true', help='store the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='relative slowdown of the fastest run that counts as a regression')
+    args = parser.parse_args(argv)
+
+    scale = {'users': args.users, 'investments': args.investments, 'tickers': args.tickers,
+             'years': args.years, 'intraday_days': args.intraday_days, 'replay_latency': args.replay_latency,
+             'seed': args.seed}
+    with tempfile.TemporaryDirectory(prefix='investment_tracker_bench_') as workdir:
+        cwd = os.getcwd()
+        os.chdir(workdir)
+        try:
+            start = time.perf_counter()
+            data = make_program_data(users=args.users, investments=args.investments, tickers=args.tickers,
+                                     years=args.years, intraday_days=args.intraday_days, seed=args.seed,
+                                     persist=True)
+            print(f"Generated {scale} in {time.perf_counter() - start:.1f}s")
+            # Refreshes are answered from the generated history, timed like a remote call without the variance
+            write_recordings(RECORDINGS_DIR, data.trackedTickers)
+            set_market_data(MarketDataGateway(ReplayProvider(RECORDINGS_DIR, latency=args.replay_latency), rate=None))
+            results = {}
+            for name, (func, setup) in build_benchmarks(data, args.seed).items():
+                if args.filter and args.filter not in name:
+                    continue
+                results[name] = measure(func, args.repeat, setup)
+        finally:
+            os.chdir(cwd)
+
+    baseline = None
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            stored = json.load(f)
+        if stored.get('scale') == scale:
+            baseline = stored['results']
+        else:
+            print(f"Baseline in {args.baseline} was recorded at scale {stored.get('scale')}, not comparing")
+
+    regressions = compare(results, baseline, args.tolerance)
+    if args.save_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump({'scale': scale, 'python': platform.python_version(), 'machine': platform.machine(),
+                       'results': results}, f, indent=2)
+            f.write('\n')
+        print(f"Saved baseline to {args.baseline}")
+    if regressions:
+        print(f"{len(regressions)} benchmark(s) slower than the baseline by more than {args.tolerance:.0%}")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,102 @@
+import datetime
+
+import numpy as np
+import pandas as pd
+
+from classes import MainProgramData, Ticker
+from market_data import Recordings
+
+TIMEZONE = 'America/New_York'
+BARS_PER_DAY = 7  # Hourly bars from 9:30 to 15:30
+PRICE_COLUMNS = ['Open', 'High', 'Low', 'Close', 'Volume', 'Dividends', 'Stock Splits']
+
+
+def make_daily_prices(rng, years=2, start_price=100.0, end=None):
+    """Daily bars on business days over the given number of years, shaped like yfinance's history()"""
+    end = pd.Timestamp(end or datetime.date.today())
+    days = pd.bdate_range(end - pd.DateOffset(years=years), end, tz=TIMEZONE, name='Date')
+    closes = start_price * np.exp(np.cumsum(rng.normal(0.0003, 0.015, len(days))))
+    return _bars(rng, days, closes)
+
+
+def make_intraday_prices(rng, last_close, days=7, end=None):
+    """Hourly bars during trading hours for the last days, starting around last_close"""
+    end = pd.Timestamp(end or datetime.date.today())
+    trading_days = pd.bdate_range(end - pd.Timedelta(days=days), end)
+    offsets = pd.to_timedelta(np.arange(BARS_PER_DAY) + 9.5, unit='h')
+    times = pd.DatetimeIndex([day + offset for day in trading_days for offset in offsets], name='Datetime')
+    times = times.tz_localize(TIMEZONE)
+    closes = last_close * np.exp(np.cumsum(rng.normal(0, 0.003, len(times))))
+    return _bars(rng, times, closes)
+
+
+def _bars(rng, index, closes):
+    opens = np.concatenate(([closes[0]], closes[:-1]))
+    spread = np.abs(rng.normal(0, 0.005, len(closes)))
+    return pd.DataFrame({
+        'Open': opens,
+        'High': np.maximum(opens, closes) * (1 + spread),
+        'Low': np.minimum(opens, closes) * (1 - spread),
+        'Close': closes,
+        'Volume': rng.integers(10_000, 1_000_000, len(closes)),
+        'Dividends': 0.0,
+        'Stock Splits': 0.0,
+    }, index=index, columns=PRICE_COLUMNS)
+
+
+def make_tickers(count, years=2, intraday_days=7, seed=0, data_dir="ticker_data"):
+    """Tickers with synthetic price history that never need a refresh"""
+    rng = np.random.default_rng(seed)
+    tickers = []
+    for number in range(count):
+        closing_prices = make_daily_prices(rng, years, start_price=rng.uniform(10, 500))
+        intraday_prices = make_intraday_prices(rng, closing_prices['Close'].iloc[-1], intraday_days)
+        ticker = Ticker.from_frames(f"SYN{number:04d}", closing_prices, intraday_prices,
+                                    name=f"Synthetic {number}", currency='EUR' if number % 3 else 'USD',
+                                    sector='Synthetic', data_dir=data_dir)
+        ticker.update_interval = datetime.timedelta(days=3650)
+        tickers.append(ticker)
+    return tickers
+
+
+def write_recordings(directory, tickers):
+    """Store the frames of the tickers as captured responses for a ReplayProvider"""
+    recordings = Recordings(directory)
+    for ticker in tickers:
+        recordings.save_info(ticker.tickerId, {'shortName': ticker.name, 'currency': ticker.currency,
+                                               'sector': ticker.sector})
+        recordings.save_history(ticker.tickerId, '1d', ticker.closingPrices)
+        recordings.save_history(ticker.tickerId, '1h', ticker.intradayPrices)
+
+
+def make_program_data(users=10, investments=20, tickers=50, years=2, intraday_days=7, sold_fraction=0.2,
+                      seed=0, persist=False):
+    """Build program data at the given scale without any network access
+
+    Every user gets investments bought on random days over the generated history, a sold_fraction of
+    them sold later. With persist the tickers are written to the ticker store, like tracked tickers
+    in a real session.
+    """
+    rng = np.random.default_rng(seed)
+    data = MainProgramData()
+    data.trackedTickers = make_tickers(tickers, years, intraday_days, seed)
+    data._rebuild_indexes()
+    if persist:
+        for ticker in data.trackedTickers:
+            ticker.save_data_locally()
+
+    for user_number in range(users):
+        user = data.add_user(f"User {user_number}")
+        for _ in range(investments):
+            ticker = data.trackedTickers[rng.integers(len(data.trackedTickers))]
+            closes = ticker.closingPrices['Close']
+            bought = int(rng.integers(len(closes) - 1))
+            investment = user.add_investment(ticker, initial_investment=float(rng.integers(100, 10_000)),
+                                             currency=ticker.currency, purchase_price=float(closes.iloc[bought]),
+                                             purchase_date=closes.index[bought].to_pydatetime().replace(tzinfo=None),
+                                             tags=[f"tag{rng.integers(5)}"])
+            if rng.random() < sold_fraction:
+                sold = int(rng.integers(bought + 1, len(closes)))
+                user.sell_investment(investment.id, float(closes.iloc[sold]),
+                                     closes.index[sold].to_pydatetime().replace(tzinfo=None))
+    return data
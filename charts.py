@@ -0,0 +1,122 @@
+import json
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+import metrics
+
+
+def lttb(x, y, threshold):
+    """Pick the indices of at most threshold points that preserve the shape of a line (Largest-Triangle-Three-Buckets)"""
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    indices = np.empty(threshold, dtype=np.int64)
+    indices[0] = 0
+    indices[-1] = n - 1
+
+    # The first and last points are always kept, the rest is split into equally sized buckets
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.int64)
+    selected = 0
+    for bucket in range(threshold - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+        next_start, next_end = end, edges[bucket + 2] if bucket + 2 < len(edges) else n
+        # Average point of the next bucket is the third corner of the triangle
+        avg_x = x[next_start:next_end].mean()
+        avg_y = y[next_start:next_end].mean()
+        areas = np.abs((x[selected] - avg_x) * (y[start:end] - y[selected])
+                       - (x[selected] - x[start:end]) * (avg_y - y[selected]))
+        selected = start + int(np.argmax(areas))
+        indices[bucket + 1] = selected
+    return indices
+
+
+def _timestamps_ms(index):
+    """Milliseconds since the epoch of the wall-clock times, so Plotly shows dates in the data's own timezone"""
+    index = pd.DatetimeIndex(index)
+    if index.tz is not None:
+        index = index.tz_localize(None)
+    return index.as_unit('ms').asi8
+
+
+def line_chart(frame, title, y_label, point_budget=None, downsample_column=None, trace_options=None):
+    """Build a Plotly figure dict with one line per column of a DataFrame indexed by date
+
+    Long series are downsampled with LTTB to point_budget points, using downsample_column (the first
+    column by default) to choose the points that are kept for every line. trace_options optionally maps
+    column names to extra trace attributes.
+    """
+    x = _timestamps_ms(frame.index)
+    if point_budget and len(frame) > point_budget:
+        column = downsample_column if downsample_column is not None else frame.columns[0]
+        keep = lttb(x, np.nan_to_num(frame[column].to_numpy(dtype=float)), point_budget)
+        frame = frame.iloc[keep]
+        x = x[keep]
+
+    x_values = x.tolist()
+    data = []
+    for column in frame.columns:
+        # Gaps become null, which Plotly draws as a break in the line
+        y_values = [None if value != value else value
+                    for value in np.round(frame[column].to_numpy(dtype=float), 4).tolist()]
+        trace = {'type': 'scatter', 'mode': 'lines', 'name': str(column), 'x': x_values, 'y': y_values}
+        trace.update((trace_options or {}).get(column, {}))
+        data.append(trace)
+    layout = {'title': title, 'xaxis': {'title': 'Date', 'type': 'date'}, 'yaxis': {'title': y_label},
+              'hovermode': 'x unified'}
+    return {'data': data, 'layout': layout}
+
+
+def portfolio_chart(history, point_budget=None):
+    """Build a chart with the total, realized and unrealized value and the value per ticker"""
+    ticker_columns = list(history.columns[3:])
+    frame = history[['total'] + ticker_columns + ['unrealized', 'realized']].rename(
+        columns={'total': 'Total', 'unrealized': 'Unrealized Gain', 'realized': 'Realized Gain'})
+    options = {'Total': {'line': {'width': 3}},
+               'Unrealized Gain': {'line': {'dash': 'dot'}},
+               'Realized Gain': {'line': {'dash': 'dot'}}}
+    for column in ticker_columns:
+        options[column] = {'stackgroup': 'tickers', 'line': {'width': 0.5}, 'visible': 'legendonly'}
+    return line_chart(frame, 'Portfolio Value History', 'Value', point_budget, downsample_column='Total',
+                      trace_options=options)
+
+
+def to_json(chart):
+    """Serialize a chart compactly, safe to embed in a single-quoted string inside a script tag"""
+    payload = json.dumps(chart, separators=(',', ':'), allow_nan=False)
+    return payload.replace("'", "\\u0027").replace("<", "\\u003c")
+
+
+class ChartCache:
+    """Thread-safe LRU cache of serialized chart payloads
+
+    Keys should include everything the chart depends on, such as the window and data versions,
+    so entries never have to be invalidated explicitly.
+    """
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_build(self, key, build):
+        """Return the cached payload for key, calling build() to create it on a miss"""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                metrics.record_cache('chart', True)
+                return self._entries[key]
+
+        metrics.record_cache('chart', False)
+        payload = build()
+        with self._lock:
+            self._entries[key] = payload
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return payload
@@ -1,314 +1,1086 @@
+import numpy as np
 import pandas as pd
-import yfinance as yf
 import os
 import pickle
+import copy
 import datetime
+import functools
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict, Optional
 
+import metrics
+from fx import FxRates, fx_ticker_id, main_unit
+from journal import Journal, read_journal
+from market_data import INTERACTIVE, MarketDataUnavailable, get_market_data
+from shm_cache import get_shared_price_cache
+from ticker_store import get_ticker_store
+
+# Serializes all changes to users and investments. Readers never take it: writers replace lists and dicts
+# instead of changing them in place, so a reader always sees either the old or the new collection.
+write_lock = threading.RLock()
+
+
+def _writer(method):
+    """Run a method that changes program state while holding the write lock"""
+    @functools.wraps(method)
+    def locked(*args, **kwargs):
+        with write_lock:
+            return method(*args, **kwargs)
+    return locked
+
+
+def refresh_tickers_concurrently(tickers, force=False, max_workers=8, priority=INTERACTIVE):
+    """Refresh each distinct ticker once using a bounded worker pool
+
+    Returns a dict mapping ticker id to True if the refresh succeeded, False otherwise.
+    """
+    # Deduplicate by ticker id so a ticker held by several investments or users is fetched once
+    distinct = {}
+    duplicates = []
+    for ticker in tickers:
+        if ticker is None:
+            continue
+        if ticker.tickerId not in distinct:
+            distinct[ticker.tickerId] = ticker
+        elif distinct[ticker.tickerId] is not ticker:
+            duplicates.append(ticker)
+
+    results = {}
+    if not distinct:
+        return results
+
+    workers = max(1, min(max_workers, len(distinct)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {ticker_id: executor.submit(ticker.update_data, force, priority) for ticker_id, ticker in distinct.items()}
+        for ticker_id, future in futures.items():
+            try:
+                results[ticker_id] = bool(future.result())
+            except Exception as e:
+                print(f"Error refreshing {ticker_id}: {e}")
+                results[ticker_id] = False
+
+    # Other instances of an already refreshed ticker pick up the freshly saved data
+    for ticker in duplicates:
+        if results.get(ticker.tickerId):
+            ticker.load_local_data()
+
+    return results
+
 
 class MainProgramData:
 
+    refresh_workers = 8  # Maximum number of tickers fetched in parallel
+
     def __init__(self):
         self.trackedTickers = []
         self.users = []
         self.session_id = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
         self.save_dir = "saved_sessions"
+        self.journal_seq = 0  # Last journal record included in this snapshot
+        self._journal = None
+        self._compact_lock = threading.Lock()
+        self._rebuild_indexes()
 
         # Create save directory if it doesn't exist
         if not os.path.exists(self.save_dir):
             os.makedirs(self.save_dir)
 
+    def __getstate__(self):
+        """Pickle the program data without the lookup indexes and the journal, indexes are rebuilt when loading"""
+        state = self.__dict__.copy()
+        for key in ('_users_by_id', '_users_by_name', '_tickers_by_id', '_journal', '_compact_lock'):
+            state.pop(key, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # Ensure backward compatibility with older sessions
+        self.__dict__.setdefault('journal_seq', 0)
+        self._journal = None
+        self._compact_lock = threading.Lock()
+        self._rebuild_indexes()
+
+    def _rebuild_indexes(self):
+        """Build the id and name lookup indexes for users and tickers"""
+        self._users_by_id = {}
+        self._users_by_name = {}
+        for user in self.users:
+            # Older sessions may contain duplicate IDs, which could never be looked up separately
+            user.id = _unique_id(user.id, self._users_by_id)
+            self._users_by_id[user.id] = user
+            self._users_by_name.setdefault(user.name, []).append(user)
+        self._tickers_by_id = {}
+        for ticker in self.trackedTickers:
+            self._tickers_by_id.setdefault(ticker.tickerId, ticker)
+
+    def _session_path(self, saveId, extension):
+        return os.path.join(self.save_dir, f"session_{saveId}.{extension}")
+
     def save_program_data(self, saveId=None):
-        """Save the current program state with the given ID or use the session ID"""
+        """Save the current program state with the given ID or use the session ID
+
+        When the session is journaled every change is already in its journal, so saving it under its own
+        ID only makes the journal durable. Other IDs get a full snapshot.
+        """
         if saveId is None:
             saveId = self.session_id
 
-        save_path = os.path.join(self.save_dir, f"session_{saveId}.pkl")
-        with open(save_path, 'wb') as f:
-            pickle.dump(self, f)
+        if self._journal is not None and saveId == self.session_id:
+            self._journal.sync()
+            return saveId
+
+        with metrics.storage_duration.time(kind='session', operation='save'):
+            snapshot = pickle.dumps(self)
+            _write_atomic(self._session_path(saveId, 'pkl'), snapshot)
+        metrics.storage_size.set(len(snapshot), kind='session', operation='save')
         return saveId
 
     def load_saved_data(self, saveId):
-        """Load a saved program state with the given ID"""
-        save_path = os.path.join(self.save_dir, f"session_{saveId}.pkl")
-        if os.path.exists(save_path):
-            with open(save_path, 'rb') as f:
-                loaded_data = pickle.load(f)
-                return loaded_data
-        return None
+        """Load a saved program state with the given ID
+
+        The journal of the session is replayed over its latest snapshot and stays open, so further changes
+        are appended to it.
+        """
+        snapshot_path = self._session_path(saveId, 'pkl')
+        journal_path = self._session_path(saveId, 'journal')
+        if os.path.exists(snapshot_path):
+            with metrics.storage_duration.time(kind='session', operation='load'):
+                with open(snapshot_path, 'rb') as f:
+                    snapshot = f.read()
+                loaded_data = pickle.loads(snapshot)
+            metrics.storage_size.set(len(snapshot), kind='session', operation='load')
+        elif os.path.exists(journal_path):
+            # The session was never compacted, rebuild it from the journal alone
+            loaded_data = MainProgramData()
+        else:
+            return None
+
+        loaded_data.session_id = saveId
+        loaded_data.save_dir = self.save_dir
+        loaded_data.replay_journal(read_journal(journal_path, after_seq=loaded_data.journal_seq))
+        loaded_data.open_journal()
+        # Sessions saved before FX tickers were tracked get them once here
+        for user in loaded_data.users:
+            loaded_data.track_fx_tickers(user)
+        return loaded_data
+
+    def get_latest_session(self):
+        """Get the ID of the most recently changed saved session, or None if there is none"""
+        latest = None
+        latest_time = None
+        for session_id in self.get_available_sessions():
+            for extension in ('pkl', 'journal'):
+                path = self._session_path(session_id, extension)
+                if os.path.exists(path) and (latest_time is None or os.path.getmtime(path) > latest_time):
+                    latest, latest_time = session_id, os.path.getmtime(path)
+        return latest
 
     def get_available_sessions(self):
         """Get a list of all available saved sessions"""
         sessions = []
         if os.path.exists(self.save_dir):
             for file in os.listdir(self.save_dir):
-                if file.startswith("session_") and file.endswith(".pkl"):
-                    session_id = file.replace("session_", "").replace(".pkl", "")
-                    sessions.append(session_id)
+                for extension in (".pkl", ".journal"):
+                    if file.startswith("session_") and file.endswith(extension):
+                        session_id = file[len("session_"):-len(extension)]
+                        if session_id not in sessions:
+                            sessions.append(session_id)
         return sessions
 
+    def open_journal(self, sync_interval=1.0, compact_every=500):
+        """Start recording every change to this session in its journal
+
+        Records are fsynced in batches every sync_interval seconds. After compact_every records a snapshot
+        is written in the background and the journal is truncated.
+        """
+        self.close_journal()
+        self._journal = Journal(self._session_path(self.session_id, 'journal'), start_seq=self.journal_seq,
+                                sync_interval=sync_interval, compact_every=compact_every,
+                                on_compact=lambda: self.compact(background=True))
+        for user in self.users:
+            user._journal = self._journal
+        return self._journal
+
+    def close_journal(self):
+        """Make the journal durable and stop recording changes"""
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+            for user in self.users:
+                user._journal = None
+
+    def compact(self, background=False):
+        """Write a snapshot of the session and drop the journal records it contains
+
+        With background=True the snapshot is taken and written by a compaction thread, so the writer whose
+        change filled up the journal neither pickles the session nor holds up the other writers meanwhile.
+        A background compaction is skipped while another one is pending or running.
+        """
+        if not background:
+            with self._compact_lock:
+                return self._write_snapshot()
+        if not self._compact_lock.acquire(blocking=False):
+            return False
+        threading.Thread(target=self._compact_in_background, name='session-compaction', daemon=True).start()
+        return True
+
+    def _compact_in_background(self):
+        try:
+            self._write_snapshot()
+        except Exception as e:
+            print(f"Error compacting session {self.session_id}: {e}")
+        finally:
+            self._compact_lock.release()
+
+    def _write_snapshot(self):
+        journal = self._journal
+        if journal is None:
+            return False
+        start = time.perf_counter()
+        # No writer may change the state between taking the journal position and pickling it; a writer
+        # that triggered the compaction finishes its whole change before the snapshot is taken
+        with write_lock:
+            seq = journal.last_seq
+            self.journal_seq = seq
+            snapshot = pickle.dumps(self)
+        _write_atomic(self._session_path(self.session_id, 'pkl'), snapshot)
+        journal.truncate(seq)
+        metrics.storage_duration.observe(time.perf_counter() - start, kind='session', operation='compact')
+        metrics.storage_size.set(len(snapshot), kind='session', operation='compact')
+        return True
+
+    def _record(self, op, **fields):
+        if self._journal is not None:
+            self._journal.append(op, **fields)
+
+    @_writer
+    def replay_journal(self, records):
+        """Apply journal records to this program state
+
+        Records carry the resulting values rather than deltas, so replaying a change that is already
+        part of the snapshot leaves the state unchanged.
+        """
+        for record in records:
+            getattr(self, f"_apply_{record['op']}")(record)
+
+    def _apply_add_user(self, record):
+        if record['user_id'] in self._users_by_id:
+            return
+        user = UserProfile(record['name'])
+        user.id = record['user_id']
+        user.created_at = user.last_updated = record['created_at']
+        self._insert_user(user)
+
+    def _apply_remove_user(self, record):
+        self.remove_user(record['user_id'])
+
+    def _apply_add_ticker(self, record):
+        self.add_ticker(record['ticker_id'], fetch=False)
+
+    def _apply_add_investment(self, record):
+        user = self._users_by_id.get(record['user_id'])
+        state = dict(record['investment'])
+        ticker_id = state.pop('ticker_id')
+        if user is None or user.get_investment(state['id'], include_sold=True):
+            return
+        # Restore the investment as it was created instead of looking up its prices again
+        investment = Investment.__new__(Investment)
+        investment.__setstate__(dict(state, ticker=self.add_ticker(ticker_id, fetch=False) if ticker_id else None))
+        user._insert_investment(investment)
+
+    def _apply_remove_investment(self, record):
+        user = self._users_by_id.get(record['user_id'])
+        if user:
+            user.remove_investment(record['investment_id'])
+
+    def _apply_sell_investment(self, record):
+        user = self._users_by_id.get(record['user_id'])
+        if user:
+            user.sell_investment(record['investment_id'], record['selling_price'], record['sell_date'])
+
+    def _apply_remove_sold_investment(self, record):
+        user = self._users_by_id.get(record['user_id'])
+        if user:
+            user.remove_sold_investment(record['investment_id'])
+
+    def _apply_update_investment_tags(self, record):
+        user = self._users_by_id.get(record['user_id'])
+        if user:
+            user.update_investment_tags(record['investment_id'], record['tags'])
+
+    def _apply_set_base_currency(self, record):
+        user = self._users_by_id.get(record['user_id'])
+        if user:
+            user.set_base_currency(record['currency'])
+
+    def _apply_add_total_dividend(self, record):
+        user = self._users_by_id.get(record['user_id'])
+        if user:
+            user.total_dividends = record['total_dividends']
+            user._touch()
+
+    @_writer
     def add_user(self, name):
         """Add a new user to the program"""
         user = UserProfile(name)
-        self.users.append(user)
+        self._insert_user(user)
+        self._record('add_user', user_id=user.id, name=name, created_at=user.created_at)
         return user
 
+    def _insert_user(self, user):
+        # Users created within the same second share a timestamp based ID, keep IDs unique
+        user.id = _unique_id(user.id, self._users_by_id)
+        user._journal = self._journal
+        # Copy on write, the indexes first so users listed by a reader can always be looked up
+        self._users_by_id = {**self._users_by_id, user.id: user}
+        self._users_by_name = {**self._users_by_name, user.name: self._users_by_name.get(user.name, []) + [user]}
+        self.users = self.users + [user]
+
     def get_user(self, name):
         """Get a user by name"""
-        for user in self.users:
-            if user.name == name:
-                return user
-        return None
+        users = self._users_by_name.get(name)
+        return users[0] if users else None
+
+    def get_user_by_id(self, user_id):
+        """Get a user by ID"""
+        return self._users_by_id.get(user_id)
 
+    @_writer
     def remove_user(self, user_id):
         """Remove a user from the program"""
-        for i, user in enumerate(self.users):
-            if user.id == user_id:
-                self.users.pop(i)
-                return True
-        return False
+        user = self._users_by_id.get(user_id)
+        if user is None:
+            return False
+        self.users = [other for other in self.users if other is not user]
+        self._users_by_id = {other_id: other for other_id, other in self._users_by_id.items() if other_id != user_id}
+        users_by_name = dict(self._users_by_name)
+        same_name = [other for other in users_by_name.get(user.name, []) if other is not user]
+        if same_name:
+            users_by_name[user.name] = same_name
+        else:
+            users_by_name.pop(user.name, None)
+        self._users_by_name = users_by_name
+        self._record('remove_user', user_id=user_id)
+        return True
 
-    def add_ticker(self, ticker_id):
-        """Add a new ticker to track"""
-        # Check if ticker already exists
-        for ticker in self.trackedTickers:
-            if ticker.tickerId == ticker_id:
-                return ticker
+    def get_ticker(self, ticker_id):
+        """Get a tracked ticker by ID"""
+        return self._tickers_by_id.get(ticker_id)
 
-        # Create new ticker
-        ticker = Ticker(ticker_id)
-        self.trackedTickers.append(ticker)
+    def add_ticker(self, ticker_id, fetch=True):
+        """Add a new ticker to track, see Ticker for fetch"""
+        # Check if ticker already exists
+        ticker = self._tickers_by_id.get(ticker_id)
+        if ticker is not None:
+            return ticker
+
+        # Create new ticker, fetching its data before taking the write lock
+        return self.track_ticker(Ticker(ticker_id, fetch=fetch))
+
+    @_writer
+    def track_ticker(self, ticker):
+        """Track a ticker created by the caller, or return the tracked ticker with the same ID"""
+        existing = self._tickers_by_id.get(ticker.tickerId)
+        if existing is not None:
+            return existing
+        self._tickers_by_id = {**self._tickers_by_id, ticker.tickerId: ticker}
+        self.trackedTickers = self.trackedTickers + [ticker]
+        self._record('add_ticker', ticker_id=ticker.tickerId)
         return ticker
 
+    def collect_tickers(self, users=None):
+        """Get the distinct tickers held by the given users and their FX tickers, or all tracked tickers if no users are given"""
+        tickers = {}
+        if users is None:
+            for ticker in self.trackedTickers:
+                tickers.setdefault(ticker.tickerId, ticker)
+            users = self.users
+        for user in users:
+            for investment in user.investments:
+                if investment.ticker:
+                    tickers.setdefault(investment.ticker.tickerId, investment.ticker)
+            for ticker in self._fx_tickers(user).values():
+                tickers.setdefault(ticker.tickerId, ticker)
+        return list(tickers.values())
+
+    def _fx_tickers(self, user, add=False):
+        """Get the tracked FX tickers converting the currencies of a user's portfolio into their base currency
+
+        With add=True missing FX tickers are tracked without fetching them, see add_ticker.
+        """
+        base_currency = user.base_currency
+        tickers = {}
+        for currency in user.get_holdings().currencies():
+            code = main_unit(currency)[0]
+            if code == base_currency or code in tickers:
+                continue
+            ticker_id = fx_ticker_id(code, base_currency)
+            ticker = self.add_ticker(ticker_id, fetch=False) if add else self._tickers_by_id.get(ticker_id)
+            if ticker is not None:
+                tickers[code] = ticker
+        return tickers
+
+    def track_fx_tickers(self, user):
+        """Track the FX tickers a user's portfolio needs, after its investments or base currency changed
+
+        The FX tickers are refreshed and stored like any other tracked ticker; new ones have no rates
+        until their data is fetched.
+        """
+        return self._fx_tickers(user, add=True)
+
+    def get_fx_rates(self, user):
+        """Get the exchange rates into a user's base currency from the FX tickers tracked for it
+
+        Currencies without a tracked FX ticker are left unconverted, see track_fx_tickers.
+        """
+        return FxRates(user.base_currency, self._fx_tickers(user))
+
+    def refresh_tickers(self, users=None, force=False):
+        """Refresh every distinct ticker concurrently and revalue all dependent investments
+
+        Returns a dict mapping ticker id to True if the refresh succeeded, False otherwise.
+        """
+        results = refresh_tickers_concurrently(self.collect_tickers(users), force=force, max_workers=self.refresh_workers)
+        self.update_investment_values(users)
+        return results
+
+    def update_investment_values(self, users=None):
+        """Revalue all investments of the given users (or all users) from the cached ticker prices"""
+        target_users = self.users if users is None else users
+
+        # Update every dependent investment in one pass, looking up each ticker's price only once
+        prices = {}
+        for user in target_users:
+            for ticker in user.get_holdings().tickers:
+                if ticker.tickerId not in prices:
+                    prices[ticker.tickerId] = ticker.get_current_price()
+            user.revalue_investments(prices)
+            user.last_updated = datetime.datetime.now()
+
+
+def _write_atomic(path, data):
+    """Replace a file with new contents so a crash never leaves a partially written file behind"""
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+
+def _investment_state(investment):
+    """The attributes of an investment as stored in the journal, with the ticker as its ID"""
+    state = {key: value for key, value in investment.__getstate__().items() if key != 'ticker'}
+    state['ticker_id'] = investment.ticker.tickerId if investment.ticker else None
+    return state
+
+
+def _unique_id(base_id, existing):
+    """Make a timestamp based ID unique by appending a counter if it is already taken"""
+    unique_id = base_id
+    counter = 2
+    while unique_id in existing:
+        unique_id = f"{base_id}_{counter}"
+        counter += 1
+    return unique_id
+
+
+def merge_price_frames(existing, new, since=None):
+    """Merge newly fetched bars into an existing price frame
+
+    Bars in the new frame replace overlapping bars in the existing one, so revised bars are corrected.
+    If since is given, bars before that datetime are dropped.
+    """
+    if existing is None or existing.empty:
+        merged = new
+    elif new is None or new.empty:
+        merged = existing
+    else:
+        if existing.index.tz is not None and new.index.tz is not None and new.index.tz != existing.index.tz:
+            new = new.tz_convert(existing.index.tz)
+        merged = pd.concat([existing, new])
+        merged = merged[~merged.index.duplicated(keep='last')].sort_index()
+
+    if since is not None and not merged.empty:
+        cutoff = pd.Timestamp(since)
+        if merged.index.tz is not None and cutoff.tz is None:
+            cutoff = cutoff.tz_localize(merged.index.tz)
+        merged = merged[merged.index >= cutoff]
+    return merged
+
+
+# How each column of price bars is rolled up into a coarser bar, other columns keep their last value
+BAR_AGGREGATIONS = {'Open': 'first', 'High': 'max', 'Low': 'min', 'Close': 'last', 'Volume': 'sum',
+                    'Dividends': 'sum', 'Stock Splits': 'max'}
+
+
+def compact_price_bars(frame, tiers, now=None):
+    """Roll price bars up into coarser OHLCV bars as they age
+
+    tiers lists (max_age, bucket) pairs from the youngest to the oldest tier. The bars of a tier are
+    combined per bucket, a pandas frequency like '1h' or '1D' in the wall time of the bars, or kept as
+    they are if bucket is None. Bars older than the last max_age are dropped. Tier boundaries are moved
+    back to the start of a bucket of the older tier, so no bucket is split between two tiers.
+
+    A rolled up bar is labelled with the time of its first bar. Rolling up is associative, so compacting
+    a compacted frame again only merges the bars that aged into a coarser tier since.
+    """
+    if frame is None or frame.empty:
+        return frame
+    frame = frame if frame.index.is_monotonic_increasing else frame.sort_index()
+    # Work in the wall time of the bars, so buckets follow the trading days of the exchange across DST changes
+    wall = frame.index.tz_localize(None) if frame.index.tz is not None else frame.index
+    now = pd.Timestamp(now or datetime.datetime.now())
+    if now.tz is not None:
+        now = (now.tz_convert(frame.index.tz) if frame.index.tz is not None else now).tz_localize(None)
+
+    # edges[i] is the position of the first bar of tier i, tier i ends where tier i - 1 starts
+    edges = []
+    end = len(frame)
+    for position, (max_age, bucket) in enumerate(tiers):
+        older_bucket = tiers[position + 1][1] if position + 1 < len(tiers) else bucket
+        boundary = now - max_age
+        if older_bucket is not None:
+            boundary = boundary.floor(older_bucket)
+        end = min(end, wall.searchsorted(boundary, side='left'))
+        edges.append(end)
+
+    parts = []
+    for position in reversed(range(len(tiers))):
+        first = edges[position]
+        last = edges[position - 1] if position > 0 else len(frame)
+        if first >= last:
+            continue
+        bucket = tiers[position][1]
+        part = frame.iloc[first:last]
+        parts.append(part if bucket is None else _roll_up(part, wall[first:last], bucket))
+    if not parts:
+        return frame.iloc[:0]
+    return pd.concat(parts) if len(parts) > 1 else parts[0]
+
+
+def _roll_up(bars, wall, bucket):
+    """Combine the bars falling into the same bucket of their wall time into one bar"""
+    keys = wall.floor(bucket).asi8
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    if len(starts) == len(bars):
+        return bars
+    ends = np.r_[starts[1:], len(bars)] - 1
+    columns = {}
+    for column in bars.columns:
+        values = bars[column].to_numpy()
+        how = BAR_AGGREGATIONS.get(column, 'last') if values.dtype.kind in 'iuf' else 'last'
+        if how == 'first':
+            columns[column] = values[starts]
+        elif how == 'max':
+            columns[column] = np.fmax.reduceat(values, starts)
+        elif how == 'min':
+            columns[column] = np.fmin.reduceat(values, starts)
+        elif how == 'sum':
+            columns[column] = np.add.reduceat(values, starts)
+        else:
+            columns[column] = values[ends]
+    return pd.DataFrame(columns, index=bars.index[starts], columns=bars.columns)
+
+
+# Price data of a ticker, replaced as a whole so readers never see frames from different refreshes
+PriceFrames = namedtuple('PriceFrames', ['closingPrices', 'intradayPrices', 'last_updated'])
+
 
 class Ticker:
 
-    def __init__(self, tickerId):
+    history_days = 730  # Days of daily closing prices to keep
+    intraday_days = 7  # Days of intraday prices fetched on a full sync
+    intraday_interval = '1h'  # Interval of the fetched intraday prices
+    # Intraday bars are rolled up into coarser bars as they age, (max_age, bucket) with None keeping the fetched
+    # bars; older purchases keep intraday prices while the memory and disk used per ticker stay bounded
+    intraday_retention = ((datetime.timedelta(days=7), None),
+                          (datetime.timedelta(days=90), '1h'),
+                          (datetime.timedelta(days=730), '1D'))
+    daily_overlap = datetime.timedelta(days=5)  # Refetch this many days to correct revised daily bars
+    intraday_overlap = datetime.timedelta(hours=3)  # Refetch this many hours to correct revised hourly bars
+    full_resync_interval = datetime.timedelta(days=1)  # Periodically refetch the full history as a safety net
+
+    def __init__(self, tickerId, fetch=True):
+        """Create a ticker, loading its data from the ticker store or else fetching it from Yahoo Finance
+
+        With fetch=False nothing is loaded or fetched here: the data is loaded from the ticker store when
+        first accessed, and a ticker without stored data is left to the background refresher.
+        """
         self.tickerId = tickerId
-        self.closingPrices = pd.DataFrame()
-        self.intradayPrices = pd.DataFrame()
+        self._lock = threading.RLock()  # Serializes loading and refreshing, readers never take it
+        self._set_frames(PriceFrames(pd.DataFrame(), pd.DataFrame(), None))
         self.dividendType = None
         self.xDate = None
         self.name = None
         self.currency = None
         self.sector = None
         self.data_dir = "ticker_data"
-        self.last_updated = None
+        self.last_full_sync = None
         self.update_interval = datetime.timedelta(minutes=15)  # Only update data every 15 minutes
 
         # Create data directory if it doesn't exist
         if not os.path.exists(self.data_dir):
             os.makedirs(self.data_dir)
 
+        if not fetch:
+            self._frames = None  # Loaded from the ticker store on first access
         # Try to load existing data or fetch new data
-        if not self.load_local_data():
+        elif not self.load_local_data():
             self.update_data(force=True)
 
-    def update_data(self, force=False):
-        """Fetch data from Yahoo Finance API"""
+    @classmethod
+    def from_frames(cls, tickerId, closing_prices, intraday_prices=None, last_updated=None, name=None,
+                    currency='USD', sector='Unknown', data_dir="ticker_data"):
+        """Create a ticker from existing price frames without reading the ticker store or calling Yahoo Finance"""
+        ticker = cls.__new__(cls)
+        ticker.__setstate__({'tickerId': tickerId, 'name': name or tickerId, 'currency': currency,
+                             'sector': sector, 'dividendType': None, 'xDate': None, 'data_dir': data_dir})
+        ticker._set_frames(PriceFrames(closing_prices,
+                                       intraday_prices if intraday_prices is not None else pd.DataFrame(),
+                                       last_updated or datetime.datetime.now()))
+        return ticker
+
+    def __getstate__(self):
+        """Pickle the ticker as a reference into the ticker store instead of embedding its price frames"""
+        state = self.__dict__.copy()
+        frames = state.pop('_frames', None)
+        state.pop('_lock', None)
+        state.pop('last_full_sync', None)
+        state.pop('_price_lookup', None)
+        state.pop('_last_quote', None)
+        state.pop('_shared_version', None)
+        fallback = state.pop('_fallback_frames', None)
+        if frames is not None:
+            fallback = frames._asdict()
+
+        # Only embed the frames if the ticker store has no copy to load them from
+        if fallback is not None and not get_ticker_store(self.data_dir).exists(self.tickerId):
+            state['_fallback_frames'] = fallback
+        return state
+
+    def __setstate__(self, state):
+        """Restore a pickled ticker, deferring the price frames until they are first accessed"""
+        state = dict(state)
+        # Older sessions embedded the frames, keep them in case the ticker store has no copy
+        last_updated = state.pop('last_updated', None)
+        if 'closingPrices' in state or 'intradayPrices' in state:
+            state['_fallback_frames'] = {
+                'closingPrices': state.pop('closingPrices', pd.DataFrame()),
+                'intradayPrices': state.pop('intradayPrices', pd.DataFrame()),
+                'last_updated': last_updated
+            }
+        state.setdefault('data_dir', "ticker_data")
+        state.setdefault('update_interval', datetime.timedelta(minutes=15))
+        state.setdefault('last_full_sync', None)
+        state['_frames'] = None
+        state['_lock'] = threading.RLock()
+        state['_price_lookup'] = None
+        state['_last_quote'] = None
+        state.setdefault('data_version', 0)
+        self.__dict__.update(state)
+
+    def _ensure_frames(self):
+        """Load the price frames from the ticker store if they have not been loaded yet"""
+        if self.__dict__.get('_frames') is not None:
+            return
+        with self._lock:
+            if self._frames is not None:
+                return
+            fallback = self.__dict__.pop('_fallback_frames', None)
+            if not self.load_local_data():
+                fallback = fallback or {}
+                self._set_frames(PriceFrames(fallback.get('closingPrices', pd.DataFrame()),
+                                             fallback.get('intradayPrices', pd.DataFrame()),
+                                             fallback.get('last_updated')))
+
+    def get_frames(self):
+        """Get a consistent snapshot of the price frames and the time they were last updated"""
+        shared = get_shared_price_cache()
+        if shared is not None and not shared.is_writer:
+            # Use the frames published by the refresher process as soon as a new version appears
+            published = shared.lookup(self.tickerId)
+            if published is not None:
+                version, closing_prices, intraday_prices, last_updated = published
+                if self.__dict__.get('_shared_version') != version:
+                    self._set_frames(PriceFrames(closing_prices, intraday_prices, last_updated))
+                    self._shared_version = version
+                return self._frames
+        self._ensure_frames()
+        return self._frames
+
+    def publish_shared(self):
+        """Publish the current frames to the other processes if this process writes the shared price cache"""
+        shared = get_shared_price_cache()
+        if shared is not None and shared.is_writer:
+            frames = self.get_frames()
+            shared.publish(self.tickerId, frames.closingPrices, frames.intradayPrices, frames.last_updated)
+
+    def _set_frames(self, frames):
+        """Publish new price frames in a single assignment and bump the data version"""
+        self._frames = frames
+        # Caches derived from the frames check that they were built from the current frames
+        self.data_version = self.__dict__.get('data_version', 0) + 1
+
+    @property
+    def closingPrices(self):
+        return self.get_frames().closingPrices
+
+    @closingPrices.setter
+    def closingPrices(self, value):
+        self._set_frames(self.get_frames()._replace(closingPrices=value))
+
+    @property
+    def intradayPrices(self):
+        return self.get_frames().intradayPrices
+
+    @intradayPrices.setter
+    def intradayPrices(self, value):
+        self._set_frames(self.get_frames()._replace(intradayPrices=value))
+
+    @property
+    def last_updated(self):
+        return self.get_frames().last_updated
+
+    @last_updated.setter
+    def last_updated(self, value):
+        self._set_frames(self.get_frames()._replace(last_updated=value))
+
+    def needs_refresh(self, lead_time=datetime.timedelta(0)):
+        """Check whether the data expires within lead_time (or has already expired)"""
         # Ensure backward compatibility with older sessions
         if not hasattr(self, 'update_interval'):
             self.update_interval = datetime.timedelta(minutes=15)  # Default: update every 15 minutes
 
+        last_updated = self.last_updated
+        if not last_updated:
+            return True
+        return datetime.datetime.now() - last_updated >= self.update_interval - lead_time
+
+    @property
+    def is_stale(self):
+        """Whether the last known prices are past their update interval, for example while Yahoo Finance is unavailable"""
+        return self.last_updated is not None and self.needs_refresh()
+
+    def needs_full_sync(self, current_time=None):
+        """Check whether the next refresh must refetch the full history instead of only the latest bars"""
+        current_time = current_time or datetime.datetime.now()
+        last_full_sync = getattr(self, 'last_full_sync', None)
+        if last_full_sync is None or current_time - last_full_sync >= self.full_resync_interval:
+            return True
+        # Incremental merges need existing timezone-aware data to line up the new bars with
+        closing_prices = self.closingPrices
+        return closing_prices.empty or closing_prices.index.tz is None
+
+    def update_data(self, force=False, priority=INTERACTIVE):
+        """Fetch data from Yahoo Finance API
+
+        The new frames are built on the side and published together once the fetch is complete.
+        priority orders the outbound calls, interactive requests go ahead of background refreshes.
+        """
+        shared = get_shared_price_cache()
+        if shared is not None and not shared.is_writer and shared.lookup(self.tickerId) is not None:
+            # The refresher process fetches this ticker once for all workers
+            return True
+        with self._lock:
+            return self._update_data(force, priority)
+
+    def _update_data(self, force, priority):
         # Check if we need to update the data
         current_time = datetime.datetime.now()
-        if not force and self.last_updated and (current_time - self.last_updated) < self.update_interval:
+        if not force and not self.needs_refresh():
             # Data is still fresh, no need to update
             return True
 
         try:
-            # Get ticker info
-            ticker = yf.Ticker(self.tickerId)
-            info = ticker.info
-
-            # Store basic info
-            self.name = info.get('shortName', self.tickerId)
-            self.currency = info.get('currency', 'EUR')
-            self.sector = info.get('sector', 'Unknown')
+            # Only fetch the bars after the data we already have, unless a full resync is due
+            full_sync = self.needs_full_sync(current_time)
+            market_data = get_market_data()
+
+            # The info rarely changes, so it is only fetched with a full sync or while it is missing
+            if full_sync or self.name is None or self.currency is None:
+                # Sharing the call with concurrent requests for the same ticker
+                info = market_data.info(self.tickerId, priority)
+                self.name = info.get('shortName', self.tickerId)
+                self.currency = info.get('currency', 'EUR')
+                self.sector = info.get('sector', 'Unknown')
 
             # Get historical data (last 2 years)
             end_date = current_time
-            start_date = end_date - datetime.timedelta(days=730)
-
-            # Fetch historical data
-            self.closingPrices = ticker.history(start=start_date, end=end_date)
+            start_date = end_date - datetime.timedelta(days=self.history_days)
+            intraday_start = end_date - datetime.timedelta(days=self.intraday_days)
+            frames = self.get_frames()
+            closing_prices = frames.closingPrices
+            intraday_prices = frames.intradayPrices
+            new_bars = {}
+            if full_sync:
+                closing_prices = market_data.history(self.tickerId, start_date, end_date, priority=priority)
+            else:
+                delta_start = (closing_prices.index[-1] - self.daily_overlap).to_pydatetime()
+                new_prices = market_data.history(self.tickerId, delta_start, end_date, priority=priority)
+                closing_prices = merge_price_frames(closing_prices, new_prices, since=start_date)
+                new_bars['closingPrices'] = new_prices
 
-            # Get intraday data if available (last 7 days)
+            # Get intraday data if available, older bars are kept and rolled up by the retention tiers
             try:
-                intraday_start = end_date - datetime.timedelta(days=7)
-                self.intradayPrices = ticker.history(start=intraday_start, end=end_date, interval="1h")
+                if full_sync or intraday_prices.empty or intraday_prices.index.tz is None:
+                    new_prices = market_data.history(self.tickerId, intraday_start, end_date,
+                                                     interval=self.intraday_interval, priority=priority)
+                    # Bars without a timezone from older versions cannot be lined up with the fetched ones
+                    kept = intraday_prices if not intraday_prices.empty and intraday_prices.index.tz is not None else None
+                    # The full sync doubles as the compaction job, the frame is rewritten in the store below
+                    intraday_prices = compact_price_bars(merge_price_frames(kept, new_prices), self.intraday_retention,
+                                                         current_time)
+                else:
+                    delta_start = max((intraday_prices.index[-1] - self.intraday_overlap).to_pydatetime(),
+                                      pd.Timestamp(intraday_start).tz_localize(intraday_prices.index.tz).to_pydatetime())
+                    new_prices = market_data.history(self.tickerId, delta_start, end_date,
+                                                     interval=self.intraday_interval, priority=priority)
+                    # Bars that aged out of the finest tier are rolled up with the next full sync
+                    intraday_prices = merge_price_frames(intraday_prices, new_prices)
+                    new_bars['intradayPrices'] = new_prices
             except Exception as e:
                 print(f"Could not fetch intraday data for {self.tickerId}: {e}")
 
-            # Update the last_updated timestamp
-            self.last_updated = current_time
+            # Publish the new frames together with the last_updated timestamp
+            self._set_frames(PriceFrames(closing_prices, intraday_prices, current_time))
+            if full_sync:
+                self.last_full_sync = current_time
 
-            # Save the data locally
-            self.save_data_locally()
+            # Save the data locally, appending only the new bars after an incremental refresh
+            self.save_data_locally(new_bars=new_bars if not full_sync else None)
+            self.publish_shared()
             return True
+        except MarketDataUnavailable as e:
+            # Keep serving the last known frames, they are flagged as stale until a refresh succeeds
+            print(f"Keeping the last known data for {self.tickerId}: {e}")
+            return False
         except Exception as e:
             print(f"Error updating data for {self.tickerId}: {e}")
             return False
 
-    def save_data_locally(self):
-        """Save ticker data to local file"""
+    def save_data_locally(self, new_bars=None):
+        """Save ticker data to the local ticker store
+
+        new_bars optionally maps frame names to the bars fetched by an incremental refresh,
+        which the store appends instead of rewriting the whole history.
+        """
         # Ensure backward compatibility with older sessions
         if not hasattr(self, 'update_interval'):
             self.update_interval = datetime.timedelta(minutes=15)  # Default: update every 15 minutes
 
-        data = {
-            'tickerId': self.tickerId,
+        frames = self.get_frames()
+        metadata = {
             'name': self.name,
             'currency': self.currency,
             'sector': self.sector,
-            'closingPrices': self.closingPrices,
-            'intradayPrices': self.intradayPrices,
             'dividendType': self.dividendType,
             'xDate': self.xDate,
-            'last_updated': self.last_updated,
+            'last_updated': frames.last_updated,
+            'last_full_sync': getattr(self, 'last_full_sync', None),
             'update_interval': self.update_interval
         }
-
-        file_path = os.path.join(self.data_dir, f"{self.tickerId}.pkl")
-        with open(file_path, 'wb') as f:
-            pickle.dump(data, f)
+        frames = {'closingPrices': frames.closingPrices, 'intradayPrices': frames.intradayPrices}
+        with metrics.storage_duration.time(kind='ticker', operation='save'):
+            get_ticker_store(self.data_dir).save(self.tickerId, metadata, frames, new_bars=new_bars)
 
     def load_local_data(self):
-        """Load ticker data from local file"""
-        file_path = os.path.join(self.data_dir, f"{self.tickerId}.pkl")
-        if os.path.exists(file_path):
-            try:
-                with open(file_path, 'rb') as f:
-                    data = pickle.load(f)
-
-                self.name = data.get('name', self.tickerId)
-                self.currency = data.get('currency', 'USD')
-                self.sector = data.get('sector', 'Unknown')
-                self.closingPrices = data.get('closingPrices', pd.DataFrame())
-                self.intradayPrices = data.get('intradayPrices', pd.DataFrame())
-                self.dividendType = data.get('dividendType', None)
-                self.xDate = data.get('xDate', None)
-                self.last_updated = data.get('last_updated', None)
-                # Load update_interval with a default if not present in saved data
-                self.update_interval = data.get('update_interval', datetime.timedelta(minutes=15))
-                return True
-            except Exception as e:
-                print(f"Error loading data for {self.tickerId}: {e}")
+        """Load ticker data from the local ticker store"""
+        start = time.perf_counter()
+        try:
+            store = get_ticker_store(self.data_dir)
+            data = store.load_metadata(self.tickerId)
+            if data is None:
+                return False
+
+            self.name = data.get('name', self.tickerId)
+            self.currency = data.get('currency', 'USD')
+            self.sector = data.get('sector', 'Unknown')
+            self.dividendType = data.get('dividendType', None)
+            self.xDate = data.get('xDate', None)
+            last_updated = data.get('last_updated', None)
+            self.last_full_sync = data.get('last_full_sync', None)
+            # Load update_interval with a default if not present in saved data
+            self.update_interval = data.get('update_interval') or datetime.timedelta(minutes=15)
+
+            # Only read the bars inside the retention windows, appended history before that stays on disk
+            daily_start = intraday_start = None
+            if last_updated:
+                daily_start = last_updated - datetime.timedelta(days=self.history_days)
+                intraday_start = last_updated - self.intraday_retention[-1][0]
+            self._set_frames(PriceFrames(store.read_frame(self.tickerId, 'closingPrices', start=daily_start),
+                                         store.read_frame(self.tickerId, 'intradayPrices', start=intraday_start),
+                                         last_updated))
+            metrics.storage_duration.observe(time.perf_counter() - start, kind='ticker', operation='load')
+            return True
+        except Exception as e:
+            print(f"Error loading data for {self.tickerId}: {e}")
         return False
 
     def get_current_price(self):
         """Get the most recent price, preferring intraday data when available"""
+        return self.get_last_quote()['price']
+
+    def get_last_quote(self):
+        """Get a snapshot of the most recent price and its timestamp, cached until the price data changes"""
+        frames = self.get_frames()
+        cached = self.__dict__.get('_last_quote')
+        hit = cached is not None and cached[0] is frames
+        metrics.record_cache('ticker_quote', hit)
+        if hit:
+            return cached[1]
+
+        closing_prices, intraday_prices = frames.closingPrices, frames.intradayPrices
+        quote = {'price': None, 'as_of': None}
         # First check if we have recent intraday data
-        if not self.intradayPrices.empty:
+        if not intraday_prices.empty:
             # Get the most recent date in the intraday data
-            most_recent_intraday_date = self.intradayPrices.index.max()
+            most_recent_intraday_date = intraday_prices.index.max()
 
             # Get the most recent date in the closing prices
-            most_recent_closing_date = self.closingPrices.index.max() if not self.closingPrices.empty else None
+            most_recent_closing_date = closing_prices.index.max() if not closing_prices.empty else None
 
             # If intraday data is more recent than closing data, use it
             if most_recent_closing_date is None or most_recent_intraday_date > most_recent_closing_date:
-                return self.intradayPrices['Close'].iloc[-1]
+                quote = {'price': intraday_prices['Close'].iloc[-1], 'as_of': intraday_prices.index[-1]}
 
         # Fall back to closing prices if intraday data is not available or not more recent
-        if not self.closingPrices.empty:
-            return self.closingPrices['Close'].iloc[-1]
+        if quote['price'] is None and not closing_prices.empty:
+            quote = {'price': closing_prices['Close'].iloc[-1], 'as_of': closing_prices.index[-1]}
 
-        return None
+        self._last_quote = (frames, quote)
+        return quote
 
     def get_price_history(self, days=30):
         """Get price history for the specified number of days"""
-        if not self.closingPrices.empty:
-            return self.closingPrices['Close'].tail(days)
+        closing_prices = self.closingPrices
+        if not closing_prices.empty:
+            return closing_prices['Close'].tail(days)
         return pd.Series()
 
     def get_price_at_date(self, date):
         """Get the price at a specific date and time, preferring intraday data when available"""
-        # Convert date to pandas Timestamp for comparison
-        date_ts = pd.Timestamp(date)
-
-        # First try to get intraday price if available
-        if not self.intradayPrices.empty:
-            # Check if we have intraday data for the date
-            intraday_dates = self.intradayPrices.index.floor('D').unique()
-            target_date = date_ts.floor('D')
-
-            if target_date in intraday_dates:
-                # Get all intraday prices for the target date
-                day_prices = self.intradayPrices[self.intradayPrices.index.floor('D') == target_date]
-
-                if not day_prices.empty:
-                    # Find the closest time
-                    # Convert date_ts to UTC if the index has timezone info
-                    if hasattr(day_prices.index, 'tz') and day_prices.index.tz is not None:
-                        # If date_ts is naive, localize it to UTC
-                        if date_ts.tz is None:
-                            date_ts = date_ts.tz_localize('UTC')
-                        # Convert both to UTC for comparison
-                        time_diffs = abs(day_prices.index.tz_convert('UTC') - date_ts.tz_convert('UTC'))
-                    else:
-                        # If index is naive, ensure date_ts is also naive
-                        if date_ts.tz is not None:
-                            date_ts = date_ts.tz_localize(None)
-                        time_diffs = abs(day_prices.index - date_ts)
-
-                    closest_idx = time_diffs.argmin()
-                    closest_time = day_prices.index[closest_idx]
-                    return day_prices.loc[closest_time, 'Close']
-
-        # Fall back to daily closing prices if intraday data is not available
-        if not self.closingPrices.empty:
-            # Try to get the exact date
-            # Handle timezone differences for the exact date comparison
-            target_date = date_ts.floor('D')
-            if hasattr(self.closingPrices.index, 'tz') and self.closingPrices.index.tz is not None:
-                # If target_date is naive, localize it to match the index timezone
-                if target_date.tz is None:
-                    target_date = target_date.tz_localize(self.closingPrices.index.tz)
-                # Convert both to the same timezone for comparison
-                index_dates = self.closingPrices.index.floor('D')
-                # Check if the date exists in the index
-                for idx_date in index_dates:
-                    if idx_date.tz_convert('UTC').floor('D') == target_date.tz_convert('UTC').floor('D'):
-                        return self.closingPrices.loc[idx_date, 'Close']
-            else:
-                # If index is naive, ensure target_date is also naive
-                if target_date.tz is not None:
-                    target_date = target_date.tz_localize(None)
-                if target_date in self.closingPrices.index:
-                    return self.closingPrices.loc[target_date, 'Close']
-
-            # If exact date not found, get the closest date before the specified date
-            # Handle timezone differences
-            if hasattr(self.closingPrices.index, 'tz') and self.closingPrices.index.tz is not None:
-                # If date_ts is naive, localize it to UTC
-                if date_ts.tz is None:
-                    date_ts = date_ts.tz_localize('UTC')
-                # Convert index to UTC for comparison
-                idx_utc = self.closingPrices.index.tz_convert('UTC')
-                earlier_dates = self.closingPrices.index[idx_utc <= date_ts.tz_convert('UTC')]
-            else:
-                # If index is naive, ensure date_ts is also naive
-                if date_ts.tz is not None:
-                    date_ts = date_ts.tz_localize(None)
-                earlier_dates = self.closingPrices.index[self.closingPrices.index <= date_ts]
-
-            if not earlier_dates.empty:
-                closest_date = earlier_dates[-1]
-                return self.closingPrices.loc[closest_date, 'Close']
-
-            # If no earlier date found, get the earliest available date
-            if not self.closingPrices.empty:
-                earliest_date = self.closingPrices.index[0]
-                return self.closingPrices.loc[earliest_date, 'Close']
-
-        # If no data available, return None
+        price = self.get_prices_at_dates([date])[0]
+        if np.isnan(price):
+            # If no data available, return None
+            return None
+        return price
+
+    def get_prices_at_dates(self, dates):
+        """Get the prices at many dates and times in one vectorized as-of lookup
+
+        For each date this returns the intraday price closest in time on the same day if available,
+        otherwise the last closing price on or before that day, otherwise the earliest closing price.
+        Naive datetimes are wall time in the timezone of the price data, for the day as well as the time
+        of day. Dates without any price data get NaN.
+        """
+        targets = pd.DatetimeIndex(pd.to_datetime(dates))
+        prices = np.full(len(targets), np.nan)
+        if len(targets) == 0:
+            return prices
+
+        lookup = self._get_price_lookup()
+        daily = lookup['closingPrices']
+        if daily is not None:
+            # Last close on or before the target day, or the earliest close if the target is before all data
+            positions = np.searchsorted(daily['days'], _day_keys(targets, daily['tz']), side='right') - 1
+            prices = daily['close'][np.maximum(positions, 0)]
+
+        intraday = lookup['intradayPrices']
+        if intraday is not None:
+            days = _day_keys(targets, intraday['tz'])
+            start = np.searchsorted(intraday['days'], days, side='left')
+            end = np.searchsorted(intraday['days'], days, side='right')
+            has_intraday = end > start
+            if has_intraday.any():
+                # Closest bar in time among the bars of the same day
+                times = _utc_nanos(_as_timezone(targets, intraday['tz']))
+                positions = np.searchsorted(intraday['times'], times, side='left')
+                # Days without intraday bars have an empty range, keep their indices valid and mask them out below
+                last_bar = len(intraday['times']) - 1
+                first = np.minimum(start, last_bar)
+                last = np.minimum(np.maximum(end - 1, start), last_bar)
+                before = np.clip(positions - 1, first, last)
+                after = np.clip(positions, first, last)
+                before_diff = np.abs(intraday['times'][before] - times)
+                after_diff = np.abs(intraday['times'][after] - times)
+                closest = np.where(after_diff < before_diff, after, before)
+                prices = np.where(has_intraday, intraday['close'][closest], prices)
+
+        return prices
+
+    def _get_price_lookup(self):
+        """Get sorted timestamp, day and close arrays for as-of lookups, rebuilt only when the frames change"""
+        frames = self.get_frames()
+        cached = self.__dict__.get('_price_lookup')
+        hit = cached is not None and cached[0] is frames
+        metrics.record_cache('price_lookup', hit)
+        if hit:
+            return cached[1]
+        lookup = {'closingPrices': _build_price_lookup(frames.closingPrices),
+                  'intradayPrices': _build_price_lookup(frames.intradayPrices)}
+        self._price_lookup = (frames, lookup)
+        return lookup
+
+
+NANOS_PER_DAY = 24 * 60 * 60 * 10**9
+
+
+def _utc_nanos(index):
+    """Nanoseconds since the epoch in UTC, treating naive timestamps as UTC"""
+    return index.as_unit('ns').asi8
+
+
+def _as_timezone(index, tz):
+    """Express timestamps in timezone tz, naive timestamps being wall time in tz (or tz None keeping wall time)"""
+    if index.tz is None and tz is not None:
+        # Ambiguous wall times during the DST change take standard time
+        return index.tz_localize(tz, ambiguous=np.zeros(len(index), dtype=bool), nonexistent='shift_forward')
+    if index.tz is not None and tz is None:
+        return index.tz_localize(None)
+    return index
+
+
+def _day_keys(index, tz):
+    """Calendar day numbers of the timestamps in the given timezone (naive timestamps keep their own date)"""
+    if index.tz is not None and tz is not None:
+        index = index.tz_convert(tz)
+    if index.tz is not None:
+        index = index.tz_localize(None)
+    return index.as_unit('ns').asi8 // NANOS_PER_DAY
+
+
+def _naive_days(index):
+    """Calendar days of a datetime index in its own timezone, as a naive index"""
+    index = pd.DatetimeIndex(index)
+    if index.tz is not None:
+        index = index.tz_localize(None)
+    return index.normalize()
+
+
+def _build_price_lookup(frame):
+    if frame is None or frame.empty or 'Close' not in frame.columns:
         return None
+    frame = frame if frame.index.is_monotonic_increasing else frame.sort_index()
+    index = pd.DatetimeIndex(frame.index)
+    return {
+        'tz': index.tz,
+        'times': _utc_nanos(index),
+        'days': _day_keys(index, index.tz),
+        'close': frame['Close'].to_numpy(dtype=float),
+    }
 
 
 class Investment:
 
-    def __init__(self, ticker=None, initial_investment=500, currency='EUR', number_of_shares=None, purchase_price=None, purchase_date=None, tags=None):
+    # No per-instance __dict__, so users with tens of thousands of investments need far less memory
+    __slots__ = ('ticker', 'initialInvestment', 'currency', 'purchasePrice', 'currentValue', 'startDatetime',
+                 'endDatetime', 'tags', 'is_sold', 'selling_price', 'profit', 'id', 'numberOfShares')
+
+    def __init__(self, ticker=None, initial_investment=500, currency='EUR', number_of_shares=None, purchase_price=None, purchase_date=None, tags=None, refresh=True):
         self.ticker = ticker
         self.initialInvestment = initial_investment
         self.currency = currency
@@ -333,42 +1105,73 @@ class Investment:
             self.numberOfShares = 0
             if ticker:
                 # If purchase date is provided and purchase price is not, use historical price
-                if purchase_date and ticker.get_price_at_date(purchase_date):
-                    self.purchasePrice = ticker.get_price_at_date(purchase_date)
+                historical_price = ticker.get_price_at_date(purchase_date) if purchase_date else None
+                if historical_price:
+                    self.purchasePrice = historical_price
                     self.numberOfShares = initial_investment / self.purchasePrice
                 # Otherwise use current price
                 elif ticker.get_current_price():
                     self.purchasePrice = ticker.get_current_price()
                     self.numberOfShares = initial_investment / self.purchasePrice
 
-        # Update data immediately if ticker is provided
-        if self.ticker:
+        # Update data immediately if ticker is provided, unless the caller revalues the investment itself
+        if self.ticker and refresh:
             self.update_data()
 
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in self.__slots__ if hasattr(self, name)}
+
+    def __setstate__(self, state):
+        # Ensure backward compatibility with older sessions, which pickled the attributes of a __dict__
+        state = {'tags': [], 'is_sold': False, 'selling_price': None, 'profit': None, **state}
+        for name in self.__slots__:
+            if name in state:
+                setattr(self, name, state[name])
+
     def update_data(self, force=False):
         """Update the current value of the investment based on ticker data"""
         if self.ticker:
             # Update ticker data if needed
             self.ticker.update_data(force=force)
+            self.update_value()
+        return self.currentValue
 
-            # Get current price and update value
+    def update_value(self, current_price=None):
+        """Recalculate the current value from the ticker's latest price without fetching new data"""
+        if current_price is None and self.ticker:
             current_price = self.ticker.get_current_price()
-            if current_price:
-                self.currentValue = self.numberOfShares * current_price
+        if current_price:
+            self.currentValue = self.numberOfShares * current_price
         return self.currentValue
 
-    def get_performance(self):
-        """Calculate the performance of the investment"""
+    def value_at(self, current_price):
+        """Get the value at a price without changing the investment, the stored value without a price"""
+        return self.numberOfShares * current_price if current_price else self.currentValue
+
+    def get_performance(self, value=None):
+        """Calculate the performance of the investment, at its stored value unless value is given"""
+        if value is None:
+            value = self.currentValue
         if self.initialInvestment > 0:
-            return (self.currentValue - self.initialInvestment) / self.initialInvestment * 100
+            return (value - self.initialInvestment) / self.initialInvestment * 100
         return 0
 
     def get_performance_history(self, days=30):
-        """Get the performance history for the specified number of days"""
+        """Get the performance history for the specified number of days, limited to the period the investment was held
+
+        Like get_portfolio_history, a sold investment counts as held until the day before it was sold.
+        """
         if self.ticker:
             price_history = self.ticker.get_price_history(days)
             if not price_history.empty and self.numberOfShares > 0:
-                value_history = price_history * self.numberOfShares
+                # Compare calendar days so timezone-aware price data lines up with the naive investment dates
+                days_index = _naive_days(price_history.index)
+                held = np.ones(len(price_history), dtype=bool)
+                if self.startDatetime:
+                    held &= days_index >= pd.Timestamp(self.startDatetime).normalize()
+                if self.endDatetime:
+                    held &= days_index < pd.Timestamp(self.endDatetime).normalize()
+                value_history = price_history[held] * self.numberOfShares
                 return value_history
         return pd.Series()
 
@@ -395,12 +1198,20 @@ class Investment:
 
         return True
 
-    def to_dict(self):
-        """Convert investment to dictionary for display"""
+    def to_dict(self, quote=None):
+        """Convert investment to dictionary for display
+
+        quote optionally passes the ticker's last quote snapshot, so it is not looked up again. Active
+        investments are valued at its price, without storing the value on the shared investment.
+        """
+        if quote is None and self.ticker:
+            quote = self.ticker.get_last_quote()
         # Get current price and ensure it's a Python native type
-        current_price = self.ticker.get_current_price() if self.ticker else None
+        current_price = quote['price'] if quote else None
         if current_price is not None:
             current_price = float(current_price)
+        current_value = self.currentValue if self.is_sold else self.value_at(current_price)
+        performance = self.get_performance(current_value)
 
         result = {
             'id': self.id,
@@ -411,109 +1222,720 @@ class Investment:
             'number_of_shares': float(self.numberOfShares) if self.numberOfShares is not None else None,
             'purchase_price': float(self.purchasePrice) if self.purchasePrice is not None else None,
             'current_price': current_price,
-            'current_value': float(self.currentValue) if self.currentValue is not None else None,
-            'performance': float(self.get_performance()) if self.get_performance() is not None else None,
+            'current_value': float(current_value) if current_value is not None else None,
+            'performance': float(performance) if performance is not None else None,
             'start_date': self.startDatetime.strftime('%Y-%m-%d') if self.startDatetime else 'Unknown',
             'end_date': self.endDatetime.strftime('%Y-%m-%d') if self.endDatetime else 'Active',
-            'tags': self.tags if hasattr(self, 'tags') else [],  # Ensure backward compatibility
-            'is_sold': self.is_sold if hasattr(self, 'is_sold') else False,  # Ensure backward compatibility
-            'selling_price': float(self.selling_price) if hasattr(self, 'selling_price') and self.selling_price is not None else None,
-            'profit': float(self.profit) if hasattr(self, 'profit') and self.profit is not None else None
+            'tags': self.tags,
+            'is_sold': self.is_sold,
+            'selling_price': float(self.selling_price) if self.selling_price is not None else None,
+            'profit': float(self.profit) if self.profit is not None else None
         }
 
         return result
 
 
+NEVER = np.iinfo(np.int64).max  # End date of investments that are still held
+HELD, SOLD, REMOVED = 0, 1, 2  # States of the rows of a HoldingsTable
+
+
+class HoldingsTable:
+    """Columnar store of a user's active and sold investments, one immutable snapshot per portfolio change
+
+    Row i holds the i-th investment added, state tells held, sold and removed investments apart and sold
+    investments are listed in the order they were sold. Dates are nanoseconds since the epoch in the
+    investments' wall time (NEVER for a missing end date), ticker is an index into tickers or -1 without
+    a ticker, currency is an index into currency_codes (the currency the cost and selling price are in)
+    and missing numbers are NaN. Current prices are not part of it, they come from the quotes of the
+    tickers.
+
+    UserProfile publishes every change as a new table in one assignment, so a reader never sees an
+    investment both held and sold, or listed but missing from the index. Adding writes the new rows past
+    the rows of the arrays this table shares with the next one, which this one never looks at, so it
+    takes amortized constant time; selling, replacing and removing copy the columns and update the
+    affected rows. Changing an older table than the latest copies everything first.
+    """
+
+    dtype = np.dtype([('shares', 'f8'), ('cost', 'f8'), ('purchase_price', 'f8'), ('value', 'f8'),
+                      ('selling_price', 'f8'), ('profit', 'f8'), ('start', 'i8'), ('end', 'i8'),
+                      ('ticker', 'i4'), ('currency', 'i4'), ('state', 'i1'), ('sold_seq', 'i8')])
+
+    def __init__(self, investments=(), sold_investments=()):
+        """Create a table from lists of active and sold investments, as stored in pickled sessions"""
+        self._objects = np.empty(0, dtype=object)
+        self._storage = np.zeros(0, dtype=self.dtype)
+        # Shared with later tables, which may add more entries than this table's counts cover
+        self._by_id = {}  # Investment id -> row
+        self._tickers = []
+        self._ticker_rows = {}
+        self._currency_codes = []
+        self._currency_rows = {}
+        self._cache = {}
+        self._latest = True
+        self.count = 0
+        self.ticker_count = 0
+        self.currency_count = 0
+        self.sold_count = 0
+        self.rows = self._storage
+        self._append(list(investments))
+        self._append(list(sold_investments), sold=True)
+
+    def _branch(self, copy_rows=False):
+        """Start the next table, sharing the arrays with this one unless copy_rows"""
+        branch = copy.copy(self)
+        branch._cache = {}
+        if not self._latest:
+            # The shared arrays and indexes may already hold entries of a later table
+            branch._by_id = {investment_id: row for investment_id, row in self._by_id.items() if row < self.count}
+            branch._tickers = self._tickers[:self.ticker_count]
+            branch._ticker_rows = {ticker_id: row for ticker_id, row in self._ticker_rows.items()
+                                   if row < self.ticker_count}
+            branch._currency_codes = self._currency_codes[:self.currency_count]
+            branch._currency_rows = {currency: row for currency, row in self._currency_rows.items()
+                                     if row < self.currency_count}
+            copy_rows = True
+        if copy_rows:
+            branch._objects = self._objects[:self.count].copy()
+            branch._storage = self._storage[:self.count].copy()
+            branch.rows = branch._storage
+        self._latest = False
+        return branch
+
+    def _append(self, investments, sold=False):
+        count, added = self.count, len(investments)
+        if not added:
+            return
+        if count + added > len(self._storage):
+            capacity = max(2 * len(self._storage), count + added, 16)
+            storage = np.zeros(capacity, dtype=self.dtype)
+            storage[:count] = self._storage[:count]
+            objects = np.empty(capacity, dtype=object)
+            objects[:count] = self._objects[:count]
+            self._storage, self._objects = storage, objects
+
+        ticker_column = []
+        currency_column = []
+        for row, investment in enumerate(investments, count):
+            # Investments bought in the same second share a timestamp based ID, keep IDs unique
+            investment.id = _unique_id(investment.id, self._by_id)
+            self._by_id[investment.id] = row
+            self._objects[row] = investment
+            ticker = investment.ticker
+            if ticker is None:
+                ticker_column.append(-1)
+            else:
+                ticker_row = self._ticker_rows.get(ticker.tickerId)
+                if ticker_row is None:
+                    ticker_row = self._ticker_rows[ticker.tickerId] = len(self._tickers)
+                    self._tickers.append(ticker)
+                ticker_column.append(ticker_row)
+            currency_row = self._currency_rows.get(investment.currency)
+            if currency_row is None:
+                currency_row = self._currency_rows[investment.currency] = len(self._currency_codes)
+                self._currency_codes.append(investment.currency)
+            currency_column.append(currency_row)
+
+        rows = self._storage[count:count + added]
+        rows['shares'] = [investment.numberOfShares or 0 for investment in investments]
+        rows['cost'] = [investment.initialInvestment or 0 for investment in investments]
+        rows['purchase_price'] = _floats([investment.purchasePrice for investment in investments])
+        rows['value'] = _floats([investment.currentValue for investment in investments])
+        rows['selling_price'] = _floats([investment.selling_price for investment in investments])
+        rows['profit'] = _floats([investment.profit for investment in investments])
+        rows['start'] = _wall_nanos([investment.startDatetime for investment in investments])
+        rows['end'] = _wall_nanos([investment.endDatetime for investment in investments])
+        rows['ticker'] = ticker_column
+        rows['currency'] = currency_column
+        rows['state'] = SOLD if sold else HELD
+        rows['sold_seq'] = np.arange(self.sold_count + 1, self.sold_count + added + 1) if sold else 0
+        if sold:
+            self.sold_count += added
+        self.count += added
+        self.ticker_count = len(self._tickers)
+        self.currency_count = len(self._currency_codes)
+        self.rows = self._storage[:self.count]
+
+    def with_added(self, investments):
+        """Get the table with the investments added as active investments, making their IDs unique"""
+        branch = self._branch()
+        branch._append(list(investments))
+        return branch
+
+    def with_sold(self, sales):
+        """Get the table with active investments replaced by their sold copies, sales lists (investment, sold) pairs"""
+        branch = self._branch(copy_rows=True)
+        rows = np.array([branch._by_id[investment.id] for investment, _ in sales], dtype=np.int64)
+        for row, (_, sold) in zip(rows, sales):
+            branch._objects[row] = sold
+        sold = [sold for _, sold in sales]
+        columns = branch.rows
+        columns['selling_price'][rows] = _floats([investment.selling_price for investment in sold])
+        columns['profit'][rows] = _floats([investment.profit for investment in sold])
+        columns['end'][rows] = _wall_nanos([investment.endDatetime for investment in sold])
+        columns['state'][rows] = SOLD
+        columns['sold_seq'][rows] = np.arange(branch.sold_count + 1, branch.sold_count + len(rows) + 1)
+        branch.sold_count += len(rows)
+        return branch
+
+    def with_replaced(self, replacements):
+        """Get the table with investments replaced by changed copies, replacements lists (investment, copy) pairs"""
+        branch = self._branch(copy_rows=True)
+        rows = np.array([branch._by_id[investment.id] for investment, _ in replacements], dtype=np.int64)
+        for row, (_, replacement) in zip(rows, replacements):
+            branch._objects[row] = replacement
+        branch.rows['value'][rows] = _floats([replacement.currentValue for _, replacement in replacements])
+        return branch
+
+    def with_removed(self, investment_id):
+        """Get the table without an active or sold investment"""
+        branch = self._branch(copy_rows=True)
+        # Free the ID for later investments, older tables keep their own index
+        branch._by_id = dict(branch._by_id)
+        row = branch._by_id.pop(investment_id)
+        branch._objects[row] = None
+        branch.rows['state'][row] = REMOVED
+        return branch
+
+    def get(self, investment_id):
+        """Get an active or sold investment by ID"""
+        row = self._by_id.get(investment_id)
+        if row is None or row >= self.count or self.rows['state'][row] == REMOVED:
+            return None
+        return self._objects[row]
+
+    def _cached(self, key, build):
+        value = self._cache.get(key)
+        if value is None:
+            value = self._cache[key] = build()
+        return value
+
+    @property
+    def held_index(self):
+        """Rows of the active investments, in the order they were added"""
+        return self._cached('held_index', lambda: np.flatnonzero(self.rows['state'] == HELD))
+
+    @property
+    def sold_index(self):
+        """Rows of the sold investments, in the order they were sold"""
+        def build():
+            rows = np.flatnonzero(self.rows['state'] == SOLD)
+            return rows[np.argsort(self.rows['sold_seq'][rows], kind='stable')]
+        return self._cached('sold_index', build)
+
+    @property
+    def investments(self):
+        return self._cached('investments', lambda: self._objects[self.held_index].tolist())
+
+    @property
+    def sold_investments(self):
+        return self._cached('sold_investments', lambda: self._objects[self.sold_index].tolist())
+
+    @property
+    def tickers(self):
+        """Distinct tickers of the investments, in the order they first appeared"""
+        return self._cached('tickers', lambda: self._tickers[:self.ticker_count])
+
+    @property
+    def currency_codes(self):
+        return self._cached('currency_codes', lambda: self._currency_codes[:self.currency_count])
+
+    def __len__(self):
+        return len(self.held_index) + len(self.sold_index)
+
+    def active_rows(self):
+        return self.rows[self.held_index]
+
+    def sold_rows(self):
+        return self.rows[self.sold_index]
+
+    def prices(self):
+        """Get the latest price of every ticker, NaN where none is known"""
+        tickers = self.tickers
+        prices = np.full(len(tickers), np.nan)
+        for index, ticker in enumerate(tickers):
+            price = ticker.get_last_quote()['price']
+            if price:
+                prices[index] = price
+        return prices
+
+    def currencies(self):
+        """Get the distinct currencies of the investments and their tickers"""
+        present = self.rows['state'] != REMOVED
+        currency_codes, tickers = self.currency_codes, self.tickers
+        currencies = {currency_codes[index] for index in np.unique(self.rows['currency'][present])}
+        ticker_rows = self.rows['ticker'][present]
+        currencies.update(tickers[index].currency for index in np.unique(ticker_rows[ticker_rows >= 0]))
+        currencies.discard(None)
+        return sorted(currencies)
+
+    def current_values(self, prices=None, fx_rates=None):
+        """Get the value of every row at the latest prices, or the stored value where there is no price
+
+        With fx_rates the values are converted into its base currency at the latest rates: values from a
+        price are in the currency of the ticker, stored values in the currency of the investment.
+        """
+        if prices is None:
+            prices = self.prices()
+        rows = self.rows
+        # Rows without a ticker index the extra NaN at the end
+        row_prices = np.append(prices, np.nan)[rows['ticker']]
+        priced = ~np.isnan(row_prices)
+        values = np.where(priced, rows['shares'] * row_prices, rows['value'])
+        if fx_rates is not None:
+            # One lookup for the currencies of the tickers and of the investments, most of them the same
+            tickers = self.tickers
+            rates = fx_rates.latest([ticker.currency for ticker in tickers] + self.currency_codes)
+            ticker_rates = np.append(rates[:len(tickers)], 1.0)
+            currency_rates = rates[len(tickers):]
+            values = values * np.where(priced, ticker_rates[rows['ticker']], currency_rates[rows['currency']])
+        return values
+
+    def _rates_on(self, fx_rates, dates):
+        """Get the rate of every row's currency on the day of the row in dates, one lookup per currency"""
+        rates = np.ones(len(self.rows))
+        for index, currency in enumerate(self.currency_codes):
+            rows = np.flatnonzero(self.rows['currency'] == index)
+            rates[rows] = fx_rates.on_days(currency, dates[rows])
+        return rates
+
+    def costs(self, fx_rates=None):
+        """Get the cost of every row, with fx_rates converted at the rates of the purchase dates"""
+        costs = self.rows['cost']
+        return costs if fx_rates is None else costs * self._rates_on(fx_rates, self.rows['start'])
+
+    def proceeds(self, fx_rates=None):
+        """Get the selling value of every row (NaN while held), with fx_rates converted at the rates of the sell dates"""
+        proceeds = self.rows['selling_price'] * self.rows['shares']
+        return proceeds if fx_rates is None else proceeds * self._rates_on(fx_rates, self.rows['end'])
+
+    def profits(self, fx_rates=None):
+        """Get the realized profit of every row (NaN while held), with fx_rates the converted proceeds minus cost"""
+        profits = self.rows['profit']
+        if fx_rates is None:
+            return profits
+        return np.where(np.isnan(profits), np.nan, self.proceeds(fx_rates) - self.costs(fx_rates))
+
+    def column(self, name, prices=None):
+        """Get a column for all rows, 'value' being the current value at the latest prices"""
+        return self.current_values(prices) if name == 'value' else self.rows[name]
+
+    def total_value(self, fx_rates=None):
+        return float(self.current_values(fx_rates=fx_rates)[self.held_index].sum())
+
+    def total_cost(self, fx_rates=None):
+        return float(self.costs(fx_rates)[self.held_index].sum())
+
+    def query(self, sold=False, ticker_id=None, sort=None, descending=False):
+        """Get the active or sold investments, optionally only those in one ticker and sorted by a column"""
+        rows = self.sold_index if sold else self.held_index
+        if ticker_id is not None:
+            index = self._ticker_rows.get(ticker_id)
+            if index is None or index >= self.ticker_count:
+                rows = rows[:0]
+            else:
+                rows = rows[self.rows['ticker'][rows] == index]
+        if sort is not None:
+            keys = self.column(sort)[rows]
+            # Negated keys keep equal rows in their order and missing values last in both directions
+            rows = rows[np.argsort(-keys if descending else keys, kind='stable')]
+        return self._objects[rows].tolist()
+
+
+def _floats(values):
+    return np.array([np.nan if value is None else value for value in values], dtype=float)
+
+
+def _wall_nanos(values):
+    """Nanoseconds since the epoch of datetimes in their own wall time, NEVER for None"""
+    nanos = np.array([np.datetime64('NaT') if value is None else value.replace(tzinfo=None) for value in values],
+                     dtype='datetime64[ns]').view(np.int64)
+    # NaT is the smallest int64
+    return np.where(nanos == np.iinfo(np.int64).min, NEVER, nanos)
+
+
 class UserProfile:
 
     def __init__(self, name):
         self.name = name
-        self.investments = []
-        self.sold_investments = []  # List to store sold investments
+        self._portfolio = HoldingsTable()  # Active and sold investments, replaced as a whole on every change
         self.id = f"user_{datetime.datetime.now().strftime('%Y%m%d%H%M%S')}_{name.replace(' ', '_')}"
         self.created_at = datetime.datetime.now()
         self.last_updated = self.created_at
         self.total_dividends = 0  # Total dividends not tied to any specific investment
+        self.base_currency = 'EUR'  # Currency the portfolio totals are converted into
+        self.version = 0  # Bumped on every change to the portfolio, used to invalidate cached summaries
+        self._summary_cache = None
+        self._journal = None  # Journal of the session this user belongs to, set by MainProgramData
+
+    def __getstate__(self):
+        """Pickle the user with lists of its investments and without caches, the portfolio is rebuilt when loading"""
+        state = self.__dict__.copy()
+        portfolio = state.pop('_portfolio')
+        state['investments'] = portfolio.investments
+        state['sold_investments'] = portfolio.sold_investments
+        state.pop('_summary_cache', None)
+        state.pop('_journal', None)
+        return state
+
+    def __setstate__(self, state):
+        state = dict(state)
+        # Older sessions may contain duplicate IDs, which could never be looked up separately
+        self._portfolio = HoldingsTable(state.pop('investments', []), state.pop('sold_investments', []))
+        state.pop('_holdings', None)
+        state.pop('_investments_by_id', None)
+        state.pop('_sold_investments_by_id', None)
+        self.__dict__.update(state)
+        # Ensure backward compatibility with older sessions
+        self.__dict__.setdefault('total_dividends', 0)
+        self.__dict__.setdefault('base_currency', 'EUR')
+        self.__dict__.setdefault('version', 0)
+        self._summary_cache = None
+        self._journal = None
+
+    @property
+    def investments(self):
+        """Active investments"""
+        return self._portfolio.investments
+
+    @property
+    def sold_investments(self):
+        """Sold investments, in the order they were sold"""
+        return self._portfolio.sold_investments
+
+    def _touch(self):
+        """Record a change to the portfolio"""
+        self.version += 1
+        self.last_updated = datetime.datetime.now()
+
+    def _record(self, op, **fields):
+        if self._journal is not None:
+            self._journal.append(op, user_id=self.id, **fields)
 
     def add_investment(self, ticker, initial_investment=1000, currency='EUR', number_of_shares=None, purchase_price=None, purchase_date=None, tags=None):
         """Add a new investment to the user's portfolio"""
+        # Looking up the purchase price may fetch data, so the investment is created before taking the write lock
         investment = Investment(ticker, initial_investment, currency, number_of_shares, purchase_price, purchase_date, tags)
-        self.investments.append(investment)
-        self.last_updated = datetime.datetime.now()
+        with write_lock:
+            self._insert_investment(investment)
+            self._record('add_investment', investment=_investment_state(investment))
         return investment
 
+    @_writer
+    def import_investments(self, investments, sales=(), dividends=0):
+        """Add many investments, sell investments and add dividends as one change to the portfolio
+
+        sales lists (investment, selling_price, sell_date) tuples for active or newly added investments.
+        The portfolio is published once for the whole batch instead of once per investment.
+        Returns the sold investments.
+        """
+        # Journaled once the batch is installed, a compaction triggered by the records snapshots all of it
+        records = []
+        portfolio = self._portfolio.with_added(investments)
+        for investment in investments:
+            records.append(('add_investment', {'investment': _investment_state(investment)}))
+
+        sold = {}
+        for investment, selling_price, sell_date in sales:
+            investment_id = investment.id
+            if investment_id in sold or portfolio.get(investment_id) is not investment:
+                continue
+            # Sell a copy, readers still holding the active investment keep seeing it unsold
+            sold_investment = copy.copy(investment)
+            sold_investment.sell(selling_price, sell_date)
+            sold[investment_id] = (investment, sold_investment)
+            records.append(('sell_investment', {'investment_id': investment_id, 'selling_price': selling_price,
+                                                'sell_date': sold_investment.endDatetime}))
+        if sold:
+            portfolio = portfolio.with_sold(list(sold.values()))
+
+        self._portfolio = portfolio
+        if dividends:
+            self.total_dividends = getattr(self, 'total_dividends', 0) + dividends
+            records.append(('add_total_dividend', {'amount': dividends, 'total_dividends': self.total_dividends}))
+        self._touch()
+        for op, fields in records:
+            self._record(op, **fields)
+        return [sold_investment for _, sold_investment in sold.values()]
+
+    def _insert_investment(self, investment):
+        self._portfolio = self._portfolio.with_added([investment])
+        self._touch()
+
+    @_writer
     def remove_investment(self, investment_id):
         """Remove an investment from the user's portfolio"""
-        for i, investment in enumerate(self.investments):
-            if investment.id == investment_id:
-                self.investments.pop(i)
-                self.last_updated = datetime.datetime.now()
-                return True
-        return False
+        if self.get_investment(investment_id) is None:
+            return False
+        self._portfolio = self._portfolio.with_removed(investment_id)
+        self._touch()
+        self._record('remove_investment', investment_id=investment_id)
+        return True
 
-    def get_investment(self, investment_id):
-        """Get an investment by ID"""
-        for investment in self.investments:
-            if investment.id == investment_id:
-                return investment
-        return None
+    def get_investment(self, investment_id, include_sold=False):
+        """Get an investment by ID, optionally also searching the sold investments"""
+        investment = self._portfolio.get(investment_id)
+        if investment is None or (investment.is_sold and not include_sold):
+            return None
+        return investment
+
+    def get_sold_investment(self, investment_id):
+        """Get a sold investment by ID"""
+        investment = self._portfolio.get(investment_id)
+        return investment if investment is not None and investment.is_sold else None
 
     def update_all_investments(self, force=False):
-        """Update data for all investments"""
-        for investment in self.investments:
-            investment.update_data(force=force)
+        """Update data for all investments, fetching each distinct ticker once and in parallel"""
+        results = refresh_tickers_concurrently([investment.ticker for investment in self.investments], force=force)
+        self.revalue_investments({ticker.tickerId: ticker.get_current_price() for ticker in self.get_holdings().tickers})
         self.last_updated = datetime.datetime.now()
+        return results
+
+    @_writer
+    def revalue_investments(self, prices):
+        """Publish copies of the active investments valued at prices, a dict mapping ticker IDs to prices
+
+        Values follow from the prices, so this is neither journaled nor a new portfolio version.
+        """
+        replacements = []
+        for investment in self._portfolio.investments:
+            price = prices.get(investment.ticker.tickerId) if investment.ticker else None
+            if price and investment.value_at(price) != investment.currentValue:
+                revalued = copy.copy(investment)
+                revalued.update_value(price)
+                replacements.append((investment, revalued))
+        if replacements:
+            self._portfolio = self._portfolio.with_replaced(replacements)
+
+    def get_holdings(self):
+        """Get the columnar table of the active and sold investments, the current snapshot of the portfolio"""
+        return self._portfolio
+
+    @_writer
+    def set_base_currency(self, currency):
+        """Set the currency the portfolio totals and history are converted into"""
+        self.base_currency = currency
+        self._touch()
+        self._record('set_base_currency', currency=currency)
+        return True
 
-    def get_total_value(self):
-        """Get the total current value of all investments"""
-        return sum(investment.currentValue for investment in self.investments)
+    def get_total_value(self, fx_rates=None):
+        """Get the total current value of all investments, converted into the base currency of fx_rates if given"""
+        return self.get_holdings().total_value(fx_rates)
 
-    def get_total_initial_investment(self):
-        """Get the total initial investment"""
-        return sum(investment.initialInvestment for investment in self.investments)
+    def get_total_initial_investment(self, fx_rates=None):
+        """Get the total initial investment, converted into the base currency of fx_rates if given"""
+        return self.get_holdings().total_cost(fx_rates)
 
-    def get_overall_performance(self):
+    def get_overall_performance(self, fx_rates=None):
         """Get the overall performance of the portfolio"""
-        total_initial = self.get_total_initial_investment()
+        total_initial = self.get_total_initial_investment(fx_rates)
         if total_initial > 0:
-            return (self.get_total_value() - total_initial) / total_initial * 100
+            return (self.get_total_value(fx_rates) - total_initial) / total_initial * 100
         return 0
 
+    def get_portfolio_history(self, days=None, fx_rates=None):
+        """Get the daily value of the portfolio across all held and sold positions
+
+        Returns a DataFrame indexed by calendar day with the columns 'total' (market value of the positions
+        held that day), 'unrealized' (that value minus their cost), 'realized' (cumulative profit of the
+        positions sold up to that day) and one column per ticker with the market value held in it.
+        A position counts from its start date until the day before it was sold.
+
+        With fx_rates all amounts are converted into its base currency: prices at the rate of each day,
+        costs and realized profits as in HoldingsTable.costs and HoldingsTable.profits.
+        """
+        holdings = self.get_holdings()
+        index = np.concatenate([holdings.held_index, holdings.sold_index])
+        rows = holdings.rows[index]
+        mask = (rows['ticker'] >= 0) & (rows['shares'] != 0)
+        positions = rows[mask]
+        if not len(positions):
+            return pd.DataFrame()
+
+        # Align the closing prices of every ticker on one calendar of trading days
+        held_tickers, ticker_index = np.unique(positions['ticker'], return_inverse=True)
+        tickers = [holdings.tickers[index] for index in held_tickers]
+        ticker_ids = [ticker.tickerId for ticker in tickers]
+        closes = []
+        for ticker in tickers:
+            prices = ticker.closingPrices
+            if prices.empty:
+                closes.append((np.array([], dtype=np.int64), np.array([])))
+                continue
+            ticker_days = _naive_days(prices.index).as_unit('ns').asi8
+            closes.append((ticker_days, prices['Close'].to_numpy(dtype=float)))
+        all_days = [ticker_days for ticker_days, _ in closes if len(ticker_days)]
+        if not all_days:
+            return pd.DataFrame()
+        dates = np.unique(np.concatenate(all_days))
+
+        start = positions['start'] // NANOS_PER_DAY * NANOS_PER_DAY
+        dates = dates[dates >= start.min()]
+        if days is not None:
+            dates = dates[-days:]
+        if len(dates) == 0:
+            return pd.DataFrame()
+
+        # Price matrix (tickers x days), forward-filling days on which a ticker did not trade
+        price_matrix = np.zeros((len(ticker_ids), len(dates)))
+        for row, (ticker_days, ticker_closes) in enumerate(closes):
+            if len(ticker_days) == 0:
+                continue
+            order = np.argsort(ticker_days, kind='stable')
+            ticker_days, ticker_closes = ticker_days[order], ticker_closes[order]
+            positions_asof = np.searchsorted(ticker_days, dates, side='right') - 1
+            price_matrix[row] = np.where(positions_asof >= 0, ticker_closes[np.maximum(positions_asof, 0)], 0.0)
+        price_matrix = np.nan_to_num(price_matrix)
+        if fx_rates is not None:
+            # Convert every price on every day with one multiply by the aligned rates of the tickers' currencies
+            price_matrix *= fx_rates.daily([ticker.currency for ticker in tickers], dates)
+
+        # Share-count masks from the buy and sell dates (positions x days)
+        shares = positions['shares']
+        cost = holdings.costs(fx_rates)[index][mask]
+        sold = positions['state'] == SOLD
+        end = np.where(positions['end'] == NEVER, NEVER, positions['end'] // NANOS_PER_DAY * NANOS_PER_DAY)
+        profit = np.nan_to_num(holdings.profits(fx_rates)[index][mask])
+
+        held = (dates[None, :] >= start[:, None]) & (dates[None, :] < end[:, None])
+        values = held * shares[:, None] * price_matrix[ticker_index]
+        per_ticker = np.zeros((len(ticker_ids), len(dates)))
+        np.add.at(per_ticker, ticker_index, values)
+        total = values.sum(axis=0)
+        unrealized = total - (held * cost[:, None]).sum(axis=0)
+        realized = ((dates[None, :] >= end[:, None]) & sold[:, None]).astype(float).T @ profit
+
+        history = pd.DataFrame(per_ticker.T, index=pd.DatetimeIndex(dates.astype('datetime64[ns]')), columns=ticker_ids)
+        history.insert(0, 'realized', realized)
+        history.insert(0, 'unrealized', unrealized)
+        history.insert(0, 'total', total)
+        return history
+
+    @_writer
     def sell_investment(self, investment_id, selling_price, sell_date=None):
         """Sell an investment and move it to sold_investments"""
-        # Ensure backward compatibility with older sessions
-        if not hasattr(self, 'sold_investments'):
-            self.sold_investments = []
-
-        for i, investment in enumerate(self.investments):
-            if investment.id == investment_id:
-                # Sell the investment
-                if investment.sell(selling_price, sell_date):
-                    # Move to sold investments
-                    self.sold_investments.append(investment)
-                    self.investments.pop(i)
-                    self.last_updated = datetime.datetime.now()
-                    return True
-                return False
+        investment = self.get_investment(investment_id)
+        if investment is None:
+            return False
+
+        # Sell a copy, readers still holding the active investment keep seeing it unsold
+        sold = copy.copy(investment)
+        if sold.sell(selling_price, sell_date):
+            self._portfolio = self._portfolio.with_sold([(investment, sold)])
+            self._touch()
+            self._record('sell_investment', investment_id=investment_id, selling_price=selling_price,
+                         sell_date=sold.endDatetime)
+            return True
         return False
 
+    @_writer
+    def update_investment_tags(self, investment_id, tags):
+        """Replace the tags of an investment"""
+        investment = self.get_investment(investment_id, include_sold=True)
+        if investment is None:
+            return False
+        # Change a copy, readers still holding the investment keep seeing the old tags
+        tagged = copy.copy(investment)
+        tagged.tags = tags
+        self._portfolio = self._portfolio.with_replaced([(investment, tagged)])
+        self._touch()
+        self._record('update_investment_tags', investment_id=investment_id, tags=tags)
+        return True
+
     def get_investments_summary(self):
         """Get a summary of all active investments"""
-        return [investment.to_dict() for investment in self.investments]
+        return self.get_profile_summary()['investments']
 
     def get_sold_investments_summary(self):
         """Get a summary of all sold investments"""
-        return [investment.to_dict() for investment in self.sold_investments]
+        return self.get_profile_summary()['sold_investments']
+
+    def get_summary_version(self, fx_rates=None):
+        """Get a key that changes whenever the portfolio, the price data of one of its tickers or the FX rates change
+
+        The price frames are loaded first, so loading them lazily afterwards does not change the key.
+        """
+        version = self.version
+        held_tickers = self._get_held_tickers()
+        for ticker in held_tickers + (list(fx_rates.tickers.values()) if fx_rates is not None else []):
+            ticker.get_frames()
+        version = (version,) + tuple((ticker.tickerId, ticker.data_version) for ticker in held_tickers)
+        return version if fx_rates is None else version + (fx_rates.version(),)
+
+    def _get_held_tickers(self):
+        """Get the distinct tickers of all active and sold investments, cached per portfolio version"""
+        return self.get_holdings().tickers
+
+    def get_profile_summary(self, fx_rates=None):
+        """Get the investment summaries and portfolio totals shown on the profile page
+
+        With fx_rates the totals are converted into its base currency, the investment summaries stay in
+        their own currencies. The result is cached until the portfolio changes, one of its tickers gets new
+        price data or the FX rates change.
+        """
+        version = self.get_summary_version(fx_rates)
+        hit = self._summary_cache is not None and self._summary_cache[0] == version
+        metrics.record_cache('profile_summary', hit)
+        if hit:
+            return self._summary_cache[1]
+
+        # The summaries and totals all come from one snapshot of the portfolio
+        holdings = self.get_holdings()
+
+        # One quote snapshot per ticker instead of looking up the latest price for every investment
+        quotes = {ticker.tickerId: ticker.get_last_quote() for ticker in holdings.tickers}
+        investments = []
+        for investment in holdings.investments:
+            quote = quotes.get(investment.ticker.tickerId) if investment.ticker else None
+            investments.append(investment.to_dict(quote))
+        sold_investments = [investment.to_dict(quotes.get(investment.ticker.tickerId) if investment.ticker else None)
+                            for investment in holdings.sold_investments]
+
+        # Calculate portfolio metrics for active investments
+        total_value = holdings.total_value(fx_rates)
+        total_initial = holdings.total_cost(fx_rates)
+        overall_performance = (total_value - total_initial) / total_initial * 100 if total_initial > 0 else 0
+
+        # Calculate metrics for sold investments
+        sold = holdings.sold_index
+        total_sold_value = float(np.nansum(holdings.proceeds(fx_rates)[sold]))
+        total_sold_initial = float(holdings.costs(fx_rates)[sold].sum())
+        total_sold_profit = float(np.nansum(holdings.profits(fx_rates)[sold]))
+        sold_performance = (total_sold_profit / total_sold_initial) * 100 if total_sold_initial > 0 else 0
+
+        summary = {
+            'investments': investments,
+            'sold_investments': sold_investments,
+            'total_value': total_value,
+            'total_initial': total_initial,
+            'overall_performance': overall_performance,
+            'total_sold_value': total_sold_value,
+            'total_sold_initial': total_sold_initial,
+            'total_sold_profit': total_sold_profit,
+            'sold_performance': sold_performance,
+            'total_dividends': self.total_dividends,
+            'base_currency': fx_rates.base_currency if fx_rates is not None else None,
+            'unconverted_currencies': fx_rates.unavailable(holdings.currencies()) if fx_rates is not None else [],
+            'quotes': {ticker_id: {'price': float(quote['price']) if quote['price'] is not None else None,
+                                   'as_of': quote['as_of']}
+                       for ticker_id, quote in quotes.items()}
+        }
+        # Stored under the version taken before building, data published meanwhile is at least as new as the
+        # key and only causes a rebuild on the next call
+        self._summary_cache = (version, summary)
+        return summary
 
+    @_writer
     def remove_sold_investment(self, investment_id):
         """Remove a sold investment from the user's portfolio"""
-        for i, investment in enumerate(self.sold_investments):
-            if investment.id == investment_id:
-                self.sold_investments.pop(i)
-                self.last_updated = datetime.datetime.now()
-                return True
-        return False
+        if self.get_sold_investment(investment_id) is None:
+            return False
+        self._portfolio = self._portfolio.with_removed(investment_id)
+        self._touch()
+        self._record('remove_sold_investment', investment_id=investment_id)
+        return True
 
+    @_writer
     def add_total_dividend(self, amount, date=None):
         """Add a dividend to the total, not tied to any specific investment"""
         # Ensure backward compatibility with older sessions
@@ -522,5 +1944,6 @@ class UserProfile:
 
         # Add the amount to the total
         self.total_dividends += amount
-        self.last_updated = datetime.datetime.now()
+        self._touch()
+        self._record('add_total_dividend', amount=amount, total_dividends=self.total_dividends)
         return True
@@ -0,0 +1,99 @@
+import numpy as np
+
+NANOS_PER_DAY = 24 * 60 * 60 * 10**9
+
+# Currencies some exchanges quote prices in, as (currency, amount of it per quoted unit)
+SUBUNITS = {'GBp': ('GBP', 0.01), 'GBX': ('GBP', 0.01), 'ZAc': ('ZAR', 0.01), 'ILA': ('ILS', 0.01)}
+
+
+def main_unit(currency):
+    """Split a currency code into its main currency and the factor converting amounts into it"""
+    return SUBUNITS.get(currency, (currency, 1.0))
+
+
+def fx_ticker_id(currency, base_currency):
+    """Yahoo Finance symbol of the exchange rate converting currency into base_currency, e.g. USDEUR=X"""
+    return f"{currency}{base_currency}=X"
+
+
+class FxRates:
+    """Exchange rates from any number of currencies into one base currency
+
+    tickers maps currency codes to the FX ticker quoting their rate in the base currency (see fx_ticker_id),
+    which are tracked and refreshed like any other ticker. Rates are looked up once per distinct currency
+    and returned as arrays, so whole columns and series are converted with one multiply. Amounts in a
+    currency without a known rate (no FX ticker, or no data yet) are left unconverted, see unavailable().
+    """
+
+    def __init__(self, base_currency, tickers):
+        self.base_currency = base_currency
+        self.tickers = tickers
+
+    def version(self):
+        """Key that changes with the base currency and with the price data of the FX tickers"""
+        return (self.base_currency,) + tuple(sorted((currency, ticker.data_version)
+                                                    for currency, ticker in self.tickers.items()))
+
+    def _ticker(self, currency):
+        """Get the FX ticker and factor for a currency, or (None, factor) if no conversion is needed or known"""
+        code, factor = main_unit(currency)
+        if code is None or code == self.base_currency:
+            return None, factor
+        ticker = self.tickers.get(code)
+        if ticker is None or ticker.closingPrices.empty:
+            return None, 1.0
+        return ticker, factor
+
+    def unavailable(self, currencies):
+        """Get the currencies that cannot be converted into the base currency yet"""
+        missing = set()
+        for currency in currencies:
+            code = main_unit(currency)[0]
+            if code is not None and code != self.base_currency and self._ticker(currency)[0] is None:
+                missing.add(code)
+        return sorted(missing)
+
+    def latest(self, currencies):
+        """Get the latest rate of each currency, aligned with currencies, looking up each distinct currency once"""
+        known = {}
+        rates = np.ones(len(currencies))
+        for position, currency in enumerate(currencies):
+            if currency not in known:
+                ticker, factor = self._ticker(currency)
+                quote = ticker.get_last_quote() if ticker is not None else None
+                known[currency] = factor * quote['price'] if quote and quote['price'] else factor
+            rates[position] = known[currency]
+        return rates
+
+    def on_days(self, currency, nanos):
+        """Get the rate of one currency on each day, given as nanoseconds since the epoch in wall time
+
+        The last close on or before the day is used, or the earliest close for days before all data.
+        """
+        nanos = np.asarray(nanos, dtype=np.int64)
+        ticker, factor = self._ticker(currency)
+        if ticker is None:
+            return np.full(len(nanos), factor)
+        days, closes = _daily_closes(ticker)
+        positions = np.searchsorted(days, nanos // NANOS_PER_DAY * NANOS_PER_DAY, side='right') - 1
+        return closes[np.maximum(positions, 0)] * factor
+
+    def daily(self, currencies, days):
+        """Get a matrix of rates with one row per currency and one column per day, see on_days"""
+        rows = {}
+        matrix = np.empty((len(currencies), len(days)))
+        for position, currency in enumerate(currencies):
+            if currency not in rows:
+                rows[currency] = self.on_days(currency, days)
+            matrix[position] = rows[currency]
+        return matrix
+
+
+def _daily_closes(ticker):
+    """Calendar days (nanoseconds in the ticker's wall time) and closing prices of a ticker, sorted by day"""
+    prices = ticker.closingPrices
+    index = prices.index if prices.index.tz is None else prices.index.tz_localize(None)
+    days = index.normalize().as_unit('ns').asi8
+    closes = prices['Close'].to_numpy(dtype=float)
+    order = np.argsort(days, kind='stable')
+    return days[order], closes[order]
@@ -0,0 +1,387 @@
+import argparse
+import bisect
+import copy
+import csv
+import datetime
+import itertools
+import math
+import re
+import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from classes import Investment, MainProgramData, Ticker
+
+BUY = 'buy'
+SELL = 'sell'
+DIVIDEND = 'dividend'
+
+# Normalized header names used by common broker exports, mapped to the field they hold
+COLUMN_ALIASES = {
+    'date': 'date', 'trade date': 'date', 'transaction date': 'date', 'datetime': 'date', 'time': 'date',
+    'type': 'type', 'action': 'type', 'transaction': 'type', 'transaction type': 'type', 'side': 'type',
+    'ticker': 'ticker', 'symbol': 'ticker', 'ticker symbol': 'ticker', 'instrument': 'ticker',
+    'shares': 'shares', 'quantity': 'shares', 'qty': 'shares', 'units': 'shares', 'number of shares': 'shares',
+    'price': 'price', 'price per share': 'price', 'unit price': 'price', 'share price': 'price',
+    'amount': 'amount', 'total': 'amount', 'value': 'amount', 'net amount': 'amount',
+    'currency': 'currency',
+    'tags': 'tags',
+}
+REQUIRED_COLUMNS = ('date', 'type', 'ticker')
+
+TYPE_ALIASES = {
+    'buy': BUY, 'bought': BUY, 'purchase': BUY,
+    'sell': SELL, 'sold': SELL, 'sale': SELL,
+    'dividend': DIVIDEND, 'dividends': DIVIDEND, 'div': DIVIDEND, 'cash dividend': DIVIDEND,
+}
+
+# Tried after ISO 8601, day first like most European brokers
+DATE_FORMATS = [date_format + time_format
+                for date_format in ('%d.%m.%Y', '%d/%m/%Y', '%d-%m-%Y', '%Y/%m/%d')
+                for time_format in ('', ' %H:%M', ' %H:%M:%S')]
+
+# Share counts closer than this are treated as equal when matching sells against held investments
+SHARE_TOLERANCE = 1e-6
+
+PROGRESS_EVERY = 1000  # Rows between progress reports while reading
+
+
+class Transaction:
+    """One parsed row of a transaction export"""
+
+    def __init__(self, line, kind, date, ticker_id, shares=None, price=None, amount=None, currency=None, tags=None):
+        self.line = line
+        self.kind = kind
+        self.date = date
+        self.ticker_id = ticker_id
+        self.shares = shares
+        self.price = price
+        self.amount = amount
+        self.currency = currency
+        self.tags = tags or []
+
+
+class ImportResult:
+    """Outcome of an import, with the rows that could not be imported as (line, message) pairs"""
+
+    def __init__(self):
+        self.rows = 0
+        self.investments = []
+        self.sold = []
+        self.dividends = 0.0
+        self.dividend_rows = 0
+        self.fetched_tickers = []
+        self.errors = []
+
+    def error(self, line, message):
+        self.errors.append((line, message))
+
+    def summary(self):
+        summary = (f"Imported {self.rows - len(self.errors)} of {self.rows} rows: "
+                   f"{len(self.investments)} investments added, {len(self.sold)} sold, "
+                   f"{self.dividend_rows} dividends totalling {self.dividends:.2f}")
+        if self.fetched_tickers:
+            summary += f", {len(self.fetched_tickers)} new tickers"
+        return summary
+
+
+def import_transactions(program_data, user, file, progress=None):
+    """Import the buys, sells and dividends of a CSV transaction export into a user's portfolio
+
+    file is a text file object, read row by row. Rows are grouped by ticker: every ticker that is not
+    tracked yet is fetched once, concurrently, and the missing prices of all rows of a ticker are looked
+    up in one as-of pass over its history. Sells are matched first in, first out against the investments
+    held on the sell date; an investment bought in the same import can be sold in part, an existing one
+    only as a whole. Dividends are added to the user's total.
+
+    Everything is committed to the user in one change. Rows that cannot be imported are skipped and listed
+    in the errors of the returned ImportResult. progress, if given, is called as progress(phase, done, total)
+    for the phases 'read' (total None), 'fetch', 'resolve' and 'commit'.
+    """
+    result = ImportResult()
+    report = progress or (lambda phase, done, total: None)
+
+    # Read and group the rows by ticker, dividends only need their amount
+    by_ticker = {}
+    for transaction in read_transactions(file, result, report):
+        if transaction.kind == DIVIDEND:
+            result.dividends += transaction.amount
+            result.dividend_rows += 1
+        else:
+            by_ticker.setdefault(transaction.ticker_id, []).append(transaction)
+
+    tickers = _fetch_tickers(program_data, list(by_ticker), result, report,
+                             max_workers=getattr(program_data, 'refresh_workers', 8))
+
+    # Existing investments per ticker, the oldest first so sells consume them first in, first out
+    held = {}
+    for investment in user.get_holdings().query(sort='start'):
+        if investment.ticker is not None and investment.ticker.tickerId in by_ticker:
+            held.setdefault(investment.ticker.tickerId, []).append(investment)
+
+    investments = []
+    sales = []
+    for done, (ticker_id, transactions) in enumerate(by_ticker.items(), start=1):
+        ticker = tickers.get(ticker_id)
+        if ticker is None:
+            for transaction in transactions:
+                result.error(transaction.line, f"Could not find ticker {ticker_id}")
+        else:
+            added = _build_investments(ticker, transactions, held.get(ticker_id, []), sales, result)
+            if added:
+                # One quote for all new investments of the ticker
+                quote = ticker.get_last_quote()
+                for investment in added:
+                    investment.update_value(quote['price'] if quote else None)
+                investments.extend(added)
+        report('resolve', done, len(by_ticker))
+
+    report('commit', 0, 1)
+    if investments or sales or result.dividends:
+        result.sold = user.import_investments(investments, sales, result.dividends)
+    result.investments = investments
+    result.errors.sort(key=lambda error: error[0])
+    report('commit', 1, 1)
+    return result
+
+
+def read_transactions(file, result, report):
+    """Parse the rows of a CSV export one at a time, counting them in result and recording bad rows"""
+    header_line = file.readline()
+    if not header_line.strip():
+        raise ValueError("The file is empty")
+    # Exports from European brokers often separate columns with semicolons
+    delimiter = max((',', ';', '\t'), key=header_line.count)
+    reader = csv.reader(itertools.chain([header_line], file), delimiter=delimiter)
+    columns = {}
+    for position, name in enumerate(next(reader)):
+        field = COLUMN_ALIASES.get(_normalize(name))
+        if field is not None:
+            columns.setdefault(field, position)
+    missing = [field for field in REQUIRED_COLUMNS if field not in columns]
+    if missing:
+        raise ValueError(f"Missing columns: {', '.join(missing)}")
+
+    for row in reader:
+        if not any(value.strip() for value in row):
+            continue
+        result.rows += 1
+        values = {field: row[position].strip() if position < len(row) else '' for field, position in columns.items()}
+        try:
+            yield _parse_row(reader.line_num, values)
+        except ValueError as e:
+            result.error(reader.line_num, str(e))
+        if result.rows % PROGRESS_EVERY == 0:
+            report('read', result.rows, None)
+    report('read', result.rows, None)
+
+
+def _parse_row(line, values):
+    kind = TYPE_ALIASES.get(_normalize(values['type']))
+    if kind is None:
+        raise ValueError(f"Unknown transaction type '{values['type']}'")
+    ticker_id = values['ticker'].upper()
+    if not ticker_id:
+        raise ValueError("Missing ticker")
+    date = parse_date(values['date'])
+    # Brokers list sells and fees with negative quantities or amounts
+    shares, price, amount = (_abs(parse_number(values.get(field, ''))) for field in ('shares', 'price', 'amount'))
+    tags = [tag.strip() for tag in re.split(r'[,;|]', values.get('tags', '')) if tag.strip()]
+
+    if kind == DIVIDEND:
+        if amount is None and shares and price:
+            amount = shares * price
+        if not amount:
+            raise ValueError("Dividend without an amount")
+    elif not shares and not amount:
+        raise ValueError(f"{kind.capitalize()} without shares or an amount")
+    elif price is None and shares and amount:
+        price = amount / shares
+    return Transaction(line, kind, date, ticker_id, shares, price, amount, values.get('currency') or None, tags)
+
+
+def parse_date(value):
+    """Parse an ISO 8601 or day first date, with an optional time, into a naive datetime"""
+    value = value.strip()
+    try:
+        # Keep the wall time of aware timestamps, investments use naive datetimes
+        return datetime.datetime.fromisoformat(value).replace(tzinfo=None)
+    except ValueError:
+        pass
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, date_format)
+        except ValueError:
+            continue
+    raise ValueError(f"Invalid date '{value}'")
+
+
+def parse_number(value):
+    """Parse a number written with either decimal separator, or return None if the value is empty
+
+    The separator that comes last is the decimal separator, a lone comma is taken as one.
+    """
+    value = re.sub(r'[^0-9,.\-]', '', value)
+    if not value.strip('-'):
+        return None
+    if ',' in value and ('.' not in value or value.rfind(',') > value.rfind('.')):
+        value = value.replace('.', '').replace(',', '.')
+    else:
+        value = value.replace(',', '')
+    try:
+        number = float(value)
+    except ValueError:
+        raise ValueError(f"Invalid number '{value}'") from None
+    if not math.isfinite(number):
+        raise ValueError(f"Invalid number '{value}'")
+    return number
+
+
+def _abs(number):
+    return abs(number) if number is not None else None
+
+
+def _normalize(name):
+    return re.sub(r'[\s_]+', ' ', name.strip().lstrip('\ufeff')).lower()
+
+
+def _fetch_tickers(program_data, ticker_ids, result, report, max_workers=8):
+    """Get the tickers, fetching the ones that are not tracked yet once each and in parallel"""
+    tickers = {ticker_id: program_data.get_ticker(ticker_id) for ticker_id in ticker_ids}
+    missing = [ticker_id for ticker_id, ticker in tickers.items() if ticker is None]
+    report('fetch', 0, len(missing))
+    if not missing:
+        return tickers
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(missing)))) as executor:
+        futures = {executor.submit(_fetch_ticker, program_data, ticker_id): ticker_id for ticker_id in missing}
+        for done, future in enumerate(as_completed(futures), start=1):
+            ticker_id = futures[future]
+            try:
+                tickers[ticker_id] = future.result()
+                result.fetched_tickers.append(ticker_id)
+            except Exception as e:
+                print(f"Error fetching {ticker_id}: {e}")
+            report('fetch', done, len(missing))
+    return tickers
+
+
+def _fetch_ticker(program_data, ticker_id):
+    """Fetch a ticker and track it, raising LookupError without tracking it if Yahoo Finance has no prices for it"""
+    # Ticker catches fetch errors itself, an unknown symbol just ends up without data
+    ticker = Ticker(ticker_id)
+    if ticker.last_updated is None or ticker.closingPrices.empty:
+        raise LookupError(f"No price data for {ticker_id}")
+    return program_data.track_ticker(ticker)
+
+
+def _build_investments(ticker, transactions, held, sales, result):
+    """Turn the buys and sells of one ticker into new investments and sales, in date order
+
+    held lists the existing investments in the ticker, oldest first. Sales are appended to sales, the
+    new investments (including the parts of new investments that are sold again) are returned.
+    """
+    # All missing prices of the ticker in one vectorized lookup
+    pending = [transaction for transaction in transactions if transaction.price is None]
+    if pending:
+        prices = ticker.get_prices_at_dates([transaction.date for transaction in pending])
+        for transaction, price in zip(pending, prices):
+            if not math.isnan(price) and price > 0:
+                transaction.price = float(price)
+
+    # Buys before sells on the same date, otherwise the order of the file
+    transactions = sorted(transactions, key=lambda transaction: (transaction.date, transaction.kind != BUY,
+                                                                 transaction.line))
+    lots = list(held)
+    new = set()
+    investments = []
+    for transaction in transactions:
+        if transaction.price is None:
+            result.error(transaction.line, f"No price for {ticker.tickerId} on {transaction.date:%Y-%m-%d}")
+            continue
+        shares = transaction.shares if transaction.shares else transaction.amount / transaction.price
+
+        if transaction.kind == BUY:
+            investment = Investment(ticker, transaction.amount or shares * transaction.price,
+                                    transaction.currency or ticker.currency, shares, transaction.price,
+                                    transaction.date, transaction.tags, refresh=False)
+            bisect.insort(lots, investment, key=lambda lot: lot.startDatetime)
+            new.add(id(investment))
+            investments.append(investment)
+            continue
+
+        # Plan the sell before changing anything, so a row that cannot be matched leaves the lots alone
+        remaining = shares
+        whole = []
+        split = None
+        for lot in lots:
+            if remaining <= SHARE_TOLERANCE:
+                break
+            if lot.startDatetime > transaction.date:
+                continue
+            if lot.numberOfShares <= remaining + SHARE_TOLERANCE:
+                whole.append(lot)
+                remaining -= lot.numberOfShares
+            else:
+                split = lot
+                break
+        if split is not None and id(split) not in new:
+            result.error(transaction.line, f"Selling {shares:g} shares of {ticker.tickerId} would split the "
+                                           f"existing investment {split.id}, which can only be sold as a whole")
+            continue
+        if split is None and remaining > SHARE_TOLERANCE:
+            result.error(transaction.line, f"Selling {shares:g} shares of {ticker.tickerId}, but only "
+                                           f"{shares - remaining:g} were held on {transaction.date:%Y-%m-%d}")
+            continue
+
+        for lot in whole:
+            lots.remove(lot)
+            sales.append((lot, transaction.price, transaction.date))
+        if split is not None:
+            # Sell part of an investment from this import by splitting off the sold shares
+            sold = copy.copy(split)
+            sold.tags = list(split.tags)
+            sold.numberOfShares = remaining
+            sold.initialInvestment = split.initialInvestment * remaining / split.numberOfShares
+            sold.currentValue = split.currentValue * remaining / split.numberOfShares
+            split.numberOfShares -= remaining
+            split.initialInvestment -= sold.initialInvestment
+            split.currentValue -= sold.currentValue
+            investments.append(sold)
+            sales.append((sold, transaction.price, transaction.date))
+    return investments
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Import a CSV transaction export into a user of a saved session")
+    parser.add_argument('session_id')
+    parser.add_argument('user', help='user ID or name')
+    parser.add_argument('file', help='CSV file with date, type, ticker, shares, price and amount columns')
+    args = parser.parse_args(argv)
+
+    program_data = MainProgramData().load_saved_data(args.session_id)
+    if program_data is None:
+        print(f"Session {args.session_id} not found", file=sys.stderr)
+        return 1
+    try:
+        user = program_data.get_user_by_id(args.user) or program_data.get_user(args.user)
+        if user is None:
+            print(f"User {args.user} not found", file=sys.stderr)
+            return 1
+
+        def progress(phase, done, total):
+            print(f"{phase}: {done}" + (f"/{total}" if total is not None else ''), file=sys.stderr)
+
+        with open(args.file, encoding='utf-8-sig', newline='') as f:
+            result = import_transactions(program_data, user, f, progress)
+        program_data.save_program_data(args.session_id)
+    finally:
+        program_data.close_journal()
+
+    print(result.summary())
+    for line, message in result.errors:
+        print(f"line {line}: {message}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,128 @@
+import datetime
+import json
+import os
+import threading
+
+import numpy as np
+
+
+class Journal:
+    """Append-only log of session mutations, stored as one JSON record per line
+
+    Every record gets a sequence number. Records are written to the file immediately, but fsync is
+    batched: a background thread syncs at most every sync_interval seconds, and sync() forces it.
+    Once compact_every records have been appended since the last snapshot, on_compact is called so
+    the owner can write a snapshot and truncate the journal up to it.
+    """
+
+    def __init__(self, path, start_seq=0, sync_interval=1.0, compact_every=500, on_compact=None):
+        self.path = path
+        self.sync_interval = sync_interval
+        self.compact_every = compact_every
+        self.on_compact = on_compact
+        self.last_seq = start_seq
+        self.snapshot_seq = start_seq
+        for record in read_journal(path):
+            self.last_seq = max(self.last_seq, record['seq'])
+        self._file = None
+        self._dirty = False
+        self._closed = threading.Event()
+        self._lock = threading.Lock()
+        self._sync_thread = None
+
+    def append(self, op, **fields):
+        """Append a record and return its sequence number"""
+        with self._lock:
+            if self._closed.is_set():
+                raise ValueError(f"Journal {self.path} is closed")
+            self.last_seq += 1
+            record = {'seq': self.last_seq, 'op': op, 'time': datetime.datetime.now()}
+            record.update(fields)
+            if self._file is None:
+                self._file = open(self.path, 'a', encoding='utf-8')
+            self._file.write(json.dumps(record, default=_encode_value) + '\n')
+            self._file.flush()
+            self._dirty = True
+            if self._sync_thread is None:
+                self._sync_thread = threading.Thread(target=self._sync_loop, name='journal-sync', daemon=True)
+                self._sync_thread.start()
+            seq = self.last_seq
+            compact = self.on_compact is not None and seq - self.snapshot_seq >= self.compact_every
+
+        if compact:
+            self.on_compact()
+        return seq
+
+    def sync(self):
+        """Make all appended records durable"""
+        with self._lock:
+            if self._dirty and self._file is not None:
+                os.fsync(self._file.fileno())
+                self._dirty = False
+
+    def truncate(self, seq):
+        """Drop the records up to and including seq, after they were written to a snapshot"""
+        with self._lock:
+            kept = [record for record in read_journal(self.path) if record['seq'] > seq]
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            temp_path = self.path + '.tmp'
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                for record in kept:
+                    f.write(json.dumps(record, default=_encode_value) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, self.path)
+            self._dirty = False
+            self.snapshot_seq = max(self.snapshot_seq, seq)
+
+    def close(self):
+        """Sync outstanding records and stop the background sync thread"""
+        self.sync()
+        with self._lock:
+            self._closed.set()
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def _sync_loop(self):
+        while not self._closed.wait(self.sync_interval):
+            self.sync()
+
+
+def read_journal(path, after_seq=0):
+    """Read the records with a sequence number above after_seq
+
+    A partially written last line, left behind by a crash, is ignored.
+    """
+    if not os.path.exists(path):
+        return []
+    records = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line, object_hook=_decode_value)
+            except ValueError:
+                break
+            if record['seq'] > after_seq:
+                records.append(record)
+    return records
+
+
+def _encode_value(value):
+    if isinstance(value, datetime.datetime):
+        return {'__datetime__': value.isoformat()}
+    if isinstance(value, datetime.date):
+        return {'__date__': value.isoformat()}
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"Cannot store {type(value).__name__} in the journal")
+
+
+def _decode_value(value):
+    if '__datetime__' in value:
+        return datetime.datetime.fromisoformat(value['__datetime__'])
+    if '__date__' in value:
+        return datetime.date.fromisoformat(value['__date__'])
+    return value
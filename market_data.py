@@ -0,0 +1,436 @@
+import heapq
+import itertools
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+import pandas as pd
+
+import metrics
+
+PROVIDER_ENV = 'INVESTMENT_TRACKER_MARKET_DATA'  # 'yfinance' (default), 'record:<dir>' or 'replay:<dir>'
+REPLAY_LATENCY_ENV = 'INVESTMENT_TRACKER_REPLAY_LATENCY'  # Seconds added to every replayed call
+RATE_ENV = 'INVESTMENT_TRACKER_MARKET_DATA_RATE'  # Calls per second to the provider, 0 to disable limiting
+BURST_ENV = 'INVESTMENT_TRACKER_MARKET_DATA_BURST'  # Calls that may go out at once after a quiet period
+
+# A refresh cycle makes two history calls per ticker, the burst lets one for a few dozen tickers go out at once
+DEFAULT_RATE = 5.0
+DEFAULT_BURST = 60
+
+# Request priorities, lower values are served first
+INTERACTIVE = 0  # A user is waiting for the data
+BACKGROUND = 1  # Scheduled refreshes
+
+
+class MarketDataUnavailable(Exception):
+    """Raised when market data cannot be fetched right now, the caller should keep its last known data"""
+
+
+class CircuitOpenError(MarketDataUnavailable):
+    """Raised without calling the upstream while its circuit breaker is open"""
+
+
+class MarketDataTimeout(MarketDataUnavailable):
+    """Raised when a call does not complete within its deadline"""
+
+
+class MarketDataProvider:
+    """Interface for a source of ticker info and price bars"""
+
+    name = 'provider'
+
+    def info(self, symbol):
+        """Get a dict with at least shortName, currency and sector of a symbol"""
+        raise NotImplementedError
+
+    def history(self, symbol, start, end, interval='1d'):
+        """Get the price bars of a symbol between start and end, daily ('1d') or intraday (e.g. '1h')"""
+        raise NotImplementedError
+
+
+class YFinanceProvider(MarketDataProvider):
+    """Market data from Yahoo Finance through yfinance, which is only imported with the first call"""
+
+    name = 'Yahoo Finance'
+
+    def info(self, symbol):
+        import yfinance as yf
+        return yf.Ticker(symbol).info
+
+    def history(self, symbol, start, end, interval='1d'):
+        import yfinance as yf
+        return yf.Ticker(symbol).history(start=start, end=end, interval=interval)
+
+
+class RecordingProvider(MarketDataProvider):
+    """Passes calls on to another provider and captures its responses in a directory for ReplayProvider
+
+    The bars of all calls for a symbol and interval are merged, so repeated and incremental
+    refreshes build up one continuous recording.
+    """
+
+    def __init__(self, provider, directory):
+        self.provider = provider
+        self.name = provider.name
+        self.recordings = Recordings(directory)
+
+    def info(self, symbol):
+        info = self.provider.info(symbol)
+        self.recordings.save_info(symbol, info)
+        return info
+
+    def history(self, symbol, start, end, interval='1d'):
+        bars = self.provider.history(symbol, start, end, interval)
+        self.recordings.save_history(symbol, interval, bars)
+        return bars
+
+
+class ReplayProvider(MarketDataProvider):
+    """Serves captured responses from a directory, waiting latency (plus up to jitter) seconds per call
+
+    Requests are answered with the recorded bars between start and end, so the same refreshes give the
+    same data on any machine without network access.
+    """
+
+    name = 'replay'
+
+    def __init__(self, directory, latency=0.0, jitter=0.0, seed=None):
+        self.recordings = Recordings(directory)
+        self.latency = latency
+        self.jitter = jitter
+        self._random = random.Random(seed)
+
+    def _wait(self):
+        delay = self.latency + (self._random.uniform(0, self.jitter) if self.jitter else 0)
+        if delay > 0:
+            time.sleep(delay)
+
+    def info(self, symbol):
+        self._wait()
+        info = self.recordings.load_info(symbol)
+        if info is None:
+            raise KeyError(f"No recorded info for {symbol}")
+        return info
+
+    def history(self, symbol, start, end, interval='1d'):
+        self._wait()
+        bars = self.recordings.load_history(symbol, interval)
+        if bars is None:
+            raise KeyError(f"No recorded {interval} bars for {symbol}")
+        if bars.empty:
+            return bars
+        tz = bars.index.tz
+        return bars.loc[_bound(start, tz):_bound(end, tz)]
+
+
+class Recordings:
+    """Captured market data responses, one directory per symbol with info.json and a pickle per interval"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._lock = threading.Lock()
+
+    def _path(self, symbol, name):
+        return os.path.join(self.directory, symbol, name)
+
+    def save_info(self, symbol, info):
+        path = self._path(symbol, 'info.json')
+        with self._lock:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(info, f, default=str)
+
+    def load_info(self, symbol):
+        path = self._path(symbol, 'info.json')
+        if not os.path.exists(path):
+            return None
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+
+    def save_history(self, symbol, interval, bars):
+        """Merge bars into the recording, newer bars replace recorded bars with the same timestamp"""
+        path = self._path(symbol, f'history_{interval}.pkl')
+        with self._lock:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            recorded = pd.read_pickle(path) if os.path.exists(path) else None
+            if recorded is not None and bars.empty:
+                return
+            if recorded is not None and not recorded.empty:
+                bars = pd.concat([recorded, bars])
+                bars = bars[~bars.index.duplicated(keep='last')].sort_index()
+            bars.to_pickle(path)
+
+    def load_history(self, symbol, interval):
+        path = self._path(symbol, f'history_{interval}.pkl')
+        return pd.read_pickle(path) if os.path.exists(path) else None
+
+
+def _bound(value, tz):
+    """Make a start or end date comparable with an index in timezone tz, naive dates are taken as local time there"""
+    if value is None:
+        return None
+    value = pd.Timestamp(value)
+    if tz is None:
+        return value.tz_localize(None) if value.tz is not None else value
+    return value.tz_localize(tz) if value.tz is None else value.tz_convert(tz)
+
+
+class SingleFlight:
+    """Lets concurrent callers with the same key share one in-flight call"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, call):
+        """Run call() unless a call with the same key is already running, then wait for its result instead
+
+        Returns a (result, shared) tuple, where shared tells whether the result came from another caller.
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._calls[key] = future
+        if not leader:
+            return future.result(), True
+
+        try:
+            result = call()
+            future.set_result(result)
+            return result, False
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+
+class RateLimiter:
+    """Token bucket that serves waiting callers in priority order
+
+    Tokens are added at rate per second up to burst. A caller only takes a token when no caller with a
+    higher priority (or the same priority that arrived earlier) is waiting. A rate of None disables limiting.
+    """
+
+    def __init__(self, rate=DEFAULT_RATE, burst=DEFAULT_BURST):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._waiters = []
+        self._order = itertools.count()
+        self._condition = threading.Condition()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, priority=INTERACTIVE, timeout=None):
+        """Wait for a token, returning False if none could be taken within timeout seconds"""
+        if not self.rate:
+            return True
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        with self._condition:
+            entry = (priority, next(self._order))
+            heapq.heappush(self._waiters, entry)
+            try:
+                while True:
+                    self._refill()
+                    first = self._waiters[0] == entry
+                    if first and self._tokens >= 1:
+                        self._tokens -= 1
+                        return True
+                    # The first waiter sleeps until the next token, the others until they are woken up
+                    wait = (1 - self._tokens) / self.rate if first else None
+                    if deadline is not None:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            return False
+                        wait = remaining if wait is None else min(wait, remaining)
+                    self._condition.wait(wait)
+            finally:
+                self._waiters.remove(entry)
+                heapq.heapify(self._waiters)
+                self._condition.notify_all()
+
+
+class CircuitBreaker:
+    """Stops calling a failing upstream for a cooldown period
+
+    After failure_threshold consecutive failures the breaker opens and rejects every call. Once the
+    cooldown has passed it lets a single trial call through: a success closes it again, a failure
+    opens it for another cooldown.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=5, cooldown=60.0):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Check whether a call may go out, a True result must be followed by record_success or record_failure"""
+        with self._lock:
+            if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.cooldown:
+                self.state = self.HALF_OPEN
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.HALF_OPEN and not self._trial_running:
+                self._trial_running = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self._failures = 0
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+            self._trial_running = False
+
+
+class MarketDataGateway:
+    """Single entry point for all outbound market data calls, made to provider (Yahoo Finance by default)
+
+    Identical concurrent calls are coalesced into one, and the calls that do go out are rate limited
+    with interactive requests ahead of background refreshes. Once it has its turn, every call has a
+    deadline of timeout seconds, and a circuit breaker stops calling the provider while it keeps
+    failing. Both surface as MarketDataUnavailable.
+    """
+
+    def __init__(self, provider=None, rate=DEFAULT_RATE, burst=DEFAULT_BURST, timeout=10.0, failure_threshold=5,
+                 cooldown=60.0, max_workers=8):
+        self.provider = provider if provider is not None else YFinanceProvider()
+        self.limiter = RateLimiter(rate, burst)
+        self.breaker = CircuitBreaker(failure_threshold, cooldown)
+        self.timeout = timeout
+        # Calls run on their own threads so the caller can stop waiting, a timed out call finishes in the background
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='market-data')
+        self._flights = SingleFlight()
+
+    def info(self, symbol, priority=INTERACTIVE):
+        """Get the info dict of a symbol"""
+        return self._fetch(('info', symbol), lambda: self.provider.info(symbol), priority)
+
+    def history(self, symbol, start, end, interval='1d', priority=INTERACTIVE):
+        """Get the price bars of a symbol between start and end"""
+        # Requests for the same range within the same minute share one call
+        key = ('history', symbol, interval, _minute(start), _minute(end))
+        return self._fetch(key, lambda: self.provider.history(symbol, start, end, interval), priority)
+
+    def _fetch(self, key, call, priority):
+        result, shared = self._flights.do(key, lambda: self._guarded_call(key, call, priority))
+        if shared:
+            self._count(key, 'coalesced')
+        return result
+
+    def _guarded_call(self, key, call, priority):
+        # Checked before waiting for a token, so rejected calls do not hold up the others
+        if not self.breaker.allow():
+            self._count(key, 'rejected')
+            raise CircuitOpenError(f"Not calling {self.provider.name} for {key[1]} after repeated failures")
+        self.limiter.acquire(priority)
+
+        start = time.perf_counter()
+        future = self._executor.submit(call)
+        try:
+            result = future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            self.breaker.record_failure()
+            self._count(key, 'timeout', start)
+            raise MarketDataTimeout(f"{self.provider.name} call for {key[1]} exceeded {self.timeout}s") from None
+        except Exception as e:
+            # Errors about one symbol, like an unknown or delisted ticker, show the provider is answering
+            if is_upstream_failure(e):
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()
+            self._count(key, 'error', start)
+            raise
+        self.breaker.record_success()
+        self._count(key, 'ok', start)
+        return result
+
+    def _count(self, key, outcome, start=None):
+        # info calls are one endpoint, history calls one per interval (daily, intraday)
+        endpoint = key[0] if key[0] == 'info' else f"{key[0]}_{key[2]}"
+        metrics.market_data_calls.inc(provider=self.provider.name, endpoint=endpoint, outcome=outcome)
+        if start is not None:
+            metrics.market_data_call_duration.observe(time.perf_counter() - start, provider=self.provider.name,
+                                                      endpoint=endpoint)
+
+
+def is_upstream_failure(error):
+    """Check whether an error means the provider itself is failing rather than a single symbol
+
+    HTTP errors count when they are server errors (5xx) or rate limiting (429), other connection and
+    transport errors (OSError, which the HTTP clients' request errors derive from) always count.
+    """
+    response = getattr(error, 'response', None)
+    status = getattr(response, 'status_code', None) or getattr(error, 'status_code', None)
+    if isinstance(status, int):
+        return status >= 500 or status == 429
+    # yfinance reports Yahoo's rate limiting as YFRateLimitError, without a response
+    if 'RateLimit' in type(error).__name__:
+        return True
+    return isinstance(error, (OSError, TimeoutError))
+
+
+def _minute(value):
+    return value.replace(second=0, microsecond=0) if value is not None else None
+
+
+_gateway = None
+_gateway_lock = threading.Lock()
+
+
+def get_market_data():
+    """Get the market data gateway shared by the whole process"""
+    global _gateway
+    if _gateway is None:
+        with _gateway_lock:
+            if _gateway is None:
+                _gateway = MarketDataGateway(_configured_provider(), rate=float(os.environ.get(RATE_ENV, DEFAULT_RATE)),
+                                             burst=int(os.environ.get(BURST_ENV, DEFAULT_BURST)))
+    return _gateway
+
+
+def _configured_provider():
+    """Create the provider selected by INVESTMENT_TRACKER_MARKET_DATA"""
+    setting = os.environ.get(PROVIDER_ENV, 'yfinance')
+    kind, _, directory = setting.partition(':')
+    if kind == 'yfinance':
+        return YFinanceProvider()
+    if kind == 'record' and directory:
+        return RecordingProvider(YFinanceProvider(), directory)
+    if kind == 'replay' and directory:
+        return ReplayProvider(directory, latency=float(os.environ.get(REPLAY_LATENCY_ENV, 0)))
+    raise ValueError(f"Unknown market data provider: {setting}")
+
+
+def set_market_data(gateway):
+    """Use a custom market data gateway, for example with different rate limits"""
+    global _gateway
+    with _gateway_lock:
+        _gateway = gateway
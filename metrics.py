@@ -0,0 +1,208 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# Seconds, from a cached page render up to a slow Yahoo Finance call
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Metric:
+    """Base class for metrics with a fixed set of label names, rendered in the Prometheus text format"""
+
+    type = 'untyped'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if len(labels) != len(self.labels):
+            raise ValueError(f"{self.name} expects the labels {self.labels}, got {tuple(labels)}")
+        return tuple([labels[label] if type(labels[label]) is str else str(labels[label]) for label in self.labels])
+
+    def _format_labels(self, key, extra=()):
+        pairs = list(zip(self.labels, key)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{label}="{_escape(value)}"' for label, value in pairs) + '}'
+
+    def samples(self):
+        """Get the (suffix, labels, value) samples of the metric"""
+        raise NotImplementedError
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        for suffix, labels, value in self.samples():
+            lines.append(f"{self.name}{suffix}{labels} {_format_value(value)}")
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    """Monotonically increasing count"""
+
+    type = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return [('_total', self._format_labels(key), value) for key, value in values]
+
+
+class Gauge(Metric):
+    """Value that can go up and down, set directly or computed by a function when metrics are collected"""
+
+    type = 'gauge'
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        self._values = {}
+        self._function = None
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def set_function(self, function):
+        """Compute the values on every collection, function returns a dict mapping label value tuples to values"""
+        self._function = function
+
+    def samples(self):
+        if self._function is not None:
+            values = self._function()
+        else:
+            with self._lock:
+                values = dict(self._values)
+        return [('', self._format_labels(tuple(str(value) for value in key)), value)
+                for key, value in sorted(values.items())]
+
+
+class Histogram(Metric):
+    """Distribution of observed values, counted in cumulative buckets"""
+
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}  # label values -> [count per bucket (+Inf last), sum]
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        bucket = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][bucket] += 1
+            entry[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of the block in seconds"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        with self._lock:
+            values = sorted((key, (list(counts), total)) for key, (counts, total) in self._values.items())
+        samples = []
+        for key, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                samples.append(('_bucket', self._format_labels(key, [('le', _format_value(bound))]), cumulative))
+            samples.append(('_sum', self._format_labels(key), total))
+            samples.append(('_count', self._format_labels(key), cumulative))
+        return samples
+
+
+class Registry:
+    """Collection of metrics rendered together on the /metrics endpoint"""
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=()):
+        return self.register(Gauge(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def render(self):
+        """Render all metrics in the Prometheus text exposition format"""
+        return '\n'.join(metric.render() for metric in self._metrics) + '\n'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+REGISTRY = Registry()
+
+http_request_duration = REGISTRY.histogram(
+    'investment_tracker_http_request_duration_seconds', 'Time spent handling a request, by route',
+    ('route', 'method', 'status'))
+market_data_calls = REGISTRY.counter(
+    'investment_tracker_market_data_calls', 'Market data calls by endpoint and outcome',
+    ('provider', 'endpoint', 'outcome'))
+market_data_call_duration = REGISTRY.histogram(
+    'investment_tracker_market_data_call_duration_seconds', 'Duration of market data calls that reached the provider',
+    ('provider', 'endpoint'))
+market_data_circuit_open = REGISTRY.gauge(
+    'investment_tracker_market_data_circuit_open', '1 while the circuit breaker of the market data provider is open',
+    ('provider',))
+ticker_data_age = REGISTRY.gauge(
+    'investment_tracker_ticker_data_age_seconds', 'Seconds since the price data of a tracked ticker was updated',
+    ('ticker',))
+storage_duration = REGISTRY.histogram(
+    'investment_tracker_storage_duration_seconds', 'Time spent loading and saving sessions and ticker data',
+    ('kind', 'operation'))
+storage_size = REGISTRY.gauge(
+    'investment_tracker_storage_size_bytes', 'Size of the last saved or loaded session snapshot',
+    ('kind', 'operation'))
+cache_requests = REGISTRY.counter(
+    'investment_tracker_cache_requests', 'Lookups in the in-process caches, by cache and result',
+    ('cache', 'result'))
+
+
+def record_cache(cache, hit):
+    """Count a hit or miss of the named cache
+
+    This runs on every cache lookup, so it skips the lock: an increment racing with another one for the
+    same cache may be lost, which does not matter for a hit ratio.
+    """
+    key = (cache, 'hit' if hit else 'miss')
+    values = cache_requests._values
+    values[key] = values.get(key, 0) + 1
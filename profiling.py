@@ -0,0 +1,109 @@
+import datetime
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+
+
+class Capture:
+    """Stack samples of one request, counted per distinct stack"""
+
+    def __init__(self, thread_id, forced):
+        self.thread_id = thread_id
+        self.forced = forced
+        self.start = time.perf_counter()
+        self.stacks = Counter()
+        self.samples = 0
+
+
+class RequestProfiler:
+    """Sampling profiler for single requests, writing flamegraph-compatible folded stacks
+
+    A background thread samples the stacks of the threads handling profiled requests every interval
+    seconds. A request is profiled when it is forced (see begin), or, if slow_threshold is set, kept when
+    it took at least slow_threshold seconds; to catch those every request is sampled while it runs.
+    At most one profile is written every min_interval seconds.
+
+    Profiles are written to directory as <time>_<label>_<ms>ms.folded, one "frame;frame;frame count"
+    line per distinct stack, which flamegraph.pl and speedscope read directly.
+    """
+
+    def __init__(self, directory='profiles', interval=0.005, slow_threshold=None, min_interval=60.0):
+        self.directory = directory
+        self.interval = interval
+        self.slow_threshold = slow_threshold
+        self.min_interval = min_interval
+        self._active = {}
+        self._condition = threading.Condition()
+        self._thread = None
+        self._last_written = None
+
+    def _may_write(self):
+        return self._last_written is None or time.monotonic() - self._last_written >= self.min_interval
+
+    def begin(self, forced=False):
+        """Start sampling the current thread, return the capture to pass to end() or None if not sampled"""
+        with self._condition:
+            if forced and not self._may_write():
+                forced = False
+            if not forced and self.slow_threshold is None:
+                return None
+            capture = Capture(threading.get_ident(), forced)
+            self._active[capture.thread_id] = capture
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='request-profiler', daemon=True)
+                self._thread.start()
+            self._condition.notify()
+        return capture
+
+    def end(self, capture, label):
+        """Stop sampling and write the profile if the request was forced or slow, return its path or None"""
+        if capture is None:
+            return None
+        duration = time.perf_counter() - capture.start
+        with self._condition:
+            self._active.pop(capture.thread_id, None)
+            slow = self.slow_threshold is not None and duration >= self.slow_threshold
+            if not capture.samples or not (capture.forced or (slow and self._may_write())):
+                return None
+            self._last_written = time.monotonic()
+        return self._write(capture, label, duration)
+
+    def _write(self, capture, label, duration):
+        os.makedirs(self.directory, exist_ok=True)
+        name = re.sub(r'[^A-Za-z0-9_.-]+', '_', label).strip('_') or 'request'
+        timestamp = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
+        path = os.path.join(self.directory, f"{timestamp}_{name}_{duration * 1000:.0f}ms.folded")
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, count in capture.stacks.most_common():
+                f.write(f"{';'.join(stack)} {count}\n")
+        return path
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while True:
+            with self._condition:
+                while not self._active:
+                    self._condition.wait()
+                captures = list(self._active.values())
+            frames = sys._current_frames()
+            for capture in captures:
+                frame = frames.get(capture.thread_id)
+                if frame is not None and capture.thread_id != own_id:
+                    capture.stacks[_stack(frame)] += 1
+                    capture.samples += 1
+            del frames
+            time.sleep(self.interval)
+
+
+def _stack(frame):
+    """Frames from the outermost call to frame, labelled function (file:line of the definition)"""
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})".replace(';', ':'))
+        frame = frame.f_back
+    stack.reverse()
+    return tuple(stack)
@@ -0,0 +1,139 @@
+import datetime
+import os
+import threading
+
+from classes import Ticker, refresh_tickers_concurrently
+from market_data import BACKGROUND, INTERACTIVE
+from shm_cache import DEFAULT_NAME, NAME_ENV, SharedPriceCache, set_shared_price_cache
+from ticker_store import get_ticker_store
+
+
+class BackgroundRefresher:
+    """Keeps tracked tickers fresh in a background thread so page requests never wait on Yahoo"""
+
+    def __init__(self, get_program_data, poll_interval=30, lead_time=datetime.timedelta(minutes=2)):
+        # get_program_data is a callable so the refresher follows session loads that replace the program data
+        self.get_program_data = get_program_data
+        self.poll_interval = poll_interval
+        self.lead_time = lead_time  # Refresh tickers this long before their data expires
+        self._requested = set()
+        self._in_flight = set()
+        self._failed = set()  # Tickers whose last refresh failed, until one succeeds
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Start the background thread if it is not running yet"""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, name="ticker-refresher", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Stop the background thread after the current refresh cycle"""
+        self._stopped.set()
+        self._wakeup.set()
+
+    def request_refresh(self, ticker):
+        """Schedule a ticker for refresh on the next cycle without blocking the caller"""
+        with self._lock:
+            self._requested.add(ticker.tickerId)
+        self._wakeup.set()
+
+    def is_refreshing(self, ticker_id):
+        """Check whether a ticker is queued for or currently being refreshed"""
+        with self._lock:
+            return ticker_id in self._requested or ticker_id in self._in_flight
+
+    def refresh_failed(self, ticker_id):
+        """Check whether the last refresh of a ticker failed, so pages stop waiting for it"""
+        return ticker_id in self._failed
+
+    def refresh_due_tickers(self):
+        """Refresh all tickers that were requested or expire within the lead time"""
+        program_data = self.get_program_data()
+        with self._lock:
+            requested = self._requested
+            self._requested = set()
+
+        due = [ticker for ticker in program_data.collect_tickers()
+               if ticker.tickerId in requested or ticker.needs_refresh(self.lead_time)]
+        if not due:
+            return {}
+
+        with self._lock:
+            self._in_flight.update(ticker.tickerId for ticker in due)
+        try:
+            # Tickers a user is waiting for go out ahead of the scheduled refreshes
+            results = {}
+            for tickers, priority in (([t for t in due if t.tickerId in requested], INTERACTIVE),
+                                      ([t for t in due if t.tickerId not in requested], BACKGROUND)):
+                if tickers:
+                    results.update(refresh_tickers_concurrently(tickers, force=True, priority=priority,
+                                                                max_workers=program_data.refresh_workers))
+            program_data.update_investment_values()
+        finally:
+            with self._lock:
+                self._in_flight.difference_update(ticker.tickerId for ticker in due)
+                self._failed = (self._failed | {ticker_id for ticker_id, ok in results.items() if not ok}) \
+                    - {ticker_id for ticker_id, ok in results.items() if ok}
+        return results
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                self.refresh_due_tickers()
+            except Exception as e:
+                print(f"Error in background refresh: {e}")
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+
+
+class StoredTickers:
+    """Stands in for the program data in the shared refresher process, covering every ticker in the ticker store
+
+    Workers that add a new ticker save it to the store, so it is picked up on the next cycle.
+    """
+
+    refresh_workers = 8
+
+    def __init__(self):
+        self._tickers = {}
+
+    def collect_tickers(self, users=None):
+        for ticker_id in get_ticker_store().list_tickers():
+            if ticker_id not in self._tickers:
+                ticker = Ticker(ticker_id)
+                ticker.publish_shared()
+                self._tickers[ticker_id] = ticker
+        return list(self._tickers.values())
+
+    def update_investment_values(self, users=None):
+        # Investments live in the worker processes, which revalue them from the shared prices
+        pass
+
+
+def run_shared_refresher(name=DEFAULT_NAME, poll_interval=30):
+    """Refresh all stored tickers and publish them to the shared price cache until interrupted
+
+    Web workers started with INVESTMENT_TRACKER_SHM=reader then never call Yahoo for these tickers.
+    """
+    cache = SharedPriceCache('writer', name)
+    set_shared_price_cache(cache)
+    stored = StoredTickers()
+    refresher = BackgroundRefresher(lambda: stored, poll_interval=poll_interval)
+    try:
+        refresher._run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        cache.close()
+
+
+if __name__ == '__main__':
+    # Usage: python refresher.py, next to web workers started with INVESTMENT_TRACKER_SHM=reader
+    run_shared_refresher(os.environ.get(NAME_ENV, DEFAULT_NAME))
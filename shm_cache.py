@@ -0,0 +1,306 @@
+import datetime
+import json
+import os
+import sys
+import threading
+import time
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+import pandas as pd
+
+ROLE_ENV = 'INVESTMENT_TRACKER_SHM'  # 'writer' for the refresher process, 'reader' for web workers
+NAME_ENV = 'INVESTMENT_TRACKER_SHM_NAME'
+DEFAULT_NAME = 'investment_tracker'
+TABLE_DTYPE = np.dtype([('ticker', 'S32'), ('version', '<i8')])
+ALIGNMENT = 64
+
+
+class SharedPriceCache:
+    """Ticker price frames shared between processes through shared memory
+
+    The writer (the refresher process) publishes each new version of a ticker's frames into its own
+    segment named <name>_<slot>_<version> and then bumps the ticker's version in a small version table.
+    Readers (the web workers) look up the version on every access, map new segments read-only and build
+    DataFrames on top of them without copying, so memory stays flat as workers are added.
+
+    Prices are stored as float64, one block per frame, with the timestamps as UTC nanoseconds.
+    """
+
+    def __init__(self, role, name=DEFAULT_NAME, capacity=4096, reattach_interval=10):
+        if role not in ('writer', 'reader'):
+            raise ValueError(f"Unknown shared price cache role: {role}")
+        self.role = role
+        self.name = name
+        self.capacity = capacity
+        self.reattach_interval = reattach_interval  # Readers re-open the table to follow a restarted writer
+        self._lock = threading.Lock()
+        self._table_shm = None
+        self._table = None
+        self._attached_at = None
+        self._slots = {}
+        # Writer: ticker id -> segment of the published version
+        # Reader: ticker id -> (version, segment, published frames)
+        self._segments = {}
+        self._retired = []  # Reader segments whose frames may still be in use
+        if role == 'writer':
+            self._create_table()
+
+    @property
+    def is_writer(self):
+        return self.role == 'writer'
+
+    def _table_name(self):
+        return f"{self.name}_versions"
+
+    def _segment_name(self, slot, version):
+        return f"{self.name}_{slot}_{version}"
+
+    def _create_table(self):
+        try:
+            shm = shared_memory.SharedMemory(name=self._table_name(), create=True,
+                                             size=TABLE_DTYPE.itemsize * self.capacity)
+        except FileExistsError:
+            # Left behind by a previous writer, continue its versions so readers keep their slots
+            shm = shared_memory.SharedMemory(name=self._table_name())
+        self._table_shm = shm
+        self._table = np.ndarray((shm.size // TABLE_DTYPE.itemsize,), dtype=TABLE_DTYPE, buffer=shm.buf)
+        for slot, ticker in enumerate(self._table['ticker']):
+            if ticker:
+                self._slots[ticker.decode()] = slot
+
+    def _attach_table(self):
+        now = time.monotonic()
+        if self._attached_at is not None and now - self._attached_at < self.reattach_interval:
+            return self._table
+
+        self._attached_at = now
+        old_shm = self._table_shm
+        self._table = self._table_shm = None
+        self._slots = {}
+        if old_shm is not None:
+            self._retired.append(old_shm)
+            self._close_retired()
+        try:
+            shm = _attach(self._table_name())
+        except FileNotFoundError:
+            # No writer has started yet
+            return None
+        self._table_shm = shm
+        self._table = np.ndarray((shm.size // TABLE_DTYPE.itemsize,), dtype=TABLE_DTYPE, buffer=shm.buf)
+        return self._table
+
+    def _find_slot(self, ticker_id, create=False):
+        slot = self._slots.get(ticker_id)
+        if slot is None:
+            key = ticker_id.encode()
+            matches = np.flatnonzero(self._table['ticker'] == key)
+            if len(matches):
+                slot = int(matches[0])
+            elif create:
+                free = np.flatnonzero(self._table['ticker'] == b'')
+                if not len(free):
+                    raise RuntimeError(f"Shared price cache {self.name} is full")
+                slot = int(free[0])
+                self._table['ticker'][slot] = key
+            else:
+                return None
+            self._slots[ticker_id] = slot
+        return slot
+
+    def publish(self, ticker_id, closing_prices, intraday_prices, last_updated):
+        """Publish a new version of a ticker's frames to all readers and return the version"""
+        if not self.is_writer:
+            raise RuntimeError("Only the writer can publish to the shared price cache")
+        size, header, arrays = _layout({'closingPrices': closing_prices, 'intradayPrices': intraday_prices},
+                                       last_updated)
+        with self._lock:
+            slot = self._find_slot(ticker_id, create=True)
+            version = int(self._table['version'][slot]) + 1
+            name = self._segment_name(slot, version)
+            try:
+                shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+            except FileExistsError:
+                stale = shared_memory.SharedMemory(name=name)
+                stale.close()
+                stale.unlink()
+                shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+            _write(shm.buf, size, header, arrays)
+
+            # Readers only look for the new segment once the version is bumped
+            self._table['version'][slot] = version
+            previous = self._segments.get(ticker_id)
+            self._segments[ticker_id] = shm
+            if previous is not None:
+                # Readers that already mapped the previous version keep their mapping
+                previous.close()
+                previous.unlink()
+        return version
+
+    def lookup(self, ticker_id):
+        """Get (version, closingPrices, intradayPrices, last_updated) of the latest published version, or None"""
+        if self.is_writer:
+            return None
+        with self._lock:
+            table = self._attach_table()
+            if table is None:
+                return None
+            slot = self._find_slot(ticker_id)
+            if slot is None:
+                return None
+            version = int(table['version'][slot])
+            cached = self._segments.get(ticker_id)
+            if version == 0 or (cached is not None and cached[0] == version):
+                return cached[2] if cached is not None else None
+
+            try:
+                shm = _attach(self._segment_name(slot, version))
+            except FileNotFoundError:
+                # Replaced again while we were looking, keep the previous version until the next lookup
+                return cached[2] if cached is not None else None
+            closing_prices, intraday_prices, last_updated = _read(shm.buf)
+            published = (version, closing_prices, intraday_prices, last_updated)
+            self._segments[ticker_id] = (version, shm, published)
+            if cached is not None:
+                self._retired.append(cached[1])
+            self._close_retired()
+            return published
+
+    def _close_retired(self):
+        """Unmap replaced segments once no frames built on them are left"""
+        still_used = []
+        for shm in self._retired:
+            try:
+                shm.close()
+            except BufferError:
+                still_used.append(shm)
+        self._retired = still_used
+
+    def close(self):
+        """Unmap all segments, the writer also removes them"""
+        with self._lock:
+            for entry in self._segments.values():
+                shm = entry if self.is_writer else entry[1]
+                self._retired.append(shm)
+                if self.is_writer:
+                    shm.unlink()
+            self._segments = {}
+            self._close_retired()
+            self._table = None
+            if self._table_shm is not None:
+                self._table_shm.close()
+                if self.is_writer:
+                    self._table_shm.unlink()
+                self._table_shm = None
+
+
+class _MappedSegment(shared_memory.SharedMemory):
+    """Segment mapped by a reader, which may still back frames in use when the process exits"""
+
+    def __del__(self):
+        try:
+            self.close()
+        except BufferError:
+            # The frames built on the segment keep the mapping alive until they are freed
+            pass
+
+
+def _attach(name):
+    """Map an existing segment without letting this process's resource tracker remove it on exit"""
+    if sys.version_info >= (3, 13):
+        return _MappedSegment(name=name, track=False)
+    shm = _MappedSegment(name=name)
+    resource_tracker.unregister(shm._name, 'shared_memory')
+    return shm
+
+
+def _align(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def _layout(frames, last_updated):
+    """Plan a segment: 16 bytes with the header position, the arrays, then a JSON header describing them"""
+    offset = ALIGNMENT
+    arrays = []
+    header = {'last_updated': last_updated.isoformat() if last_updated is not None else None, 'frames': {}}
+    for name, frame in frames.items():
+        if frame is None or frame.empty:
+            header['frames'][name] = {'rows': 0}
+            continue
+        numeric = frame.select_dtypes('number')
+        index = pd.DatetimeIndex(numeric.index).as_unit('ns')
+        times = index.asi8
+        values = np.ascontiguousarray(numeric.to_numpy(dtype=np.float64))
+        header['frames'][name] = {
+            'rows': len(numeric),
+            'columns': [str(column) for column in numeric.columns],
+            'tz': str(index.tz) if index.tz is not None else None,
+            'index_name': index.name,
+            'index_offset': offset,
+            'values_offset': _align(offset + times.nbytes),
+        }
+        arrays.append((offset, times))
+        offset = _align(offset + times.nbytes)
+        arrays.append((offset, values))
+        offset = _align(offset + values.nbytes)
+    header = json.dumps(header).encode()
+    return offset + len(header), header, arrays
+
+
+def _write(buf, size, header, arrays):
+    header_offset = size - len(header)
+    buf[:16] = np.array([header_offset, len(header)], dtype='<i8').tobytes()
+    for offset, array in arrays:
+        np.frombuffer(buf, dtype=array.dtype, count=array.size, offset=offset)[:] = array.ravel()
+    buf[header_offset:size] = header
+
+
+def _read(buf):
+    """Build the frames of a segment as read-only views on the shared memory"""
+    header_offset, header_length = (int(value) for value in np.frombuffer(buf, dtype='<i8', count=2))
+    header = json.loads(bytes(buf[header_offset:header_offset + header_length]))
+    frames = []
+    for name in ('closingPrices', 'intradayPrices'):
+        meta = header['frames'][name]
+        rows = meta['rows']
+        if rows == 0:
+            frames.append(pd.DataFrame())
+            continue
+        columns = meta['columns']
+        times = np.frombuffer(buf, dtype='<i8', count=rows, offset=meta['index_offset'])
+        index = pd.DatetimeIndex(times.view('M8[ns]'), name=meta['index_name'])
+        if meta['tz'] is not None:
+            index = index.tz_localize('UTC').tz_convert(meta['tz'])
+        values = np.frombuffer(buf, dtype=np.float64, count=rows * len(columns), offset=meta['values_offset'])
+        values = values.reshape(rows, len(columns))
+        values.flags.writeable = False
+        frames.append(pd.DataFrame(values, index=index, columns=columns, copy=False))
+    last_updated = header['last_updated']
+    last_updated = datetime.datetime.fromisoformat(last_updated) if last_updated is not None else None
+    return frames[0], frames[1], last_updated
+
+
+_shared_cache = None
+_configured = False
+_configure_lock = threading.Lock()
+
+
+def get_shared_price_cache():
+    """Get the shared price cache of this process as configured by INVESTMENT_TRACKER_SHM, or None"""
+    global _shared_cache, _configured
+    if not _configured:
+        with _configure_lock:
+            if not _configured:
+                role = os.environ.get(ROLE_ENV)
+                if role:
+                    _shared_cache = SharedPriceCache(role, os.environ.get(NAME_ENV, DEFAULT_NAME))
+                _configured = True
+    return _shared_cache
+
+
+def set_shared_price_cache(cache):
+    """Use the given shared price cache in this process, or None to disable it"""
+    global _shared_cache, _configured
+    with _configure_lock:
+        _shared_cache = cache
+        _configured = True
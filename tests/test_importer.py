@@ -0,0 +1,47 @@
+import io
+import os
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import importer  # noqa: E402
+from classes import MainProgramData  # noqa: E402
+from market_data import MarketDataGateway, ReplayProvider, get_market_data, set_market_data  # noqa: E402
+from benchmarks.synthetic import make_tickers, write_recordings  # noqa: E402
+
+
+class ImportTransactionsTest(unittest.TestCase):
+    """Imports with market data replayed from synthetic recordings, in a temporary directory"""
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.workdir = tempfile.TemporaryDirectory(prefix='investment_tracker_test_')
+        os.chdir(self.workdir.name)
+        self.addCleanup(self.workdir.cleanup)
+        self.addCleanup(os.chdir, self.cwd)
+        self.gateway = get_market_data()
+        self.addCleanup(set_market_data, self.gateway)
+        write_recordings('recordings', make_tickers(1, years=1))
+        set_market_data(MarketDataGateway(ReplayProvider('recordings'), rate=None))
+
+    def test_unknown_ticker_is_reported_and_not_tracked(self):
+        program_data = MainProgramData()
+        user = program_data.add_user("Importer")
+        file = io.StringIO("Date,Type,Ticker,Shares,Price\n"
+                           "2024-01-02,buy,SYN0000,10,5\n"
+                           "2024-01-02,buy,NOSUCHTICKR,10,5\n")
+
+        result = importer.import_transactions(program_data, user, file)
+
+        self.assertEqual([line for line, _ in result.errors], [3])
+        self.assertIn("NOSUCHTICKR", result.errors[0][1])
+        self.assertIsNone(program_data.get_ticker("NOSUCHTICKR"))
+        self.assertEqual(result.fetched_tickers, ["SYN0000"])
+        self.assertEqual([investment.ticker.tickerId for investment in user.investments], ["SYN0000"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,375 @@
+import datetime
+import json
+import os
+import pickle
+import sys
+
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+except ImportError:  # Fall back to the pickle store when pyarrow is not installed
+    pa = None
+
+FRAMES = ('closingPrices', 'intradayPrices')
+METADATA_FIELDS = ('name', 'currency', 'sector', 'dividendType', 'xDate', 'last_updated', 'last_full_sync', 'update_interval')
+INDEX_COLUMN = '__index__'
+
+
+class TickerStore:
+    """Interface for persisting ticker metadata and price frames"""
+
+    def load_metadata(self, ticker_id):
+        """Load the metadata dict of a ticker, or None if the ticker is not stored"""
+        raise NotImplementedError
+
+    def read_frame(self, ticker_id, frame, columns=None, start=None, end=None):
+        """Read a price frame, optionally limited to some columns and to the bars between start and end"""
+        raise NotImplementedError
+
+    def save(self, ticker_id, metadata, frames, new_bars=None):
+        """Save metadata and frames of a ticker
+
+        frames maps frame names to the complete frames. new_bars optionally maps frame names to
+        only the bars fetched since the last save, which stores may append instead of rewriting.
+        """
+        raise NotImplementedError
+
+    def exists(self, ticker_id):
+        """Check whether data for the ticker is stored"""
+        return self.load_metadata(ticker_id) is not None
+
+    def list_tickers(self):
+        """Get the IDs of all stored tickers"""
+        raise NotImplementedError
+
+    def load(self, ticker_id, start=None):
+        """Load metadata and all frames of a ticker into one dict, or None if the ticker is not stored
+
+        start optionally maps frame names to the earliest bar to read for that frame.
+        """
+        data = self.load_metadata(ticker_id)
+        if data is None:
+            return None
+        start = start or {}
+        for frame in FRAMES:
+            data[frame] = self.read_frame(ticker_id, frame, start=start.get(frame))
+        return data
+
+
+class PickleTickerStore(TickerStore):
+    """Original storage format: one pickled dict per ticker in <data_dir>/<ticker_id>.pkl"""
+
+    def __init__(self, data_dir="ticker_data"):
+        self.data_dir = data_dir
+
+    def _path(self, ticker_id):
+        return os.path.join(self.data_dir, f"{ticker_id}.pkl")
+
+    def _load_pickle(self, ticker_id):
+        path = self._path(ticker_id)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
+    def exists(self, ticker_id):
+        return os.path.exists(self._path(ticker_id))
+
+    def list_tickers(self):
+        if not os.path.isdir(self.data_dir):
+            return []
+        return sorted(file[:-len(".pkl")] for file in os.listdir(self.data_dir) if file.endswith(".pkl"))
+
+    def load_metadata(self, ticker_id):
+        data = self._load_pickle(ticker_id)
+        if data is None:
+            return None
+        return {key: value for key, value in data.items() if key not in FRAMES}
+
+    def read_frame(self, ticker_id, frame, columns=None, start=None, end=None):
+        data = self._load_pickle(ticker_id) or {}
+        return _filter_frame(data.get(frame, pd.DataFrame()), columns, start, end)
+
+    def load(self, ticker_id, start=None):
+        data = self._load_pickle(ticker_id)
+        if data is None:
+            return None
+        for frame, frame_start in (start or {}).items():
+            data[frame] = _filter_frame(data.get(frame, pd.DataFrame()), start=frame_start)
+        return data
+
+    def save(self, ticker_id, metadata, frames, new_bars=None):
+        data = {'tickerId': ticker_id}
+        data.update(metadata)
+        data.update(frames)
+        os.makedirs(self.data_dir, exist_ok=True)
+        with open(self._path(ticker_id), 'wb') as f:
+            pickle.dump(data, f)
+
+
+class ArrowTickerStore(TickerStore):
+    """Columnar store keeping each price frame as memory-mapped Arrow IPC segments
+
+    Layout: <data_dir>/<ticker_id>/meta.json plus <data_dir>/<ticker_id>/<frame>/<segment>.arrow.
+    New bars are appended as new segments, so a refresh never rewrites the existing history.
+    Overlapping bars in later segments replace earlier ones when reading. Once a frame has more
+    than max_segments segments it is compacted back into a single segment.
+    """
+
+    def __init__(self, data_dir="ticker_data", max_segments=16):
+        if pa is None:
+            raise ImportError("ArrowTickerStore requires pyarrow")
+        self.data_dir = data_dir
+        self.max_segments = max_segments
+        self.legacy = PickleTickerStore(data_dir)
+
+    def _ticker_dir(self, ticker_id):
+        return os.path.join(self.data_dir, ticker_id)
+
+    def _meta_path(self, ticker_id):
+        return os.path.join(self._ticker_dir(ticker_id), "meta.json")
+
+    def _read_meta(self, ticker_id):
+        path = self._meta_path(ticker_id)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r') as f:
+            return json.load(f)
+
+    def _write_meta(self, ticker_id, meta):
+        path = self._meta_path(ticker_id)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, path)
+
+    def exists(self, ticker_id):
+        # Legacy pickles count as stored, they are migrated when first loaded
+        return os.path.exists(self._meta_path(ticker_id)) or self.legacy.exists(ticker_id)
+
+    def list_tickers(self):
+        if not os.path.isdir(self.data_dir):
+            return []
+        stored = {entry for entry in os.listdir(self.data_dir) if os.path.exists(self._meta_path(entry))}
+        return sorted(stored | set(self.legacy.list_tickers()))
+
+    def load_metadata(self, ticker_id):
+        meta = self._read_meta(ticker_id)
+        if meta is None:
+            # Pick up tickers that were saved in the original pickle format
+            if self.legacy.exists(ticker_id):
+                self.migrate(ticker_id)
+                meta = self._read_meta(ticker_id)
+            if meta is None:
+                return None
+        return _decode_metadata(ticker_id, meta['metadata'])
+
+    def read_frame(self, ticker_id, frame, columns=None, start=None, end=None):
+        meta = self._read_meta(ticker_id)
+        if meta is None or frame not in meta['frames']:
+            return pd.DataFrame()
+        frame_meta = meta['frames'][frame]
+        tz = frame_meta['tz']
+        start_ns = _to_ns(start, tz) if start is not None else None
+        end_ns = _to_ns(end, tz) if end is not None else None
+
+        tables = []
+        for segment in frame_meta['segments']:
+            # Skip segments that lie entirely outside the requested range
+            if start_ns is not None and segment['max'] < start_ns:
+                continue
+            if end_ns is not None and segment['min'] > end_ns:
+                continue
+            path = os.path.join(self._ticker_dir(ticker_id), frame, segment['file'])
+            with pa.memory_map(path, 'r') as source:
+                table = pa.ipc.open_file(source).read_all()
+            if columns is not None:
+                table = table.select([INDEX_COLUMN] + [c for c in columns if c in table.column_names])
+            tables.append(table)
+        if not tables:
+            return pd.DataFrame()
+
+        table = pa.concat_tables(tables, promote_options='permissive') if len(tables) > 1 else tables[0]
+        if start_ns is not None or end_ns is not None:
+            index_ns = pc.cast(table[INDEX_COLUMN], pa.int64())
+            mask = None
+            if start_ns is not None:
+                mask = pc.greater_equal(index_ns, start_ns)
+            if end_ns is not None:
+                upper = pc.less_equal(index_ns, end_ns)
+                mask = upper if mask is None else pc.and_(mask, upper)
+            table = table.filter(mask)
+
+        result = table.to_pandas().set_index(INDEX_COLUMN)
+        result.index.name = frame_meta['index_name']
+        if len(tables) > 1:
+            result = result[~result.index.duplicated(keep='last')].sort_index()
+        return result
+
+    def save(self, ticker_id, metadata, frames, new_bars=None):
+        new_bars = new_bars or {}
+        meta = self._read_meta(ticker_id) or {'frames': {}}
+        meta['metadata'] = _encode_metadata(metadata)
+
+        obsolete = []
+        for frame, data in frames.items():
+            frame_meta = meta['frames'].get(frame)
+            if frame in new_bars and frame_meta is not None and len(frame_meta['segments']) < self.max_segments:
+                self._append_segment(ticker_id, frame, frame_meta, new_bars[frame])
+            else:
+                meta['frames'][frame] = self._rewrite_frame(ticker_id, frame, frame_meta, data)
+                if frame_meta is not None:
+                    obsolete.extend(os.path.join(self._ticker_dir(ticker_id), frame, segment['file'])
+                                    for segment in frame_meta['segments'])
+
+        self._write_meta(ticker_id, meta)
+
+        # Replaced segments are only removed once the new metadata no longer references them
+        for path in obsolete:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _append_segment(self, ticker_id, frame, frame_meta, bars):
+        if bars is None or bars.empty:
+            return
+        if bars.index.tz is not None and frame_meta['tz'] is not None and str(bars.index.tz) != frame_meta['tz']:
+            bars = bars.tz_convert(frame_meta['tz'])
+        frame_meta['segments'].append(self._write_segment(ticker_id, frame, frame_meta['next_segment'], bars))
+        frame_meta['next_segment'] += 1
+
+    def _rewrite_frame(self, ticker_id, frame, frame_meta, data):
+        next_segment = frame_meta['next_segment'] if frame_meta else 0
+        new_meta = {
+            'tz': str(data.index.tz) if isinstance(data.index, pd.DatetimeIndex) and data.index.tz is not None else None,
+            'index_name': data.index.name,
+            'segments': [],
+            'next_segment': next_segment,
+        }
+        if not data.empty:
+            new_meta['segments'].append(self._write_segment(ticker_id, frame, next_segment, data))
+            new_meta['next_segment'] += 1
+        return new_meta
+
+    def _write_segment(self, ticker_id, frame, number, data):
+        frame_dir = os.path.join(self._ticker_dir(ticker_id), frame)
+        os.makedirs(frame_dir, exist_ok=True)
+        file_name = f"{number:06d}.arrow"
+        path = os.path.join(frame_dir, file_name)
+
+        # Store timestamps in nanoseconds so segment bounds and range filters share one unit
+        index = data.index.as_unit('ns')
+        columns = {INDEX_COLUMN: pa.array(index)}
+        for column in data.columns:
+            columns[str(column)] = pa.array(data[column].to_numpy())
+        table = pa.table(columns)
+
+        tmp_path = path + ".tmp"
+        with pa.OSFile(tmp_path, 'wb') as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        os.replace(tmp_path, path)
+
+        index_ns = index.asi8
+        return {'file': file_name, 'rows': len(data), 'min': int(index_ns.min()), 'max': int(index_ns.max())}
+
+    def migrate(self, ticker_id):
+        """Copy a ticker from the legacy pickle format into this store"""
+        data = self.legacy.load(ticker_id)
+        if data is None:
+            return False
+        metadata = {key: data[key] for key in METADATA_FIELDS if key in data}
+        frames = {frame: data.get(frame, pd.DataFrame()) for frame in FRAMES}
+        self.save(ticker_id, metadata, frames)
+        return True
+
+
+def _filter_frame(frame, columns=None, start=None, end=None):
+    if frame.empty:
+        return frame
+    if columns is not None:
+        frame = frame[[c for c in columns if c in frame.columns]]
+    if start is not None:
+        frame = frame[frame.index >= _localize(start, frame.index.tz)]
+    if end is not None:
+        frame = frame[frame.index <= _localize(end, frame.index.tz)]
+    return frame
+
+
+def _localize(value, tz):
+    """Interpret naive datetimes in the timezone of the data they are compared with"""
+    ts = pd.Timestamp(value)
+    if tz is not None:
+        return ts.tz_localize(tz) if ts.tz is None else ts.tz_convert(tz)
+    return ts.tz_localize(None) if ts.tz is not None else ts
+
+
+def _to_ns(value, tz):
+    return _localize(value, tz).value
+
+
+def _encode_metadata(metadata):
+    encoded = {}
+    for key, value in metadata.items():
+        if isinstance(value, datetime.timedelta):
+            encoded[key] = {'timedelta': value.total_seconds()}
+        elif isinstance(value, datetime.datetime):
+            encoded[key] = {'datetime': value.isoformat()}
+        elif isinstance(value, datetime.date):
+            encoded[key] = {'date': value.isoformat()}
+        else:
+            encoded[key] = value
+    return encoded
+
+
+def _decode_metadata(ticker_id, encoded):
+    metadata = {'tickerId': ticker_id}
+    for key, value in encoded.items():
+        if isinstance(value, dict) and 'timedelta' in value:
+            value = datetime.timedelta(seconds=value['timedelta'])
+        elif isinstance(value, dict) and 'datetime' in value:
+            value = datetime.datetime.fromisoformat(value['datetime'])
+        elif isinstance(value, dict) and 'date' in value:
+            value = datetime.date.fromisoformat(value['date'])
+        metadata[key] = value
+    return metadata
+
+
+_stores = {}
+
+
+def get_ticker_store(data_dir="ticker_data"):
+    """Get the store for a data directory, using the Arrow store when pyarrow is available"""
+    if data_dir not in _stores:
+        _stores[data_dir] = ArrowTickerStore(data_dir) if pa is not None else PickleTickerStore(data_dir)
+    return _stores[data_dir]
+
+
+def set_ticker_store(store, data_dir="ticker_data"):
+    """Use a custom store for a data directory"""
+    _stores[data_dir] = store
+
+
+def migrate_pickles(data_dir="ticker_data", remove=False):
+    """Migrate every legacy <ticker_id>.pkl file in data_dir into the Arrow store"""
+    store = ArrowTickerStore(data_dir)
+    migrated = []
+    for file in sorted(os.listdir(data_dir)):
+        if file.endswith(".pkl"):
+            ticker_id = file[:-len(".pkl")]
+            try:
+                if store.migrate(ticker_id):
+                    migrated.append(ticker_id)
+                    if remove:
+                        os.remove(os.path.join(data_dir, file))
+            except Exception as e:
+                print(f"Error migrating {ticker_id}: {e}")
+    return migrated
+
+
+if __name__ == '__main__':
+    # Usage: python ticker_store.py [data_dir] [--remove]
+    args = [arg for arg in sys.argv[1:] if arg != '--remove']
+    migrated = migrate_pickles(args[0] if args else "ticker_data", remove='--remove' in sys.argv)
+    print(f"Migrated {len(migrated)} tickers: {', '.join(migrated)}")